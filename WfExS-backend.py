@@ -37,6 +37,7 @@ except ImportError:
 from wfexs_backend.workflow import WF
 from wfexs_backend import get_WfExS_version
 from wfexs_backend.common import ArgTypeMixin, CacheType as WfExS_CacheType
+from wfexs_backend.common import CacheGCPolicy as WfExS_CacheGCPolicy, parseByteSize
 
 class WfExS_Commands(ArgTypeMixin, enum.Enum):
     Init = 'init'
@@ -55,6 +56,7 @@ class WfExS_Cache_Commands(ArgTypeMixin, enum.Enum):
     Inject = 'inject'
     Remove = 'rm'
     Validate = 'validate'
+    GarbageCollect = 'gc'
 
 DEFAULT_LOCAL_CONFIG_RELNAME = 'wfexs_config.yml'
 LOGGING_FORMAT = '%(asctime)-15s - [%(levelname)s] %(message)s'
@@ -104,13 +106,14 @@ def processCacheCommand(wfInstance:WF, args: argparse.Namespace, logLevel) -> in
     cH , cPath = wfInstance.getCacheHandler(args.cache_type)
     retval = 0
     if args.cache_command == WfExS_Cache_Commands.List:
+        lister = cH.listFailed  if args.listFailed  else  cH.list
         if logLevel <= logging.INFO:
-            contents = sorted(map(lambda l: l[1], cH.list(cPath, *args.cache_command_args, acceptGlob=args.filesAsGlobs)), key=lambda x: x['stamp'])
+            contents = sorted(map(lambda l: l[1], lister(cPath, *args.cache_command_args, acceptGlob=args.filesAsGlobs)), key=lambda x: x['stamp'])
             for entry in contents:
                 json.dump(entry, sys.stdout, indent=4, sort_keys=True)
                 print()
         else:
-            contents = sorted(map(lambda l: l[0], cH.list(cPath, *args.cache_command_args, acceptGlob=args.filesAsGlobs)))
+            contents = sorted(map(lambda l: l[0], lister(cPath, *args.cache_command_args, acceptGlob=args.filesAsGlobs)))
             for entry in contents:
                 print(entry)
             
@@ -123,6 +126,16 @@ def processCacheCommand(wfInstance:WF, args: argparse.Namespace, logLevel) -> in
         # cH.remove(cPath, injected_uri)
         # Then, inject new occurrence
         cH.inject(cPath, injected_uri, finalCachedFilename=finalCachedFilename)
+    elif args.cache_command == WfExS_Cache_Commands.GarbageCollect:
+        maxSize, maxAge = wfInstance.getCacheGCLimits(args.cache_type)
+        if args.cacheMaxSize is not None:
+            maxSize = parseByteSize(args.cacheMaxSize)
+        if args.cacheMaxAgeDays is not None:
+            maxAge = args.cacheMaxAgeDays * 86400.0
+        policy = args.cacheGCPolicy  if args.cacheGCPolicy is not None  else  wfInstance.cacheGCPolicy
+        
+        for evictedPath, evictedSize, evictedURIs in cH.gc(cPath, maxSize=maxSize, maxAge=maxAge, policy=policy, dryRun=args.doCacheDryRun):
+            print('\t'.join([evictedPath, str(evictedSize), *evictedURIs]))
     #elif args.cache_command == WfExS_Cache_Commands.Validate:
     #    contents = cH.list(*args.cache_command_args)
     #    pass
@@ -168,6 +181,11 @@ if __name__ == "__main__":
     ap_c.add_argument('cache_command', help='Cache command to perform', type=WfExS_Cache_Commands.argtype, choices=WfExS_Cache_Commands)
     ap_c.add_argument("-r", dest="doCacheRecursively", help='Try doing the operation recursively (i.e. both metadata and data)', action="store_true", default=False)
     ap_c.add_argument("-g", dest="filesAsGlobs", help='Given cache element names are globs', action="store_true", default=False)
+    ap_c.add_argument("--failed", dest="listFailed", help='List the recently failed resolutions instead of the cached entries (ls)', action="store_true", default=False)
+    ap_c.add_argument("--max-size", dest="cacheMaxSize", help='Size budget for the garbage collection (gc), overriding the configured one (for instance, 500G)')
+    ap_c.add_argument("--max-age-days", dest="cacheMaxAgeDays", help='Days without being used before a content is evicted by the garbage collection (gc), overriding the configured one', type=float)
+    ap_c.add_argument("--policy", dest="cacheGCPolicy", help='Eviction policy for the garbage collection (gc), overriding the configured one', type=WfExS_CacheGCPolicy.argtype, choices=WfExS_CacheGCPolicy)
+    ap_c.add_argument("-n", "--dry-run", dest="doCacheDryRun", help='Only report what the garbage collection (gc) would evict', action="store_true", default=False)
     ap_c.add_argument('cache_type', help='Cache type to perform the cache command', type=WfExS_CacheType.argtype, choices=WfExS_CacheType)
     ap_c.add_argument('cache_command_args', help='Optional cache element names', nargs='*')
     
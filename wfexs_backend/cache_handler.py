@@ -17,8 +17,10 @@
 
 from __future__ import absolute_import
 
+import contextlib
 import datetime
-import fnmatch
+import errno
+import fcntl
 import hashlib
 import json
 import logging
@@ -26,25 +28,130 @@ import os
 import os.path
 import re
 import shutil
+import threading
+import time
 import urllib.parse
-import uuid
 
-from typing import Iterator, List, Mapping
-from typing import Optional, Pattern, Tuple, Union
+from typing import Any, Iterator, List, Mapping
+from typing import Optional, Sequence, Tuple, Union
 
 from .common import *
+from .cache_index import CacheMetadataIndex
 
 META_JSON_POSTFIX = '_meta.json'
+LOCK_POSTFIX = '.lock'
+TEMP_POSTFIX = '.tmp'
+CACHING_PREFIX = 'caching-'
+# Temporary files from crashed runs are recognized by the URI hash
+# they are linked to. Those from previous versions only by their age
+ORPHAN_PATTERN = re.compile(r'^(?:' + re.escape(CACHING_PREFIX) + r'([0-9a-f]{40})-.+|([0-9a-f]{40})(?:' + re.escape(META_JSON_POSTFIX) + r')?\..+' + re.escape(TEMP_POSTFIX) + r')$')
+LEGACY_ORPHAN_MIN_AGE = 86400
+# Temporary files of an entry are created while its URI lock is held, so
+# their names only depend on the URI hash, and the leftovers from crashed
+# fetches of an URI are found without listing the whole cache
+LOCKED_TEMP_POSTFIX = '.writing' + TEMP_POSTFIX
+FETCHING_POSTFIX = '-fetching'
+# Interrupted downloads from these schemes are kept, keyed by the
+# URI hash, so next fetches resume them instead of starting again
+RESUMABLE_SCHEMES = ('http', 'https', 'ftp', 'sftp', 'ssh')
+PARTIAL_POSTFIX = '-partial'
+# Seconds an untouched partial download is kept
+PARTIAL_MAX_AGE = 7 * 86400
+# Seconds a failed resolution is remembered, so it is not retried
+DEFAULT_FAILED_TTL = 3600
+# Only these answers tell the content does not exist. Connection
+# errors, timeouts, 5xx or 401/403 could be gone in the next try
+DEFINITIVE_FAILURE_STATUSES = (404, 410)
+# Schemes whose cached contents can be revalidated through conditional requests
+REVALIDATION_SCHEMES = ('http', 'https')
+# Default ports, which are removed from the canonical URIs
+DEFAULT_PORTS = {
+    'http': '80',
+    'https': '443',
+    'ftp': '21',
+    'sftp': '22',
+    'ssh': '22',
+}
+# Schemes whose paths follow RFC 3986 hierarchical semantics, so
+# dot-segments and empty segments can be removed
+HIERARCHICAL_PATH_SCHEMES = ('http', 'https', 'ftp')
+PERCENT_ENCODED_PATTERN = re.compile(r'%[0-9a-fA-F]{2}')
+
+def _removeDotSegments(path:str) -> str:
+    segments = re.sub(r'/{2,}', '/', path).split('/')
+    resolved = []
+    for segment in segments[1:]:
+        if segment == '..':
+            if len(resolved) > 0:
+                resolved.pop()
+        elif segment != '.':
+            resolved.append(segment)
+    
+    # A trailing dot-segment still denotes a directory
+    if segments[-1] in ('.', '..'):
+        resolved.append('')
+    
+    return '/' + '/'.join(resolved)
+
+def canonicalizeURI(the_remote_file:Union[urllib.parse.ParseResult, URIType], sortQuerySchemes:Sequence[str]=[]) -> URIType:
+    """
+    The canonical form of a URI, used to compute its cache key. Scheme
+    and host are lowercased, default ports and empty queries are removed,
+    and for http(s) and ftp also dot-segments and empty path segments.
+    The query parameters are sorted for the schemes in sortQuerySchemes.
+    It is never fetched, so the original URI is the one recorded
+    """
+    if isinstance(the_remote_file, urllib.parse.ParseResult):
+        the_remote_file = urllib.parse.urlunparse(the_remote_file)
+    
+    parsedURI = urllib.parse.urlsplit(the_remote_file)
+    scheme = parsedURI.scheme.lower()
+    # Opaque URIs (like pride.project:PXD001819) and local
+    # paths only get their scheme lowercased
+    if (scheme == '') or (parsedURI.netloc == ''):
+        return scheme + the_remote_file[len(scheme):]
+    
+    userinfo, at, hostport = parsedURI.netloc.rpartition('@')
+    hostport = hostport.lower()
+    host, colon, port = hostport.rpartition(':')
+    # Beware of IPv6 addresses
+    if (colon != '') and (']' not in port) and (port in ('', DEFAULT_PORTS.get(scheme))):
+        hostport = host
+    netloc = userinfo + at + hostport
+    
+    path = parsedURI.path
+    if scheme in HIERARCHICAL_PATH_SCHEMES:
+        path = PERCENT_ENCODED_PATTERN.sub(lambda m: m.group(0).upper(), path)
+        path = _removeDotSegments(path)
+    
+    query = parsedURI.query
+    if scheme in sortQuerySchemes:
+        query = '&'.join(sorted(filter(lambda param: param != '', query.split('&'))))
+    
+    return urllib.parse.urlunsplit((scheme, netloc, path, query, parsedURI.fragment))
+
 class SchemeHandlerCacheHandler:
-    def __init__(self, cacheDir, schemeHandlers:Mapping[str,ProtocolFetcher]):
+    def __init__(self, cacheDir, schemeHandlers:Mapping[str,ProtocolFetcher], failedTTL:float=DEFAULT_FAILED_TTL, sortQuerySchemes:Sequence[str]=[]):
         # Getting a logger focused on specific classes
         import inspect
         
         self.logger = logging.getLogger(dict(inspect.getmembers(self))['__module__'] + '::' + self.__class__.__name__)
         
-        # TODO: create caching database
         self.cacheDir = cacheDir
         self.schemeHandlers = dict()
+        self.checksumProbes = dict()
+        # When it is not positive, failures are not remembered
+        self.failedTTL = failedTTL
+        # Schemes whose query parameters order is not relevant
+        self.sortQuerySchemes = list(map(lambda scheme: scheme.lower(), sortQuerySchemes))
+        # The metadata indexes, one per hash directory
+        self._indexes = dict()
+        self._indexesLock = threading.Lock()
+        # fcntl locks are per process, so threads are serialized apart.
+        # Each lock is kept along with the number of threads using it,
+        # so it is dropped once the last one releases it
+        self._uriThreadLocks = dict()
+        self._uriThreadLocksGuard = threading.Lock()
         
         self.addSchemeHandlers(schemeHandlers)
     
@@ -52,8 +159,16 @@ class SchemeHandlerCacheHandler:
         if isinstance(schemeHandlers, dict):
             self.schemeHandlers.update(schemeHandlers)
     
+    def addChecksumProbes(self, checksumProbes:Mapping[str, ChecksumProbe]) -> None:
+        """
+        Probes of the checksums known by the servers, so contents
+        already cached from other URIs are not fetched again
+        """
+        if isinstance(checksumProbes, dict):
+            self.checksumProbes.update(checksumProbes)
+    
     def _genUriMetaCachedFilename(self, hashDir:AbsPath, the_remote_file:Union[urllib.parse.ParseResult, URIType]) -> Tuple[AbsPath, AbsPath]:
-        input_file = hashlib.sha1(the_remote_file.encode('utf-8')).hexdigest()
+        input_file = hashlib.sha1(canonicalizeURI(the_remote_file, self.sortQuerySchemes).encode('utf-8')).hexdigest()
         metadata_input_file = input_file + META_JSON_POSTFIX
         
         return os.path.join(hashDir, metadata_input_file), input_file, os.path.join(hashDir, input_file)
@@ -63,13 +178,316 @@ class SchemeHandlerCacheHandler:
         hashDir = os.path.join(destdir,'uri_hashes')
         if not os.path.exists(hashDir):
             try:
-                os.makedirs(hashDir)
+                os.makedirs(hashDir, exist_ok=True)
             except IOError:
                 errstr = "ERROR: Unable to create directory for workflow URI hashes {}.".format(hashDir)
                 raise WFException(errstr)
         
         return hashDir
     
+    @contextlib.contextmanager
+    def _lockURI(self, hashDir:AbsPath, uriHash:str, wait:bool=True) -> Iterator[bool]:
+        """
+        Exclusive lock over a URI entry, shared among the threads of this
+        process and the processes using the same cache (also through NFS,
+        as fcntl locks are used over a lock file). It yields whether the
+        lock was acquired, which is always the case when wait is true
+        """
+        lockFilename = os.path.join(hashDir, uriHash + LOCK_POSTFIX)
+        with self._uriThreadLocksGuard:
+            lockUsage = self._uriThreadLocks.get(lockFilename)
+            if lockUsage is None:
+                lockUsage = [threading.Lock(), 0]
+                self._uriThreadLocks[lockFilename] = lockUsage
+            lockUsage[1] += 1
+        threadLock = lockUsage[0]
+        
+        try:
+            if not threadLock.acquire(blocking=wait):
+                yield False
+                return
+            
+            try:
+                with open(lockFilename, mode="a+b") as lH:
+                    try:
+                        fcntl.lockf(lH, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError as oe:
+                        if oe.errno not in (errno.EACCES, errno.EAGAIN):
+                            raise WFException(f"Unable to lock {lockFilename}: {oe}")
+                        if not wait:
+                            yield False
+                            return
+                        
+                        self.logger.info(f"Waiting for a concurrent fetch which is holding {lockFilename}")
+                        fcntl.lockf(lH, fcntl.LOCK_EX)
+                    
+                    try:
+                        yield True
+                    finally:
+                        fcntl.lockf(lH, fcntl.LOCK_UN)
+            finally:
+                threadLock.release()
+        finally:
+            self._releaseURIThreadLock(lockFilename, lockUsage)
+    
+    def _releaseURIThreadLock(self, lockFilename:AbsPath, lockUsage:List[Any]) -> None:
+        with self._uriThreadLocksGuard:
+            lockUsage[1] -= 1
+            if lockUsage[1] == 0:
+                del self._uriThreadLocks[lockFilename]
+    
+    @staticmethod
+    def _isStalePartial(partialPath:AbsPath) -> bool:
+        """
+        Partial downloads are kept to be resumed, unless
+        they (or their resume state) are too old
+        """
+        lastChange = max(map(lambda path: os.stat(path, follow_symlinks=False).st_mtime  if os.path.lexists(path)  else  0, (partialPath, partialPath + RESUME_STATE_POSTFIX, partialPath + RESUME_STATE_DIR_POSTFIX)))
+        return time.time() - lastChange >= PARTIAL_MAX_AGE
+    
+    def _removeOrphans(self, destdir:AbsPath, hashDir:AbsPath, uriHash:Optional[str]=None) -> int:
+        """
+        Removal of the temporary files left by crashed fetches and
+        metadata writes. When uriHash is provided, only the ones
+        from that URI are looked up, and its lock must be held
+        by the caller
+        """
+        if uriHash is not None:
+            return self._removeURIOrphans(destdir, hashDir, uriHash)
+        
+        numRemoved = 0
+        for theDir in (destdir, hashDir):
+            with os.scandir(theDir) as dH:
+                for entry in dH:
+                    orphanMatch = ORPHAN_PATTERN.search(entry.name)
+                    if orphanMatch is not None:
+                        orphanHash = orphanMatch.group(1)  if orphanMatch.group(1) is not None  else  orphanMatch.group(2)
+                        if entry.name.startswith(CACHING_PREFIX + orphanHash + PARTIAL_POSTFIX):
+                            if not self._isStalePartial(os.path.join(theDir, CACHING_PREFIX + orphanHash + PARTIAL_POSTFIX)):
+                                continue
+                        
+                        if os.path.exists(os.path.join(hashDir, orphanHash + LOCK_POSTFIX)):
+                            # Temporary files are created once the lock is held,
+                            # so no lock file means no fetch in progress
+                            with self._lockURI(hashDir, orphanHash, wait=False) as locked:
+                                # A fetch is in progress
+                                if not locked:
+                                    continue
+                    elif (theDir == destdir) and entry.name.startswith(CACHING_PREFIX):
+                        # From previous versions, only by age
+                        if time.time() - entry.stat(follow_symlinks=False).st_mtime < LEGACY_ORPHAN_MIN_AGE:
+                            continue
+                    else:
+                        continue
+                    
+                    self.logger.info(f"Removing orphaned temporary cache path {entry.path}")
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        try:
+                            os.unlink(entry.path)
+                        except FileNotFoundError:
+                            pass
+                    numRemoved += 1
+        
+        return numRemoved
+    
+    def _removeURIOrphans(self, destdir:AbsPath, hashDir:AbsPath, uriHash:str) -> int:
+        """
+        Only the known names of the temporary files of the URI are
+        looked up. Leftovers with other names (from previous versions)
+        are removed by the whole cache scans of gc
+        """
+        orphanPaths = [
+            os.path.join(destdir, CACHING_PREFIX + uriHash + FETCHING_POSTFIX),
+            os.path.join(hashDir, uriHash + LOCKED_TEMP_POSTFIX),
+            os.path.join(hashDir, uriHash + META_JSON_POSTFIX + LOCKED_TEMP_POSTFIX),
+        ]
+        partialPath = os.path.join(destdir, CACHING_PREFIX + uriHash + PARTIAL_POSTFIX)
+        if self._isStalePartial(partialPath):
+            orphanPaths.extend((partialPath, partialPath + RESUME_STATE_POSTFIX, partialPath + RESUME_STATE_DIR_POSTFIX))
+        
+        numRemoved = 0
+        for orphanPath in orphanPaths:
+            if os.path.lexists(orphanPath):
+                self.logger.info(f"Removing orphaned temporary cache path {orphanPath}")
+                self._removeContent(orphanPath)
+                numRemoved += 1
+        
+        return numRemoved
+    
+    def _getIndex(self, hashDir:AbsPath) -> CacheMetadataIndex:
+        """
+        The metadata index of a hash directory is opened on first use,
+        and it is rebuilt from the metadata files when it does not exist
+        """
+        with self._indexesLock:
+            index = self._indexes.get(hashDir)
+            if index is None:
+                index = CacheMetadataIndex(hashDir)
+                if index.isNew:
+                    numMigrated = self._migrateURIHashes(hashDir, index)
+                    if numMigrated > 0:
+                        self.logger.info(f'Migrated {numMigrated} cache entries at {hashDir} to canonical URI hashes')
+                    numEntries = index.rebuild(self._scanMetaStructures(hashDir))
+                    if numEntries > 0:
+                        self.logger.info(f'Rebuilt cache index at {hashDir} ({numEntries} entries)')
+                self._indexes[hashDir] = index
+        
+        return index
+    
+    def _migrateURIHashes(self, hashDir:AbsPath, index:CacheMetadataIndex) -> int:
+        """
+        Entries keyed by the hash of a non canonical URI are moved to the
+        canonical one. When there is already an entry there, they are folded
+        into it as aliases, and their contents are removed when nothing else
+        uses them. The index must not be used here, as it is being built
+        """
+        entries = list(self._scanMetaStructures(hashDir))
+        contentUsers = dict()
+        for uriHash, metaStructure, _ , _ in entries:
+            if metaStructure.get('kind') is not None:
+                content_path = metaStructure.get('path', {}).get('relative')
+                if content_path is not None:
+                    contentUsers.setdefault(content_path, set()).add(uriHash)
+        
+        realDestdir = os.path.realpath(os.path.dirname(hashDir))
+        numMigrated = 0
+        # The most recent duplicates are the ones kept
+        entries.sort(key=lambda entry: entry[1].get('stamp', ''), reverse=True)
+        for uriHash, metaStructure, _ , _ in entries:
+            # Which one was the hashed URI?
+            keyedURI = metaStructure.get('uri')
+            if keyedURI is None:
+                for meta in metaStructure.get('metadata_array', []):
+                    if hashlib.sha1(meta['uri'].encode('utf-8')).hexdigest() == uriHash:
+                        keyedURI = meta['uri']
+                        break
+                else:
+                    continue
+            
+            uriMetaCachedFilename , canonicalHash , absUriCachedFilename = self._genUriMetaCachedFilename(hashDir, keyedURI)
+            if canonicalHash == uriHash:
+                continue
+            
+            oldMetaCachedFilename = os.path.join(hashDir, uriHash + META_JSON_POSTFIX)
+            oldUriCachedFilename = os.path.join(hashDir, uriHash)
+            firstHash , secondHash = sorted((uriHash, canonicalHash))
+            with self._lockURI(hashDir, firstHash), self._lockURI(hashDir, secondHash):
+                # Was it migrated by a concurrent process?
+                if not os.path.exists(oldMetaCachedFilename):
+                    continue
+                
+                if not os.path.exists(uriMetaCachedFilename):
+                    os.replace(oldMetaCachedFilename, uriMetaCachedFilename)
+                    if os.path.lexists(oldUriCachedFilename):
+                        os.replace(oldUriCachedFilename, absUriCachedFilename)
+                    for users in contentUsers.values():
+                        if uriHash in users:
+                            users.discard(uriHash)
+                            users.add(canonicalHash)
+                    numMigrated += 1
+                    continue
+                
+                try:
+                    canonicalMetaStructure = self._parseMetaStructure(uriMetaCachedFilename)
+                except:
+                    self.logger.warning(f'Metadata cache {uriMetaCachedFilename} is corrupted. Not folding {oldMetaCachedFilename} into it.')
+                    continue
+                
+                # Folding the duplicate entry
+                aliases = canonicalMetaStructure.setdefault('aliases', [])
+                knownURIs = set(map(lambda meta: meta['uri'], canonicalMetaStructure.get('metadata_array', [])))
+                knownURIs.update(aliases)
+                for meta in metaStructure.get('metadata_array', []):
+                    if meta['uri'] not in knownURIs:
+                        aliases.append(meta['uri'])
+                        knownURIs.add(meta['uri'])
+                canonicalMetaStructure['path'].pop('meta', None)
+                self._dumpMetaStructure(uriMetaCachedFilename, canonicalMetaStructure)
+                
+                os.unlink(oldMetaCachedFilename)
+                if os.path.lexists(oldUriCachedFilename):
+                    os.unlink(oldUriCachedFilename)
+                numMigrated += 1
+                
+                # Is its content still used?
+                content_path = metaStructure.get('path', {}).get('relative')
+                if (metaStructure.get('kind') is None) or (content_path is None):
+                    continue
+                users = contentUsers[content_path]
+                users.discard(uriHash)
+                if (len(users) > 0) or (content_path == canonicalMetaStructure['path'].get('relative')):
+                    continue
+                if any(map(lambda meta: bool(meta.get('metadata', {}).get('injected')), metaStructure.get('metadata_array', []))):
+                    continue
+                absContentPath = os.path.normpath(os.path.join(hashDir, content_path))
+                if not os.path.realpath(absContentPath).startswith(realDestdir + os.path.sep):
+                    continue
+                if any(map(os.path.exists, index.getReferrers(content_path))):
+                    continue
+                
+                self.logger.info(f"Removing cache physical path {absContentPath} from {keyedURI}, folded into {canonicalHash}")
+                self._removeContent(absContentPath)
+                index.removeReference(content_path)
+        
+        return numMigrated
+    
+    def _scanMetaStructures(self, hashDir:AbsPath) -> Iterator[Tuple[str, Mapping[str, Any], Optional[int], int]]:
+        with os.scandir(hashDir) as hD:
+            for entry in hD:
+                # We are avoiding to enter in loops around '.' and '..'
+                if entry.is_file(follow_symlinks=False) and entry.name.endswith(META_JSON_POSTFIX):
+                    try:
+                        metaStructure = self._parseMetaStructure(entry.path)
+                    except:
+                        self.logger.warning(f'Metadata cache {entry.path} is corrupted. Not indexing it.')
+                        continue
+                    
+                    yield entry.name[0:-len(META_JSON_POSTFIX)], metaStructure, self._getContentSizeFromMeta(metaStructure), entry.stat(follow_symlinks=False).st_mtime_ns
+    
+    @staticmethod
+    def _computeContentSize(theContent:AbsPath) -> int:
+        if os.path.isdir(theContent):
+            return sum(map(lambda e: e.stat().st_size, filter(lambda e: e.is_file(), scantree(theContent))))
+        
+        return os.path.getsize(theContent)
+    
+    def _getContentSizeFromMeta(self, metaStructure:Mapping[str, Any]) -> Optional[int]:
+        absFinalCachedFilename = metaStructure.get('path', {}).get('absolute')
+        if (absFinalCachedFilename is not None) and os.path.exists(absFinalCachedFilename):
+            return self._computeContentSize(absFinalCachedFilename)
+        
+        return None
+    
+    def _getMetaStructure(self, hashDir:AbsPath, uriHash:str, uriMetaCachedFilename:AbsPath) -> Optional[Mapping[str, Any]]:
+        """
+        Indexed lookup of a metadata entry, which only falls back
+        to parse the metadata file when the index is stale
+        """
+        index = self._getIndex(hashDir)
+        try:
+            metaStat = os.stat(uriMetaCachedFilename)
+        except FileNotFoundError:
+            index.remove(uriHash)
+            return None
+        
+        if metaStat.st_size == 0:
+            return None
+        
+        metaStructure = index.get(uriHash, mtime_ns=metaStat.st_mtime_ns)
+        if metaStructure is None:
+            try:
+                metaStructure = self._parseMetaStructure(uriMetaCachedFilename)
+            except:
+                # Metadata is corrupted
+                self.logger.warning(f'Metadata cache {uriMetaCachedFilename} is corrupted. Ignoring.')
+                return None
+            
+            index.upsert(uriHash, metaStructure, size=self._getContentSizeFromMeta(metaStructure), mtime_ns=metaStat.st_mtime_ns)
+        
+        return metaStructure
+    
     @staticmethod
     def _parseMetaStructure(fMeta: AbsPath) -> Mapping[str, Any]:
         with open(fMeta, mode="r", encoding="utf-8") as eH:
@@ -98,47 +516,69 @@ class SchemeHandlerCacheHandler:
         
         return metaStructure
     
-    @staticmethod
-    def _translateArgs(args:Iterator[str]) -> List[Pattern]:
-        return list(map(lambda e: re.compile(fnmatch.translate(e)), args))
-        
-    
     def list(self, destdir:AbsPath, *args, acceptGlob:bool=False) -> Iterator[Tuple[URIType, Mapping[str,Any]]]:
         """
         This method iterates over the list of metadata entries,
+        using glob patterns if requested. The metadata index
+        is used, so no metadata file is opened
+        """
+        hashDir = self.getHashDir(destdir)
+        index = self._getIndex(hashDir)
+        for uriHash, meta_uri, metaStructure in index.query(*args, acceptGlob=acceptGlob):
+            # The path to the metadata file is relative to the current location
+            metaFile = os.path.join(hashDir, uriHash + META_JSON_POSTFIX)
+            metaStructure.setdefault('path', dict())['meta'] = {
+                'relative': os.path.basename(metaFile),
+                'absolute': metaFile
+            }
+            yield meta_uri, metaStructure
+    
+    def listFailed(self, destdir:AbsPath, *args, acceptGlob:bool=False) -> Iterator[Tuple[URIType, Mapping[str,Any]]]:
+        """
+        This method iterates over the recorded failed resolutions,
         using glob patterns if requested
         """
-        entries = set(args)
-        if entries and acceptGlob:
-            reEntries = self._translateArgs(entries)
-        else:
-            reEntries = None
-        
         hashDir = self.getHashDir(destdir)
-        with os.scandir(hashDir) as hD:
-            for entry in hD:
-                # We are avoiding to enter in loops around '.' and '..'
-                if entry.is_file(follow_symlinks=False) and entry.name.endswith(META_JSON_POSTFIX):
-                    try:
-                        metaStructure = self._parseMetaStructure(entry.path)
-                        meta_uri = None
-                        if not entries:
-                            for meta in metaStructure['metadata_array']:
-                                meta_uri = meta['uri']
-                                break
-                        else:
-                            for meta in metaStructure['metadata_array']:
-                                meta_uri = meta['uri']
-                                if reEntries and any(map(lambda r: r.match(meta_uri) is not None, reEntries)):
-                                    break
-                                elif meta_uri in entries:
-                                    break
-                                meta_uri = None
-                        
-                        if meta_uri is not None:
-                            yield meta_uri, metaStructure
-                    except:
-                        pass
+        now = time.time()
+        for uriHash, failure in self._getIndex(hashDir).queryFailures(*args, acceptGlob=acceptGlob):
+            failure['stamp'] = datetime.datetime.utcfromtimestamp(failure['failed_at']).isoformat() + 'Z'
+            failure['expired'] = now - failure['failed_at'] >= self.failedTTL
+            yield failure['uri'], failure
+    
+    def _recordFailure(self, hashDir:AbsPath, uriHash:str, the_remote_file:URIType, e:Exception, secContext:Optional[SecurityContextConfig]=None) -> None:
+        """
+        It remembers the definitive failures. The ones happening with
+        a security context are not, as they could depend on it
+        """
+        if (self.failedTTL <= 0) or (secContext is not None):
+            return
+        
+        # The original exception (for instance, an HTTPError) tells more
+        cause = e.__cause__  if e.__cause__ is not None  else  e
+        status = getattr(cause, 'code', None)
+        if not isinstance(status, int):
+            status = None
+        
+        if not (isinstance(e, ContentNotFoundException) or (status in DEFINITIVE_FAILURE_STATUSES)):
+            return
+        
+        self._getIndex(hashDir).setFailure(uriHash, the_remote_file, cause.__class__.__name__, message=str(e), status=status)
+    
+    def _checkFailure(self, hashDir:AbsPath, uriHash:str, the_remote_file:URIType, remote_file:Union[urllib.parse.ParseResult, URIType], secContext:Optional[SecurityContextConfig]=None) -> None:
+        """
+        It fails fast when the URI already failed to be resolved
+        within the last failedTTL seconds, unless it is now
+        fetched with a security context
+        """
+        if (self.failedTTL <= 0) or (secContext is not None):
+            return
+        
+        failure = self._getIndex(hashDir).getFailure(uriHash)
+        if failure is not None:
+            failedAgo = time.time() - failure['failed_at']
+            if failedAgo < self.failedTTL:
+                status = ''  if failure['status'] is None  else  f"status {failure['status']}, "
+                raise WFException(f"Not fetching {the_remote_file} (while processing {remote_file}), as it failed {int(failedAgo)} seconds ago ({status}{failure['exception']}: {failure['message']}). It will be retried in {int(self.failedTTL - failedAgo)} seconds")
     
     def remove(self, destdir:AbsPath, *args, doRemoveFiles:bool=False, acceptGlob:bool=False) -> Iterator[Tuple[URIType, AbsPath, Optional[AbsPath]]]:
         """
@@ -172,27 +612,137 @@ class SchemeHandlerCacheHandler:
                 
                 if removeCachedCopyPath is not None:
                     self.logger.info(f"Removing cache {metaStructure['fingerprint']} physical path {removeCachedCopyPath}")
-                    if os.path.isdir(removeCachedCopyPath):
-                        shutil.rmtree(removeCachedCopyPath, ignore_errors=True)
-                    else:
-                        os.unlink(removeCachedCopyPath)
+                    self._removeContent(removeCachedCopyPath)
+                    self._getIndex(hashDir).removeReference(os.path.relpath(removeCachedCopyPath, hashDir))
                 
                 metaFile = metaStructure['path']['meta']['absolute']
                 self.logger.info(f"Removing cache {metaStructure.get('fingerprint')} metadata {metaFile}")
-                os.unlink(metaFile)
+                if os.path.exists(metaFile):
+                    os.unlink(metaFile)
+                self._getIndex(hashDir).remove(metaStructure['path']['meta']['relative'][0:-len(META_JSON_POSTFIX)])
                 
                 yield meta_uri, metaFile, removeCachedCopyPath
     
-    def inject(self, destdir:AbsPath, the_remote_file:Union[urllib.parse.ParseResult, URIType], fetched_metadata_array:Optional[List[URIWithMetadata]]=None, finalCachedFilename:Optional[AbsPath]=None, tempCachedFilename:Optional[AbsPath]=None, inputKind:Optional[Union[ContentKind, AbsPath]]=None) -> Tuple[AbsPath, Fingerprint]:
-        return self._inject(
-            self.getHashDir(destdir),
-            the_remote_file,
-            fetched_metadata_array=fetched_metadata_array,
-            finalCachedFilename=finalCachedFilename,
-            tempCachedFilename=tempCachedFilename,
-            destdir=destdir,
-            inputKind=inputKind
-        )
+    def addReference(self, destdir:AbsPath, cachedFilename:AbsPath, referrer:AbsPath) -> None:
+        """
+        This method records that a cached content is being used from
+        a working directory, so it is not evicted while the working
+        directory exists
+        """
+        hashDir = self.getHashDir(destdir)
+        self._getIndex(hashDir).addReference(os.path.relpath(cachedFilename, hashDir), referrer)
+    
+    def gc(self, destdir:AbsPath, maxSize:Optional[int]=None, maxAge:Optional[float]=None, policy:CacheGCPolicy=DEFAULT_CACHE_GC_POLICY, dryRun:bool=False) -> Iterator[Tuple[AbsPath, int, List[URIType]]]:
+        """
+        This method evicts cached contents older than maxAge (in seconds)
+        and, following either LRU or LFU policy, the ones needed to fit the
+        cache in maxSize bytes. Injected contents not owned by the cache,
+        contents outside the cache directory and contents referenced by
+        existing working directories are never evicted. Contents registered
+        by reference are evicted as soon as the referenced path is gone,
+        removing only their symlinks. It yields the evicted paths, with their sizes and URIs
+        """
+        hashDir = self.getHashDir(destdir)
+        index = self._getIndex(hashDir)
+        absDestdir = os.path.abspath(destdir)
+        realDestdir = os.path.realpath(destdir)
+        
+        if not dryRun:
+            self._removeOrphans(destdir, hashDir)
+        
+        totalSize = 0
+        candidates = []
+        for content_path, size, last_access, hits, injected in index.contentUsage():
+            if injected:
+                continue
+            
+            absContentPath = os.path.normpath(os.path.join(hashDir, content_path))
+            # Contents registered by reference are symlinks in the cache
+            # pointing outside it, so their targets are not followed
+            isReference = os.path.islink(absContentPath) and os.path.abspath(absContentPath).startswith(absDestdir + os.path.sep)
+            # Contents outside the cache are not under its control
+            if not isReference and not os.path.realpath(absContentPath).startswith(realDestdir + os.path.sep):
+                continue
+            isDangling = isReference and not os.path.exists(absContentPath)
+            
+            totalSize += size
+            
+            # Is it still needed by any working directory?
+            isReferenced = False
+            for referrer in index.getReferrers(content_path):
+                if os.path.exists(referrer):
+                    isReferenced = True
+                    break
+                
+                if not dryRun:
+                    index.removeReference(content_path, referrer)
+            
+            if isDangling or not isReferenced:
+                candidates.append((content_path, absContentPath, size, last_access, hits, isDangling))
+        
+        # Dangling references go first, as they are always evicted
+        if policy == CacheGCPolicy.LFU:
+            candidates.sort(key=lambda c: (not c[5], c[4], c[3]))
+        else:
+            candidates.sort(key=lambda c: (not c[5], c[3]))
+        
+        oldestAccess = None  if maxAge is None  else  time.time() - maxAge
+        for content_path, absContentPath, size, last_access, hits, isDangling in candidates:
+            isAged = (oldestAccess is not None) and (last_access < oldestAccess)
+            if not isDangling and not isAged and ((maxSize is None) or (totalSize <= maxSize)):
+                if policy == CacheGCPolicy.LRU:
+                    # Next ones are newer
+                    break
+                continue
+            
+            evictedURIs = []
+            for uriHash, uri in index.entriesByContent(content_path):
+                evictedURIs.append(uri)
+                if not dryRun:
+                    with self._lockURI(hashDir, uriHash):
+                        for hashPath in (os.path.join(hashDir, uriHash + META_JSON_POSTFIX), os.path.join(hashDir, uriHash)):
+                            if os.path.lexists(hashPath):
+                                os.unlink(hashPath)
+                        index.remove(uriHash)
+            
+            if not dryRun:
+                self.logger.info(f"Evicting cache physical path {absContentPath} ({size} bytes)")
+                self._removeContent(absContentPath)
+                index.removeReference(content_path)
+            
+            totalSize -= size
+            yield absContentPath, size, evictedURIs
+        
+        if (maxSize is not None) and (totalSize > maxSize):
+            self.logger.warning(f"Cache at {destdir} still uses {totalSize} bytes (budget {maxSize} bytes), due contents referenced by working directories")
+    
+    def inject(self, destdir:AbsPath, the_remote_file:Union[urllib.parse.ParseResult, URIType], fetched_metadata_array:Optional[List[URIWithMetadata]]=None, finalCachedFilename:Optional[AbsPath]=None, tempCachedFilename:Optional[AbsPath]=None, inputKind:Optional[Union[ContentKind, AbsPath]]=None, owned:bool=False) -> Tuple[AbsPath, Fingerprint]:
+        """
+        Injected contents are never evicted by gc, unless they are
+        owned by the cache (like the workflow checkouts)
+        """
+        if isinstance(the_remote_file, urllib.parse.ParseResult):
+            the_remote_file = urllib.parse.urlunparse(the_remote_file)
+        
+        if owned:
+            if fetched_metadata_array is None:
+                fetched_metadata_array = [ URIWithMetadata(uri=the_remote_file, metadata={}) ]
+        elif (fetched_metadata_array is not None) and (len(fetched_metadata_array) > 0):
+            lastMetadata = fetched_metadata_array[-1]
+            fetched_metadata_array = fetched_metadata_array[:-1] + [ lastMetadata._replace(metadata=dict(lastMetadata.metadata, injected=True)) ]
+        
+        hashDir = self.getHashDir(destdir)
+        _ , uriHash , _ = self._genUriMetaCachedFilename(hashDir, the_remote_file)
+        with self._lockURI(hashDir, uriHash):
+            return self._inject(
+                hashDir,
+                the_remote_file,
+                fetched_metadata_array=fetched_metadata_array,
+                finalCachedFilename=finalCachedFilename,
+                tempCachedFilename=tempCachedFilename,
+                destdir=destdir,
+                inputKind=inputKind
+            )
     
     def _inject(self, hashDir:AbsPath, the_remote_file:Union[urllib.parse.ParseResult, URIType], fetched_metadata_array:Optional[List[URIWithMetadata]]=None, finalCachedFilename:Optional[AbsPath]=None, tempCachedFilename:Optional[AbsPath]=None, destdir:Optional[AbsPath]=None, inputKind:Optional[Union[ContentKind, AbsPath]]=None) -> Tuple[AbsPath, Fingerprint]:
         """
@@ -201,7 +751,7 @@ class SchemeHandlerCacheHandler:
         if isinstance(the_remote_file, urllib.parse.ParseResult):
             the_remote_file = urllib.parse.urlunparse(the_remote_file)
         
-        uriMetaCachedFilename , _ , _ = self._genUriMetaCachedFilename(hashDir, the_remote_file)
+        uriMetaCachedFilename , uriHash , _ = self._genUriMetaCachedFilename(hashDir, the_remote_file)
 
         if tempCachedFilename is None:
             tempCachedFilename = finalCachedFilename
@@ -218,60 +768,487 @@ class SchemeHandlerCacheHandler:
                 raise WFException(f"Local path {tempCachedFilename} is neither a file nor a directory")
         
         fingerprint = None
+        contentSize = None
+        reference = None
         # Are we dealing with a redirection?
         if isinstance(inputKind, ContentKind):
+            # Cache identity uses the internal digest algorithm, which can
+            # be a faster one. Provenance digests are computed when needed
+            internalDigestAlgorithm = getInternalDigestAlgorithm()
             if os.path.isfile(tempCachedFilename): # inputKind == ContentKind.File:
-                fingerprint = ComputeDigestFromFile(tempCachedFilename, repMethod=stringifyFilenameDigest)
+                fingerprint = ComputeDigestFromFile(tempCachedFilename, digestAlgorithm=internalDigestAlgorithm, repMethod=stringifyFilenameDigest)
                 putativeInputKind = ContentKind.File
             elif os.path.isdir(tempCachedFilename): # inputKind == ContentKind.Directory:
-                fingerprint = ComputeDigestFromDirectory(tempCachedFilename, repMethod=stringifyFilenameDigest)
+                fingerprint = ComputeDigestFromDirectory(tempCachedFilename, digestAlgorithm=internalDigestAlgorithm, repMethod=stringifyFilenameDigest, fileDigestAlgorithm=internalDigestAlgorithm)
                 putativeInputKind = ContentKind.Directory
             else:
                 raise WFException(f"FIXME: Cached {tempCachedFilename} from {the_remote_file} is neither file nor directory")
+            # Contents registered by reference do not use cache space
+            reference = fetched_metadata_array[-1].metadata.get('reference')  if fetched_metadata_array  else  None
+            contentSize = 0  if reference is not None  else  self._computeContentSize(tempCachedFilename)
             
             if inputKind != putativeInputKind:
                 self.logger.error(f"FIXME: Mismatch at {the_remote_file} : {inputKind} vs {putativeInputKind}")
             
             if finalCachedFilename is None:
-                finalCachedFilename = os.path.join(destdir, fingerprint)
+                if reference is not None:
+                    # Each reference has its own symlink, as they
+                    # are validated against their own paths
+                    finalCachedFilename = os.path.join(destdir, fingerprint + '_' + hashlib.sha1(reference['path'].encode('utf-8')).hexdigest())
+                else:
+                    finalCachedFilename = os.path.join(destdir, fingerprint)
         else:
             finalCachedFilename = None
         
-        # Saving the metadata
-        with open(uriMetaCachedFilename, mode="w", encoding="utf-8") as mOut:
-            # Serializing the metadata
-            if fetched_metadata_array is None:
-                fetched_metadata_array = [
-                    URIWithMetadata(
-                        uri=the_remote_file,
-                        metadata={
-                            'injected': True
-                        }
-                    )
-                ]
-            metaStructure = {
-                'stamp': datetime.datetime.utcnow().isoformat() + 'Z',
-                'metadata_array': list(map(lambda m: {'uri': m.uri, 'metadata': m.metadata, 'preferredName': m.preferredName}, fetched_metadata_array))
+        # Serializing the metadata
+        if fetched_metadata_array is None:
+            fetched_metadata_array = [
+                URIWithMetadata(
+                    uri=the_remote_file,
+                    metadata={
+                        'injected': True
+                    }
+                )
+            ]
+        metaStructure = {
+            'stamp': datetime.datetime.utcnow().isoformat() + 'Z',
+            'uri': the_remote_file,
+            'metadata_array': list(map(lambda m: {'uri': m.uri, 'metadata': m.metadata, 'preferredName': m.preferredName}, fetched_metadata_array))
+        }
+        if finalCachedFilename is not None:
+            metaStructure['kind'] = str(inputKind.value)
+            metaStructure['fingerprint'] = fingerprint
+            # Checksums told (and verified) by the fetcher,
+            # so the entry can be found from other URIs
+            fetchedChecksums = fetched_metadata_array[-1].metadata.get('checksums', [])  if len(fetched_metadata_array) > 0  else  []
+            if len(fetchedChecksums) > 0:
+                metaStructure['checksums'] = list(fetchedChecksums)
+            if reference is not None:
+                metaStructure['reference'] = reference
+            metaStructure['path'] = {
+                'relative': os.path.relpath(finalCachedFilename, hashDir),
+                'absolute': finalCachedFilename
             }
+        else:
+            metaStructure['resolves_to'] = inputKind
+        
+        self._writeMetaStructure(hashDir, uriHash, uriMetaCachedFilename, metaStructure, the_remote_file, contentSize)
+        
+        return finalCachedFilename, fingerprint
+    
+    @staticmethod
+    def _dumpMetaStructure(uriMetaCachedFilename:AbsPath, metaStructure:Mapping[str, Any]) -> None:
+        # Saving the metadata. It is atomically replaced, so
+        # concurrent readers never get a partially written file
+        tempMetaCachedFilename = uriMetaCachedFilename + LOCKED_TEMP_POSTFIX
+        try:
+            with open(tempMetaCachedFilename, mode="w", encoding="utf-8") as mOut:
+                json.dump(metaStructure, mOut)
+            os.replace(tempMetaCachedFilename, uriMetaCachedFilename)
+        finally:
+            if os.path.exists(tempMetaCachedFilename):
+                os.unlink(tempMetaCachedFilename)
+    
+    def _writeMetaStructure(self, hashDir:AbsPath, uriHash:str, uriMetaCachedFilename:AbsPath, metaStructure:Mapping[str, Any], the_remote_file:URIType, contentSize:Optional[int]) -> None:
+        self._dumpMetaStructure(uriMetaCachedFilename, metaStructure)
+        
+        # And keeping the index in sync
+        metaStructure['path'] = metaStructure.get('path', dict())
+        metaStructure['path']['meta'] = {
+            'relative': os.path.basename(uriMetaCachedFilename),
+            'absolute': uriMetaCachedFilename
+        }
+        self._getIndex(hashDir).upsert(
+            uriHash,
+            metaStructure,
+            uri=the_remote_file,
+            size=contentSize,
+            mtime_ns=os.stat(uriMetaCachedFilename).st_mtime_ns
+        )
+    
+    @staticmethod
+    def _getConditionalHeaders(fetched_metadata_array:List[URIWithMetadata]) -> Mapping[str, str]:
+        """
+        Conditional request headers derived from the
+        validators stored along the cached content
+        """
+        for fetched_metadata in fetched_metadata_array:
+            headers = dict(map(lambda h: (h[0].lower(), h[1]), fetched_metadata.metadata.items()))
+            conditionalHeaders = dict()
+            if headers.get('etag') is not None:
+                conditionalHeaders['If-None-Match'] = headers['etag']
+            if headers.get('last-modified') is not None:
+                conditionalHeaders['If-Modified-Since'] = headers['last-modified']
+            
+            if len(conditionalHeaders) > 0:
+                return conditionalHeaders
+        
+        return dict()
+    
+    def _revalidateEntry(self, destdir:AbsPath, hashDir:AbsPath, remote_file:URIType, the_remote_file:URIType, parsedInputURL:urllib.parse.ParseResult, uriCachedFilename:str, uriMetaCachedFilename:AbsPath, absUriCachedFilename:AbsPath, cachedEntry:Tuple[ContentKind, AbsPath, List[URIWithMetadata]], secContext:Optional[SecurityContextConfig]) -> Tuple[ContentKind, AbsPath, List[URIWithMetadata]]:
+        """
+        Conditional request over a cached content. When it was not modified
+        only the stamp of the entry is refreshed. Otherwise, it is fetched
+        again. The URI lock must be held by the caller
+        """
+        conditionalHeaders = self._getConditionalHeaders(cachedEntry[2])
+        if len(conditionalHeaders) == 0:
+            self.logger.debug(f'No validators for {the_remote_file}, so it cannot be revalidated')
+            return cachedEntry
+        
+        try:
+            newEntry = self._fetchEntry(destdir, hashDir, remote_file, the_remote_file, parsedInputURL, uriCachedFilename, absUriCachedFilename, False, secContext, conditionalHeaders=conditionalHeaders)
+        except ContentNotModifiedException:
+            self.logger.info(f'Cached content from {the_remote_file} is still valid')
+            metaStructure = self._getMetaStructure(hashDir, uriCachedFilename, uriMetaCachedFilename)
+            if metaStructure is not None:
+                metaStructure['stamp'] = datetime.datetime.utcnow().isoformat() + 'Z'
+                metaStructure.get('path', {}).pop('meta', None)
+                self._writeMetaStructure(hashDir, uriCachedFilename, uriMetaCachedFilename, metaStructure, the_remote_file, self._getContentSizeFromMeta(metaStructure))
+            return cachedEntry
+        except WFException as wfe:
+            self.logger.warning(f'Unable to revalidate {the_remote_file}, so the cached content is used ({wfe})')
+            return cachedEntry
+        
+        # The previous content is dropped, unless it is still in use
+        oldCachedFilename = cachedEntry[1]
+        if newEntry[1] != oldCachedFilename:
+            self.logger.info(f'Content from {the_remote_file} has changed')
+            index = self._getIndex(hashDir)
+            oldRelCachedFilename = os.path.relpath(oldCachedFilename, hashDir)
+            if (len(index.entriesByContent(oldRelCachedFilename)) == 0) and not any(map(os.path.exists, index.getReferrers(oldRelCachedFilename))):
+                self._removeContent(oldCachedFilename)
+                index.removeReference(oldRelCachedFilename)
+        
+        return newEntry
+    
+    def _getCachedEntry(self, hashDir:AbsPath, uriHash:str, uriMetaCachedFilename:AbsPath, absUriCachedFilename:AbsPath) -> Optional[Tuple[Union[ContentKind, URIType], Optional[AbsPath], List[URIWithMetadata]]]:
+        """
+        It returns the kind (or the URI it resolves to), the cached path and
+        the metadata of a valid cache entry, or None on a cache miss
+        """
+        metaStructure = self._getMetaStructure(hashDir, uriHash, uriMetaCachedFilename)
+        if metaStructure is None:
+            return None
+        
+        # Metadata cache hit
+        finalCachedFilename = None
+        inputKind = metaStructure.get('kind')
+        if inputKind is None:
+            inputKind = metaStructure['resolves_to']
+        else:
+            # Additional checks
+            inputKind = ContentKind(inputKind)
+            finalCachedFilename = self._getFinalCachedFilename(hashDir, metaStructure, absUriCachedFilename)
+            if finalCachedFilename is None:
+                return None
+        
+        # As the content still exists, get the metadata
+        self._getIndex(hashDir).touch(uriHash)
+        
+        fetched_metadata_array = list(map(lambda rm: URIWithMetadata(uri=rm['uri'], metadata=rm['metadata'], preferredName=rm.get('preferredName')), metaStructure['metadata_array']))
+        
+        return inputKind, finalCachedFilename, fetched_metadata_array
+    
+    def _getFinalCachedFilename(self, hashDir:AbsPath, metaStructure:Mapping[str, Any], absUriCachedFilename:AbsPath) -> Optional[AbsPath]:
+        """
+        The path to the content of an entry, or None when it does not exist
+        """
+        relFinalCachedFilename = metaStructure.get('path', {}).get('relative')
+        if relFinalCachedFilename is None:
+            relFinalCachedFilename = os.readlink(absUriCachedFilename)
+        finalCachedFilename = os.path.normpath(os.path.join(hashDir, relFinalCachedFilename))
+        
+        if not os.path.exists(finalCachedFilename):
+            self.logger.warning(f'Relative cache path {relFinalCachedFilename} was not found')
+            finalCachedFilename = metaStructure.get('path', {}).get('absolute')
+            
+            if (finalCachedFilename is None) or not os.path.exists(finalCachedFilename):
+                self.logger.warning(f'Absolute cache path {finalCachedFilename} was not found. Cache miss!!!')
+                return None
+        
+        # Contents registered by reference are only valid while unchanged
+        reference = metaStructure.get('reference')
+        if reference is not None:
+            try:
+                unchanged = getReferenceStats(reference['path']) == reference
+            except OSError:
+                unchanged = False
+            if not unchanged:
+                self.logger.info(f"Referenced contents at {reference['path']} have changed. Cache miss!!!")
+                return None
+        
+        return finalCachedFilename
+    
+    def _getChainedEntry(self, hashDir:AbsPath, headHash:str) -> Optional[Tuple[ContentKind, AbsPath, List[URIWithMetadata]]]:
+        """
+        Warm lookup of an already resolved chain of URIs, which
+        jumps directly to the entry holding the content
+        """
+        index = self._getIndex(hashDir)
+        chain = index.getChain(headHash)
+        if chain is None:
+            return None
+        
+        terminalHash, metaStructure, chain_metadata_array = chain
+        finalCachedFilename = self._getFinalCachedFilename(hashDir, metaStructure, os.path.join(hashDir, terminalHash))
+        if finalCachedFilename is None:
+            return None
+        
+        index.touch(terminalHash)
+        
+        metadata_array = list(map(lambda rm: URIWithMetadata(uri=rm['uri'], metadata=rm['metadata'], preferredName=rm.get('preferredName')), chain_metadata_array))
+        
+        return ContentKind(metaStructure['kind']), finalCachedFilename, metadata_array
+    
+    def _getChecksumEntry(self, hashDir:AbsPath, declaredChecksum:Tuple[str, bytes]) -> Optional[Tuple[ContentKind, AbsPath, List[URIWithMetadata]]]:
+        """
+        Content-addressed lookup, which returns a cached entry
+        (fetched from any URI) whose contents have the declared checksum
+        """
+        index = self._getIndex(hashDir)
+        for uriHash, metaStructure in index.findByFingerprint(stringifyFilenameDigest(*declaredChecksum)):
+            if metaStructure.get('kind') is None:
+                continue
+            
+            finalCachedFilename = self._getFinalCachedFilename(hashDir, metaStructure, os.path.join(hashDir, uriHash))
             if finalCachedFilename is not None:
-                metaStructure['kind'] = str(inputKind.value)
-                metaStructure['fingerprint'] = fingerprint
-                metaStructure['path'] = {
-                    'relative': os.path.relpath(finalCachedFilename, hashDir),
-                    'absolute': finalCachedFilename
-                }
+                index.touch(uriHash)
+                
+                metadata_array = list(map(lambda rm: URIWithMetadata(uri=rm['uri'], metadata=rm['metadata'], preferredName=rm.get('preferredName')), metaStructure['metadata_array']))
+                
+                return ContentKind(metaStructure['kind']), finalCachedFilename, metadata_array
+        
+        return None
+    
+    def _verifyChecksum(self, hashDir:AbsPath, remote_file:URIType, checksum:str, declaredChecksum:Tuple[str, bytes], uriHash:str, finalCachedFilename:AbsPath, registerInCache:bool) -> None:
+        """
+        It checks the fetched contents against the declared checksum. Verified
+        checksums are recorded in the entry holding the contents, so they can
+        be found later from other URIs. On mismatch, the entry is forgotten,
+        and also its contents, unless they are still in use
+        """
+        digestAlgorithm , digest = declaredChecksum
+        if os.path.isdir(finalCachedFilename):
+            computedDigest = ComputeDigestFromDirectory(finalCachedFilename, digestAlgorithm=digestAlgorithm, repMethod=nullProcessDigest, fileDigestAlgorithm=digestAlgorithm)
+        else:
+            computedDigest = ComputeDigestFromFile(finalCachedFilename, digestAlgorithm=digestAlgorithm, repMethod=nullProcessDigest)
+        
+        matches = computedDigest == digest
+        if registerInCache:
+            uriMetaCachedFilename = os.path.join(hashDir, uriHash + META_JSON_POSTFIX)
+            with self._lockURI(hashDir, uriHash):
+                if not matches:
+                    # So it is fetched again next time
+                    index = self._getIndex(hashDir)
+                    for hashPath in (uriMetaCachedFilename, os.path.join(hashDir, uriHash)):
+                        if os.path.lexists(hashPath):
+                            os.unlink(hashPath)
+                    index.remove(uriHash)
+                    
+                    # The fetched contents are dropped, unless they are still in
+                    # use. Contents outside the cache are not under its control
+                    relCachedFilename = os.path.relpath(finalCachedFilename, hashDir)
+                    if os.path.abspath(finalCachedFilename).startswith(os.path.dirname(os.path.abspath(hashDir)) + os.path.sep) and (len(index.entriesByContent(relCachedFilename)) == 0) and not any(map(os.path.exists, index.getReferrers(relCachedFilename))):
+                        self._removeContent(finalCachedFilename)
+                        index.removeReference(relCachedFilename)
+                else:
+                    fingerprint = stringifyFilenameDigest(digestAlgorithm, digest)
+                    metaStructure = self._getMetaStructure(hashDir, uriHash, uriMetaCachedFilename)
+                    if (metaStructure is not None) and (fingerprint not in metaStructure.get('checksums', [])):
+                        metaStructure.setdefault('checksums', []).append(fingerprint)
+                        metaStructure.get('path', {}).pop('meta', None)
+                        self._writeMetaStructure(hashDir, uriHash, uriMetaCachedFilename, metaStructure, metaStructure.get('uri', metaStructure['metadata_array'][0]['uri']), self._getContentSizeFromMeta(metaStructure))
+        
+        if not matches:
+            raise WFException(f"Contents from {remote_file} do not match declared checksum {checksum} (got {stringifyDigest(digestAlgorithm, computedDigest)})")
+    
+    def _fetchEntry(self, destdir:AbsPath, hashDir:AbsPath, remote_file:Union[urllib.parse.ParseResult, URIType], the_remote_file:URIType, parsedInputURL:urllib.parse.ParseResult, uriCachedFilename:str, absUriCachedFilename:AbsPath, offline:bool, secContext:Optional[SecurityContextConfig], conditionalHeaders:Optional[Mapping[str, str]]=None) -> Tuple[Union[ContentKind, URIType], Optional[AbsPath], List[URIWithMetadata]]:
+        """
+        Cache miss. The URI lock must be held by the caller. When conditional
+        headers are provided, ContentNotModifiedException can be raised
+        """
+        # As this is a handler for online resources, comply with offline mode
+        if offline:
+            raise WFException(f"Cannot download content in offline mode from {remote_file} to {uriCachedFilename}")
+        
+        # Content is fetched here
+        theScheme = parsedInputURL.scheme.lower()
+        schemeHandler = self.schemeHandlers.get(theScheme)
+        
+        if schemeHandler is None:
+            raise WFException(f'No {theScheme} scheme handler for {the_remote_file} (while processing {remote_file}). Was this data injected in the cache?')
+        
+        if conditionalHeaders is not None:
+            secContext = dict(secContext)  if isinstance(secContext, dict)  else  dict()
+            secContext['headers'] = dict(secContext.get('headers', {}), **conditionalHeaders)
+        else:
+            probedEntry = self._probeChecksumEntry(hashDir, the_remote_file, theScheme, absUriCachedFilename, secContext)
+            if probedEntry is not None:
+                return probedEntry
+        
+        # This filename will only be used when content is being fetched.
+        # The URI hash in its name tells which lock protects it. When
+        # the download can be resumed, it does not change among fetches
+        resumable = theScheme in RESUMABLE_SCHEMES
+        if resumable:
+            tempCachedFilename = os.path.join(destdir, CACHING_PREFIX + uriCachedFilename + PARTIAL_POSTFIX)
+            # Conditional requests start from scratch
+            if conditionalHeaders is not None:
+                self._removePartial(tempCachedFilename)
+        else:
+            tempCachedFilename = os.path.join(destdir, CACHING_PREFIX + uriCachedFilename + FETCHING_POSTFIX)
+        fetched = False
+        try:
+            # Content is fetched here
+            try:
+                inputKind, fetched_metadata_array = schemeHandler(the_remote_file, tempCachedFilename, secContext=secContext)
+            except ContentNotModifiedException:
+                raise
+            except Exception as fe:
+                # Remembering it, so it is not retried on next stagings,
+                # unless it was an interrupted download to be resumed
+                if not (resumable and os.path.lexists(tempCachedFilename)):
+                    self._recordFailure(hashDir, uriCachedFilename, the_remote_file, fe, secContext)
+                raise
+            self._getIndex(hashDir).removeFailure(uriCachedFilename)
+            
+            # The cache entry is injected
+            finalCachedFilename, fingerprint = self._inject(
+                hashDir,
+                the_remote_file,
+                fetched_metadata_array,
+                tempCachedFilename=tempCachedFilename,
+                destdir=destdir,
+                inputKind=inputKind
+            )
+            
+            # Now, creating the symlink
+            # (which should not be needed in the future)
+            if finalCachedFilename is not None:
+                if os.path.isdir(finalCachedFilename) and os.path.isdir(tempCachedFilename) and not os.path.islink(tempCachedFilename):
+                    # Same fingerprint, so same content, which could be
+                    # in use by a concurrent fetch of other URI
+                    shutil.rmtree(tempCachedFilename)
+                else:
+                    if os.path.isdir(finalCachedFilename) and not os.path.islink(finalCachedFilename):
+                        shutil.rmtree(finalCachedFilename)
+                    os.replace(tempCachedFilename, finalCachedFilename)
+                
+                next_input_file = os.path.relpath(finalCachedFilename, hashDir)
             else:
-                metaStructure['resolves_to'] = inputKind
+                _ , next_input_file , _ = self._genUriMetaCachedFilename(hashDir, inputKind)
             
-            json.dump(metaStructure, mOut)
+            tempUriCachedFilename = absUriCachedFilename + LOCKED_TEMP_POSTFIX
+            os.symlink(next_input_file, tempUriCachedFilename)
+            os.replace(tempUriCachedFilename, absUriCachedFilename)
+            fetched = True
+        except WFException as we:
+            raise we
+        except Exception as e:
+            raise WFException("Cannot download content from {} to {} (while processing {}) (temp file {}): {}".format(the_remote_file, uriCachedFilename, remote_file, tempCachedFilename, e))
+        finally:
+            # Failed fetches do not leave anything behind,
+            # but the downloads which can be resumed
+            if fetched or not resumable:
+                self._removePartial(tempCachedFilename)
         
-        return finalCachedFilename, fingerprint
+        return inputKind, finalCachedFilename, fetched_metadata_array
     
-    def fetch(self, remote_file:Union[urllib.parse.ParseResult, URIType], destdir:AbsPath, offline:bool, ignoreCache:bool=False, registerInCache:bool=True, secContext:Optional[SecurityContextConfig]=None) -> Tuple[ContentKind, AbsPath, List[URIWithMetadata]]:
+    def _probeChecksumEntry(self, hashDir:AbsPath, the_remote_file:URIType, theScheme:str, absUriCachedFilename:AbsPath, secContext:Optional[SecurityContextConfig]) -> Optional[Tuple[ContentKind, AbsPath, List[URIWithMetadata]]]:
+        """
+        When the server tells the checksums of the contents, and they
+        were already cached from other URI, the URI is bound to them
+        instead of fetching and digesting the contents again
+        """
+        checksumProbe = self.checksumProbes.get(theScheme)
+        if checksumProbe is None:
+            return None
+        
+        try:
+            checksums, contentSize = checksumProbe(the_remote_file, secContext)
+        except Exception as e:
+            self.logger.debug(f'Unable to probe the checksums of {the_remote_file}: {e}')
+            return None
+        
+        # The size has to match too. crc32c is too weak to tell the
+        # contents apart, so it is only used to check the transfers
+        if contentSize is None:
+            return None
+        checksums = list(filter(lambda checksum: checksum[0] != CRC32C_DIGEST_ALGORITHM, checksums))
+        
+        for checksum in checksums:
+            checksumEntry = self._getChecksumEntry(hashDir, checksum)
+            if checksumEntry is None:
+                continue
+            
+            inputKind, finalCachedFilename, _ = checksumEntry
+            if (inputKind != ContentKind.File) or (os.path.getsize(finalCachedFilename) != contentSize):
+                continue
+            self.logger.info(f'Contents from {the_remote_file} with checksum {stringifyDigest(*checksum)} were already cached, so they are not fetched')
+            fetched_metadata_array = self._bindChecksumEntry(hashDir, the_remote_file, absUriCachedFilename, checksums, inputKind, finalCachedFilename)
+            
+            return inputKind, finalCachedFilename, fetched_metadata_array
+        
+        return None
+    
+    def _bindChecksumEntry(self, hashDir:AbsPath, the_remote_file:URIType, absUriCachedFilename:AbsPath, checksums:Sequence[Tuple[str, bytes]], inputKind:ContentKind, finalCachedFilename:AbsPath) -> List[URIWithMetadata]:
+        """
+        It binds the URI to contents cached from other URI, which
+        have the given checksums. The URI lock must be held by the caller
+        """
+        fetched_metadata_array = [
+            URIWithMetadata(
+                uri=the_remote_file,
+                metadata={
+                    'checksums': list(map(lambda checksum: stringifyFilenameDigest(*checksum), checksums))
+                }
+            )
+        ]
+        self._inject(
+            hashDir,
+            the_remote_file,
+            fetched_metadata_array,
+            finalCachedFilename=finalCachedFilename,
+            inputKind=inputKind
+        )
+        
+        tempUriCachedFilename = absUriCachedFilename + LOCKED_TEMP_POSTFIX
+        os.symlink(os.path.relpath(finalCachedFilename, hashDir), tempUriCachedFilename)
+        os.replace(tempUriCachedFilename, absUriCachedFilename)
+        
+        return fetched_metadata_array
+    
+    @staticmethod
+    def _removePartial(tempCachedFilename:AbsPath) -> None:
+        if os.path.isdir(tempCachedFilename) and not os.path.islink(tempCachedFilename):
+            shutil.rmtree(tempCachedFilename, ignore_errors=True)
+        elif os.path.lexists(tempCachedFilename):
+            os.unlink(tempCachedFilename)
+        clearResumeState(tempCachedFilename)
+        clearResumeStates(tempCachedFilename)
+    
+    @staticmethod
+    def _removeContent(absContentPath:AbsPath) -> None:
+        # Contents registered by reference are symlinks,
+        # so the referenced files are not touched
+        if os.path.isdir(absContentPath) and not os.path.islink(absContentPath):
+            shutil.rmtree(absContentPath, ignore_errors=True)
+        elif os.path.lexists(absContentPath):
+            os.unlink(absContentPath)
+    
+    def fetch(self, remote_file:Union[urllib.parse.ParseResult, URIType], destdir:AbsPath, offline:bool, ignoreCache:bool=False, registerInCache:bool=True, secContext:Optional[SecurityContextConfig]=None, revalidate:bool=False, checksum:Optional[str]=None) -> Tuple[ContentKind, AbsPath, List[URIWithMetadata]]:
+        """
+        When revalidate is true (and not in offline mode), cached http(s)
+        contents are checked through conditional requests, so they are
+        only fetched again when they have changed. When a checksum is
+        declared, cached contents with it are used whichever URI they
+        came from, and fetched contents are verified against it
+        """
         # The directory with the content, whose name is based on sha256
         if not os.path.exists(destdir):
             try:
-                os.makedirs(destdir)
+                os.makedirs(destdir, exist_ok=True)
             except IOError:
                 errstr = "ERROR: Unable to create directory for workflow inputs {}.".format(destdir)
                 raise WFException(errstr)
@@ -280,11 +1257,47 @@ class SchemeHandlerCacheHandler:
         # to the content are placed
         hashDir = self.getHashDir(destdir)
         
-        # This filename will only be used when content is being fetched
-        tempCachedFilename = os.path.join(destdir, 'caching-' + str(uuid.uuid4()))
+        refetch = not registerInCache or ignoreCache
+        
+        # Chains of resolutions already walked are a single lookup
+        if isinstance(remote_file, urllib.parse.ParseResult):
+            remote_file = urllib.parse.urlunparse(remote_file)
+        headMetaCachedFilename , headHash , absHeadCachedFilename = self._genUriMetaCachedFilename(hashDir, remote_file)
+        revalidate = revalidate and not offline
+        
+        # Content-addressed lookup
+        declaredChecksum = None
+        if checksum is not None:
+            declaredChecksum = parseChecksum(checksum)
+            if not refetch and not revalidate:
+                checksumEntry = self._getChecksumEntry(hashDir, declaredChecksum)
+                if checksumEntry is not None:
+                    inputKind, finalCachedFilename, _ = checksumEntry
+                    # The URI could be already bound to these contents
+                    ownEntry = self._getChainedEntry(hashDir, headHash)
+                    if ownEntry is None:
+                        ownEntry = self._getCachedEntry(hashDir, headHash, headMetaCachedFilename, absHeadCachedFilename)
+                    if (ownEntry is not None) and isinstance(ownEntry[0], ContentKind) and (os.path.realpath(ownEntry[1]) == os.path.realpath(finalCachedFilename)):
+                        return ownEntry
+                    
+                    # Otherwise, the URI is bound to the found contents,
+                    # with its own metadata, so next lookups find it
+                    self.logger.info(f'Contents with checksum {checksum} were already cached, so {remote_file} is not fetched')
+                    with self._lockURI(hashDir, headHash):
+                        fetched_metadata_array = self._bindChecksumEntry(hashDir, remote_file, absHeadCachedFilename, [ declaredChecksum ], inputKind, finalCachedFilename)
+                    
+                    return inputKind, finalCachedFilename, fetched_metadata_array
+        
+        # Resolved chains are not taken when there is a checksum to verify
+        if not refetch and not revalidate and (declaredChecksum is None):
+            chainedEntry = self._getChainedEntry(hashDir, headHash)
+            if chainedEntry is not None:
+                return chainedEntry
+        
         # This is an iterative process, where the URI is resolved and peeled until a basic fetching protocol is reached
         inputKind = remote_file
         metadata_array = []
+        chainHashes = []
         while not isinstance(inputKind, ContentKind):
             the_remote_file = inputKind
             if isinstance(the_remote_file, urllib.parse.ParseResult):
@@ -295,107 +1308,60 @@ class SchemeHandlerCacheHandler:
             
             # uriCachedFilename is going to be always a symlink
             uriMetaCachedFilename , uriCachedFilename , absUriCachedFilename = self._genUriMetaCachedFilename(hashDir, the_remote_file)
+            chainHashes.append(uriCachedFilename)
             
-            # TODO: check cached state in future database
-            # Cleaning up
-            if registerInCache and ignoreCache:
-                # Removing the metadata
-                if os.path.exists(uriMetaCachedFilename):
-                    os.unlink(uriMetaCachedFilename)
-                
-                # Removing the symlink
-                if os.path.exists(absUriCachedFilename):
-                    os.unlink(absUriCachedFilename)
-                # We cannot remove the content as
-                # it could be referenced by other symlinks
-            
-            refetch = not registerInCache or ignoreCache or not os.path.exists(uriMetaCachedFilename) or os.stat(uriMetaCachedFilename).st_size == 0
-            
-            metaStructure = None
+            # Optimistic lookup, which does not need the lock
+            cachedEntry = None
             if not refetch:
-                try:
-                    metaStructure = self._parseMetaStructure(uriMetaCachedFilename)
-                except:
-                    # Metadata is corrupted
-                    self.logger.warning(f'Metadata cache {uriMetaCachedFilename} is corrupted. Ignoring.')
-                    pass
+                cachedEntry = self._getCachedEntry(hashDir, uriCachedFilename, uriMetaCachedFilename, absUriCachedFilename)
             
-            if metaStructure is not None:
-                # Metadata cache hit
-                inputKind = metaStructure.get('kind')
-                if inputKind is None:
-                    inputKind = metaStructure['resolves_to']
-                else:
-                    # Additional checks
-                    inputKind = ContentKind(inputKind)
-                    relFinalCachedFilename = metaStructure.get('path', {}).get('relative', os.readlink(absUriCachedFilename))
-                    finalCachedFilename = os.path.normpath(os.path.join(hashDir, relFinalCachedFilename))
-                    
-                    if not os.path.exists(finalCachedFilename):
-                        self.logger.warning(f'Relative cache path {relFinalCachedFilename} was not found')
-                        finalCachedFilename = metaStructure.get('path', {}).get('absolute')
-                        
-                        if (finalCachedFilename is None) or not os.path.exists(finalCachedFilename):
-                            self.logger.warning(f'Absolute cache path {finalCachedFilename} was not found. Cache miss!!!')
-                            
-                            # Cleaning up
-                            metaStructure = None
-                
-            if metaStructure is not None:
-                # Cache hit
-                # As the content still exists, get the metadata
-                
-                fetched_metadata_array = list(map(lambda rm: URIWithMetadata(uri=rm['uri'], metadata=rm['metadata'], preferredName=rm.get('preferredName')), metaStructure['metadata_array']))
-            else:
-                # Cache miss
-                # As this is a handler for online resources, comply with offline mode
-                if offline:
-                    raise WFException(f"Cannot download content in offline mode from {remote_file} to {uriCachedFilename}")
-                
-                # Content is fetched here
-                theScheme = parsedInputURL.scheme.lower()
-                schemeHandler = self.schemeHandlers.get(theScheme)
-
-                if schemeHandler is None:
-                    raise WFException(f'No {theScheme} scheme handler for {the_remote_file} (while processing {remote_file}). Was this data injected in the cache?')
-
-                try:
-                    # Content is fetched here
-                    inputKind, fetched_metadata_array = schemeHandler(the_remote_file, tempCachedFilename, secContext=secContext)
-                    
-                    # The cache entry is injected
-                    finalCachedFilename, fingerprint = self._inject(
-                        hashDir,
-                        the_remote_file,
-                        fetched_metadata_array,
-                        tempCachedFilename=tempCachedFilename,
-                        destdir=destdir,
-                        inputKind=inputKind
-                    )
+            if cachedEntry is None:
+                # Only one fetch of the URI at once. The others wait for it,
+                # and then they take the cache hit
+                with self._lockURI(hashDir, uriCachedFilename):
+                    # Leftovers from crashed fetches of this URI
+                    self._removeOrphans(destdir, hashDir, uriHash=uriCachedFilename)
                     
-                    # Now, creating the symlink
-                    # (which should not be needed in the future)
-                    if finalCachedFilename is not None:
-                        if os.path.isfile(finalCachedFilename):
-                            os.unlink(finalCachedFilename)
-                        elif os.path.isdir(finalCachedFilename):
-                            shutil.rmtree(finalCachedFilename)
-                        os.rename(tempCachedFilename, finalCachedFilename)
+                    # Cleaning up
+                    if registerInCache and ignoreCache:
+                        # Removing the metadata
+                        if os.path.exists(uriMetaCachedFilename):
+                            os.unlink(uriMetaCachedFilename)
+                        self._getIndex(hashDir).remove(uriCachedFilename)
+                        self._getIndex(hashDir).removeFailure(uriCachedFilename)
                         
-                        next_input_file = os.path.relpath(finalCachedFilename, hashDir)
-                    else:
-                        next_input_file = hashlib.sha1(inputKind.encode('utf-8')).hexdigest()
-                    
-                    if os.path.lexists(absUriCachedFilename):
-                        os.unlink(absUriCachedFilename)
+                        # Removing the symlink
+                        if os.path.lexists(absUriCachedFilename):
+                            os.unlink(absUriCachedFilename)
+                        # We cannot remove the content as
+                        # it could be referenced by other symlinks
+                    elif not refetch:
+                        cachedEntry = self._getCachedEntry(hashDir, uriCachedFilename, uriMetaCachedFilename, absUriCachedFilename)
                     
-                    os.symlink(next_input_file, absUriCachedFilename)
-                except WFException as we:
-                    raise we
-                except Exception as e:
-                    raise WFException("Cannot download content from {} to {} (while processing {}) (temp file {}): {}".format(the_remote_file, uriCachedFilename, remote_file, tempCachedFilename, e))
+                    if cachedEntry is None:
+                        if not refetch:
+                            self._checkFailure(hashDir, uriCachedFilename, the_remote_file, remote_file, secContext)
+                        inputKind, finalCachedFilename, fetched_metadata_array = self._fetchEntry(destdir, hashDir, remote_file, the_remote_file, parsedInputURL, uriCachedFilename, absUriCachedFilename, offline, secContext)
+            
+            if (cachedEntry is not None) and revalidate and isinstance(cachedEntry[0], ContentKind) and (parsedInputURL.scheme.lower() in REVALIDATION_SCHEMES):
+                with self._lockURI(hashDir, uriCachedFilename):
+                    cachedEntry = self._revalidateEntry(destdir, hashDir, remote_file, the_remote_file, parsedInputURL, uriCachedFilename, uriMetaCachedFilename, absUriCachedFilename, cachedEntry, secContext)
+            
+            if cachedEntry is not None:
+                # Cache hit
+                inputKind, cachedFinalCachedFilename, fetched_metadata_array = cachedEntry
+                if cachedFinalCachedFilename is not None:
+                    finalCachedFilename = cachedFinalCachedFilename
             
             # Store the metadata
             metadata_array.extend(fetched_metadata_array)
-
+        
+        # Remembering the whole chain for next lookups,
+        # keeping all the gathered metadata for provenance
+        if registerInCache and (len(chainHashes) > 1):
+            self._getIndex(hashDir).setChain(chainHashes, list(map(lambda m: {'uri': m.uri, 'metadata': m.metadata, 'preferredName': m.preferredName}, metadata_array)))
+        
+        if declaredChecksum is not None:
+            self._verifyChecksum(hashDir, remote_file, checksum, declaredChecksum, chainHashes[-1], finalCachedFilename, registerInCache)
+        
         return inputKind, finalCachedFilename, metadata_array
@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2020-2021 Barcelona Supercomputing Center (BSC), Spain
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import fnmatch
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+
+from typing import Any, Iterable, Iterator, List, Mapping
+from typing import Optional, Tuple
+
+from .common import *
+
+# The characters which start a glob wildcard in fnmatch syntax
+GLOB_WILDCARD_CHARS = '*?['
+
+class CacheMetadataIndex:
+    """
+    Transactional index of the metadata entries stored in a cache
+    hash directory. The *_meta.json files are still the source of truth,
+    but this index avoids opening and parsing all of them on every listing
+    or lookup.
+    """
+    INDEX_FILENAME = 'uri_hashes_index.sqlite3'
+    
+    # Time to wait for other processes holding a lock on the database
+    DEFAULT_LOCK_TIMEOUT = 60
+    
+    # Bump it when the tables derived from the metadata files change
+    SCHEMA_VERSION = 6
+    DERIVED_TABLES = [ 'cache_entry', 'cache_entry_uri', 'cache_entry_checksum', 'cache_chain', 'cache_chain_member' ]
+    
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entry (
+    uri_hash TEXT PRIMARY KEY,
+    uri TEXT NOT NULL,
+    fingerprint TEXT,
+    kind TEXT,
+    resolves_to TEXT,
+    stamp TEXT,
+    size INTEGER,
+    content_path TEXT,
+    injected INTEGER NOT NULL DEFAULT 0,
+    last_access REAL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    meta_mtime_ns INTEGER,
+    meta_json TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cache_entry_uri ON cache_entry(uri);
+CREATE INDEX IF NOT EXISTS idx_cache_entry_fingerprint ON cache_entry(fingerprint);
+CREATE INDEX IF NOT EXISTS idx_cache_entry_resolves_to ON cache_entry(resolves_to);
+CREATE INDEX IF NOT EXISTS idx_cache_entry_content_path ON cache_entry(content_path);
+CREATE TABLE IF NOT EXISTS cache_entry_uri (
+    uri_hash TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    uri TEXT NOT NULL,
+    PRIMARY KEY (uri_hash, pos)
+);
+CREATE INDEX IF NOT EXISTS idx_cache_entry_uri_uri ON cache_entry_uri(uri);
+CREATE TABLE IF NOT EXISTS cache_entry_checksum (
+    uri_hash TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY (uri_hash, fingerprint)
+);
+CREATE INDEX IF NOT EXISTS idx_cache_entry_checksum_fingerprint ON cache_entry_checksum(fingerprint);
+CREATE TABLE IF NOT EXISTS cache_chain (
+    head_hash TEXT PRIMARY KEY,
+    terminal_hash TEXT NOT NULL,
+    metadata_json TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cache_chain_member (
+    uri_hash TEXT NOT NULL,
+    head_hash TEXT NOT NULL,
+    PRIMARY KEY (uri_hash, head_hash)
+);
+CREATE TABLE IF NOT EXISTS cache_reference (
+    content_path TEXT NOT NULL,
+    referrer TEXT NOT NULL,
+    PRIMARY KEY (content_path, referrer)
+);
+CREATE TABLE IF NOT EXISTS cache_failure (
+    uri_hash TEXT PRIMARY KEY,
+    uri TEXT NOT NULL,
+    failed_at REAL NOT NULL,
+    status INTEGER,
+    exception TEXT NOT NULL,
+    message TEXT
+);
+"""
+
+    def __init__(self, hashDir:AbsPath, lockTimeout:float=DEFAULT_LOCK_TIMEOUT):
+        # Getting a logger focused on specific classes
+        import inspect
+        
+        self.logger = logging.getLogger(dict(inspect.getmembers(self))['__module__'] + '::' + self.__class__.__name__)
+        
+        self.hashDir = hashDir
+        self.indexFilename = os.path.join(hashDir, self.INDEX_FILENAME)
+        self.lockTimeout = lockTimeout
+        
+        # sqlite3 connections cannot be shared among threads,
+        # so each thread gets its own one
+        self._conns = ThreadConnections(self._connect)
+        
+        # When the database did not exist, it has to be populated
+        # from the metadata files
+        self.isNew = not os.path.exists(self.indexFilename)
+        try:
+            self._checkSchema(self.conn)
+        except sqlite3.OperationalError as oe:
+            raise WFException(f'Unable to open cache index {self.indexFilename}: {oe}')
+        except sqlite3.DatabaseError as de:
+            # A corrupted index is just thrown away, as it can be rebuilt
+            self.logger.warning(f'Cache index {self.indexFilename} is corrupted ({de}). Rebuilding it')
+            self.close()
+            os.unlink(self.indexFilename)
+            self.isNew = True
+            self._checkSchema(self.conn)
+    
+    def _connect(self) -> sqlite3.Connection:
+        # The default rollback journal is used instead of WAL,
+        # as WAL does not work on network filesystems
+        return sqlite3.connect(self.indexFilename, timeout=self.lockTimeout, check_same_thread=False)
+    
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return self._conns.get()
+    
+    def _checkSchema(self, conn:sqlite3.Connection) -> None:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            # Derived tables are recreated, but not the references,
+            # as they cannot be rebuilt from the metadata files
+            for table in self.DERIVED_TABLES:
+                conn.execute(f'DROP TABLE IF EXISTS {table}')
+            conn.executescript(self.SCHEMA)
+            conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+            conn.commit()
+            self.isNew = True
+    
+    def close(self) -> None:
+        self._conns.closeAll()
+    
+    def _upsert(self, uriHash:str, metaStructure:Mapping[str, Any], uri:Optional[URIType]=None, size:Optional[int]=None, mtime_ns:Optional[int]=None, lastAccess:Optional[float]=None) -> None:
+        metadata_array = metaStructure.get('metadata_array', [])
+        if uri is None:
+            uri = metaStructure.get('uri')
+        if uri is None:
+            for meta in metadata_array:
+                uri = meta['uri']
+                break
+            else:
+                uri = ''
+        
+        resolves_to = metaStructure.get('resolves_to')
+        if resolves_to is not None and not isinstance(resolves_to, str):
+            resolves_to = str(resolves_to)
+        
+        content_path = None
+        if metaStructure.get('kind') is not None:
+            content_path = metaStructure.get('path', {}).get('relative')
+        injected = any(map(lambda meta: bool(meta.get('metadata', {}).get('injected')), metadata_array))
+        
+        # Access statistics survive the re-registration of the entry
+        hits = 0
+        prev = self.conn.execute('SELECT last_access, hits FROM cache_entry WHERE uri_hash = ?', (uriHash,)).fetchone()
+        if prev is not None:
+            if lastAccess is None:
+                lastAccess = prev[0]
+            hits = prev[1]
+        if lastAccess is None:
+            lastAccess = time.time()
+        
+        self.conn.execute(
+            'INSERT OR REPLACE INTO cache_entry (uri_hash, uri, fingerprint, kind, resolves_to, stamp, size, content_path, injected, last_access, hits, meta_mtime_ns, meta_json) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                uriHash,
+                uri,
+                metaStructure.get('fingerprint'),
+                metaStructure.get('kind'),
+                resolves_to,
+                metaStructure.get('stamp'),
+                size,
+                content_path,
+                1 if injected else 0,
+                lastAccess,
+                hits,
+                mtime_ns,
+                json.dumps(metaStructure)
+            )
+        )
+        # The URIs folded into this entry are after the fetched ones
+        entry_uris = list(map(lambda meta: meta['uri'], metadata_array))
+        entry_uris.extend(metaStructure.get('aliases', []))
+        self.conn.execute('DELETE FROM cache_entry_uri WHERE uri_hash = ?', (uriHash,))
+        self.conn.executemany(
+            'INSERT INTO cache_entry_uri (uri_hash, pos, uri) VALUES (?, ?, ?)',
+            [ (uriHash, pos, entry_uri)  for pos, entry_uri in enumerate(entry_uris) ]
+        )
+        # Verified declared checksums, in filename fingerprint form
+        self.conn.execute('DELETE FROM cache_entry_checksum WHERE uri_hash = ?', (uriHash,))
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO cache_entry_checksum (uri_hash, fingerprint) VALUES (?, ?)',
+            [ (uriHash, fingerprint)  for fingerprint in metaStructure.get('checksums', []) ]
+        )
+        self._invalidateChains(uriHash)
+    
+    def _invalidateChains(self, uriHash:str) -> None:
+        """
+        Any change in an entry invalidates the chains it is part of
+        """
+        heads = list(map(lambda r: r[0], self.conn.execute('SELECT head_hash FROM cache_chain_member WHERE uri_hash = ?', (uriHash,))))
+        for head_hash in heads:
+            self.conn.execute('DELETE FROM cache_chain WHERE head_hash = ?', (head_hash,))
+            self.conn.execute('DELETE FROM cache_chain_member WHERE head_hash = ?', (head_hash,))
+    
+    def upsert(self, uriHash:str, metaStructure:Mapping[str, Any], uri:Optional[URIType]=None, size:Optional[int]=None, mtime_ns:Optional[int]=None, lastAccess:Optional[float]=None) -> None:
+        """
+        This method (re)registers a metadata entry in the index
+        """
+        with self.conn:
+            self._upsert(uriHash, metaStructure, uri=uri, size=size, mtime_ns=mtime_ns, lastAccess=lastAccess)
+    
+    def rebuild(self, entries:Iterable[Tuple[str, Mapping[str, Any], Optional[int], Optional[int]]]) -> int:
+        """
+        This method replaces the whole contents of the index in a single
+        transaction, from tuples of (uri hash, metadata structure, size, mtime_ns)
+        """
+        numEntries = 0
+        with self.conn:
+            self.conn.execute('DELETE FROM cache_chain_member')
+            self.conn.execute('DELETE FROM cache_chain')
+            self.conn.execute('DELETE FROM cache_entry_checksum')
+            self.conn.execute('DELETE FROM cache_entry_uri')
+            self.conn.execute('DELETE FROM cache_entry')
+            for uriHash, metaStructure, size, mtime_ns in entries:
+                # The metadata modification time is the best
+                # approximation to the last access
+                self._upsert(uriHash, metaStructure, size=size, mtime_ns=mtime_ns, lastAccess=None if mtime_ns is None else mtime_ns / 1e9)
+                numEntries += 1
+        
+        self.isNew = False
+        return numEntries
+    
+    def remove(self, uriHash:str) -> None:
+        with self.conn:
+            self._invalidateChains(uriHash)
+            self.conn.execute('DELETE FROM cache_entry_checksum WHERE uri_hash = ?', (uriHash,))
+            self.conn.execute('DELETE FROM cache_entry_uri WHERE uri_hash = ?', (uriHash,))
+            self.conn.execute('DELETE FROM cache_entry WHERE uri_hash = ?', (uriHash,))
+    
+    def setChain(self, uriHashes:List[str], metadata_array:List[Mapping[str, Any]]) -> None:
+        """
+        This method records a fully resolved chain of entries, from the
+        first URI to the one holding the content, along with the
+        gathered metadata of all of them
+        """
+        head_hash = uriHashes[0]
+        with self.conn:
+            self._invalidateChains(head_hash)
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cache_chain (head_hash, terminal_hash, metadata_json) VALUES (?, ?, ?)',
+                (head_hash, uriHashes[-1], json.dumps(metadata_array))
+            )
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO cache_chain_member (uri_hash, head_hash) VALUES (?, ?)',
+                [ (uriHash, head_hash)  for uriHash in uriHashes ]
+            )
+    
+    def getChain(self, head_hash:str) -> Optional[Tuple[str, Mapping[str, Any], List[Mapping[str, Any]]]]:
+        """
+        Single read lookup of a resolved chain. It returns the hash of the
+        terminal entry, its metadata and the gathered metadata of the chain
+        """
+        row = self.conn.execute(
+            'SELECT c.terminal_hash, e.meta_json, c.metadata_json FROM cache_chain c JOIN cache_entry e ON e.uri_hash = c.terminal_hash WHERE c.head_hash = ?',
+            (head_hash,)
+        ).fetchone()
+        if row is None:
+            return None
+        
+        return row[0], json.loads(row[1]), json.loads(row[2])
+    
+    def touch(self, uriHash:str) -> None:
+        """
+        This method records a cache hit over an entry
+        """
+        with self.conn:
+            self.conn.execute('UPDATE cache_entry SET last_access = ?, hits = hits + 1 WHERE uri_hash = ?', (time.time(), uriHash))
+    
+    def addReference(self, content_path:RelPath, referrer:AbsPath) -> None:
+        with self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO cache_reference (content_path, referrer) VALUES (?, ?)', (content_path, referrer))
+    
+    def getReferrers(self, content_path:RelPath) -> List[AbsPath]:
+        return list(map(lambda r: r[0], self.conn.execute('SELECT referrer FROM cache_reference WHERE content_path = ?', (content_path,))))
+    
+    def removeReference(self, content_path:RelPath, referrer:Optional[AbsPath]=None) -> None:
+        with self.conn:
+            if referrer is None:
+                self.conn.execute('DELETE FROM cache_reference WHERE content_path = ?', (content_path,))
+            else:
+                self.conn.execute('DELETE FROM cache_reference WHERE content_path = ? AND referrer = ?', (content_path, referrer))
+    
+    def setFailure(self, uriHash:str, uri:URIType, exception:str, message:Optional[str]=None, status:Optional[int]=None) -> None:
+        """
+        This method records a failed resolution of a URI
+        """
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO cache_failure (uri_hash, uri, failed_at, status, exception, message) VALUES (?, ?, ?, ?, ?, ?)',
+                (uriHash, uri, time.time(), status, exception, message)
+            )
+    
+    @staticmethod
+    def _failureFromRow(row:Tuple[URIType, float, Optional[int], str, Optional[str]]) -> Mapping[str, Any]:
+        uri, failed_at, status, exception, message = row
+        return {
+            'uri': uri,
+            'failed_at': failed_at,
+            'status': status,
+            'exception': exception,
+            'message': message,
+        }
+    
+    def getFailure(self, uriHash:str) -> Optional[Mapping[str, Any]]:
+        row = self.conn.execute('SELECT uri, failed_at, status, exception, message FROM cache_failure WHERE uri_hash = ?', (uriHash,)).fetchone()
+        
+        return None  if row is None  else  self._failureFromRow(row)
+    
+    def removeFailure(self, uriHash:str) -> None:
+        with self.conn:
+            self.conn.execute('DELETE FROM cache_failure WHERE uri_hash = ?', (uriHash,))
+    
+    def queryFailures(self, *args, acceptGlob:bool=False) -> Iterator[Tuple[str, Mapping[str, Any]]]:
+        """
+        This method iterates over the recorded failures whose URIs
+        match either the literal or the glob patterns
+        """
+        if acceptGlob:
+            patterns = list(map(lambda entry: re.compile(fnmatch.translate(entry)), args))
+        else:
+            literals = set(args)
+        
+        for row in self.conn.execute('SELECT uri_hash, uri, failed_at, status, exception, message FROM cache_failure ORDER BY failed_at').fetchall():
+            uri = row[1]
+            if len(args) > 0:
+                if acceptGlob:
+                    if not any(map(lambda pattern: pattern.match(uri) is not None, patterns)):
+                        continue
+                elif uri not in literals:
+                    continue
+            
+            yield row[0], self._failureFromRow(row[1:])
+    
+    def contentUsage(self) -> List[Tuple[RelPath, int, float, int, bool]]:
+        """
+        This method aggregates the entries by the content they point to,
+        returning tuples of (content path, size, last access, hits,
+        whether any entry was injected)
+        """
+        cursor = self.conn.execute(
+            'SELECT content_path, MAX(COALESCE(size, 0)), MAX(last_access), SUM(hits), MAX(injected) FROM cache_entry WHERE content_path IS NOT NULL GROUP BY content_path'
+        )
+        
+        return [ (content_path, size, last_access, hits, injected != 0)  for content_path, size, last_access, hits, injected in cursor.fetchall() ]
+    
+    def entriesByContent(self, content_path:RelPath) -> List[Tuple[str, URIType]]:
+        return self.conn.execute('SELECT uri_hash, uri FROM cache_entry WHERE content_path = ?', (content_path,)).fetchall()
+    
+    def get(self, uriHash:str, mtime_ns:Optional[int]=None) -> Optional[Mapping[str, Any]]:
+        """
+        Indexed lookup of a metadata entry. When mtime_ns is provided
+        and it does not match the registered one, the entry is considered
+        stale, and None is returned
+        """
+        row = self.conn.execute('SELECT meta_json, meta_mtime_ns FROM cache_entry WHERE uri_hash = ?', (uriHash,)).fetchone()
+        if row is None:
+            return None
+        
+        meta_json, meta_mtime_ns = row
+        if (mtime_ns is not None) and (meta_mtime_ns != mtime_ns):
+            return None
+        
+        return json.loads(meta_json)
+    
+    def findByFingerprint(self, fingerprint:Fingerprint) -> Iterator[Tuple[str, Mapping[str, Any]]]:
+        """
+        Entries whose contents have the fingerprint, either as their
+        own one or as an already verified declared checksum
+        """
+        for uriHash, meta_json in self.conn.execute(
+            'SELECT uri_hash, meta_json FROM cache_entry WHERE fingerprint = ? UNION SELECT e.uri_hash, e.meta_json FROM cache_entry_checksum c JOIN cache_entry e ON c.uri_hash = e.uri_hash WHERE c.fingerprint = ?',
+            (fingerprint, fingerprint)
+        ).fetchall():
+            yield uriHash, json.loads(meta_json)
+    
+    @staticmethod
+    def _globPrefix(pattern:str) -> str:
+        """
+        The literal prefix of a glob pattern, which can be used
+        for an indexed range query
+        """
+        for iChar, theChar in enumerate(pattern):
+            if theChar in GLOB_WILDCARD_CHARS:
+                return pattern[0:iChar]
+        
+        return pattern
+    
+    def _queryURIs(self, entries:List[str], acceptGlob:bool) -> Iterator[Tuple[str, int, URIType]]:
+        if not entries:
+            yield from self.conn.execute('SELECT uri_hash, pos, uri FROM cache_entry_uri WHERE pos = 0 ORDER BY uri_hash')
+            return
+        
+        literals = []
+        for entry in entries:
+            if acceptGlob:
+                prefix = self._globPrefix(entry)
+                if prefix != entry:
+                    reEntry = re.compile(fnmatch.translate(entry))
+                    if len(prefix) > 0:
+                        # Range query over the URI index
+                        upperBound = prefix[0:-1] + chr(ord(prefix[-1]) + 1)
+                        cursor = self.conn.execute('SELECT uri_hash, pos, uri FROM cache_entry_uri WHERE uri >= ? AND uri < ?', (prefix, upperBound))
+                    else:
+                        cursor = self.conn.execute('SELECT uri_hash, pos, uri FROM cache_entry_uri')
+                    
+                    for row in cursor:
+                        if reEntry.match(row[2]) is not None:
+                            yield row
+                    continue
+            
+            literals.append(entry)
+        
+        if len(literals) > 0:
+            yield from self.conn.execute(
+                'SELECT uri_hash, pos, uri FROM cache_entry_uri WHERE uri IN ({})'.format(','.join(['?'] * len(literals))),
+                literals
+            )
+    
+    def query(self, *args, acceptGlob:bool=False) -> Iterator[Tuple[str, URIType, Mapping[str, Any]]]:
+        """
+        This method iterates over the index entries whose metadata URIs
+        match either the literal or the glob patterns. It mimics the
+        behaviour of the scan based listing, so the first matching
+        URI from each metadata array is the one returned
+        """
+        entries = list(set(args))
+        
+        matched = dict()
+        for uriHash, pos, uri in self._queryURIs(entries, acceptGlob):
+            prev = matched.get(uriHash)
+            if (prev is None) or (pos < prev[0]):
+                matched[uriHash] = (pos, uri)
+        
+        for uriHash, (_ , uri) in matched.items():
+            metaStructure = self.get(uriHash)
+            if metaStructure is not None:
+                yield uriHash, uri, metaStructure
@@ -19,12 +19,21 @@ from __future__ import absolute_import
 
 import abc
 import base64
+import binascii
+import collections
+import concurrent.futures
 import enum
 import functools
 import hashlib
+import io
+import json
 import os
-from typing import Any, Callable, List, Mapping, NamedTuple
-from typing import NewType, Optional, Pattern, Tuple, Type, Union
+import re
+import shutil
+import threading
+import weakref
+from typing import Any, Callable, List, Mapping, MutableMapping, NamedTuple
+from typing import NewType, Optional, Pattern, Sequence, Tuple, Type, Union
 
 
 
@@ -147,6 +156,11 @@ class MaterializedContent(NamedTuple):
 
 ProtocolFetcher = Callable[[URIType, AbsPath, Optional[SecurityContextConfig]], Tuple[Union[URIType, ContentKind], List[URIWithMetadata]]]
 
+# It tells beforehand the checksums (algorithm and raw digest) of the
+# contents behind an URI, if they are known by the server, along with
+# their size. Only collision resistant checksums identify the contents
+ChecksumProbe = Callable[[URIType, Optional[SecurityContextConfig]], Tuple[List[Tuple[str, bytes]], Optional[int]]]
+
 
 class MaterializedInput(NamedTuple):
     """
@@ -238,12 +252,16 @@ class GeneratedDirectoryContent(AbstractGeneratedContent, NamedTuple):
     signature: Optional computed checksum from the directory
     preferredFilename: The preferred relative filename to use when it is
       uploaded from the computational environment
+    merkleSignature: Optional checksum of the Merkle tree node of the
+      directory, built from the names and checksums of the values, so
+      each subdirectory has its own one
     """
     local: AbsPath
     values: List[AbstractGeneratedContent]  # It should be List[Union[GeneratedContent, GeneratedDirectoryContent]]
     uri: Optional[URIType] = None
     preferredFilename: Optional[RelPath] = None
     signature: Optional[Fingerprint] = None
+    merkleSignature: Optional[Fingerprint] = None
 
 
 class MaterializedOutput(NamedTuple):
@@ -351,6 +369,20 @@ class Container(NamedTuple):
 class WFException(Exception):
     pass
 
+class ContentNotModifiedException(WFException):
+    """
+    Raised by fetchers when a conditional request tells
+    the already cached content is still valid
+    """
+    pass
+
+class ContentNotFoundException(WFException):
+    """
+    Raised by fetchers when the content definitely does not
+    exist, so it is not worth retrying it soon
+    """
+    pass
+
 
 # Adapted from https://gist.github.com/ptmcg/23ba6e42d51711da44ba1216c53af4ea
 # in order to show the value instead of the class name
@@ -375,11 +407,229 @@ class CacheType(ArgTypeMixin, enum.Enum):
     TRS = 'ga4gh-trs'
     Workflow = 'workflow'
 
+# Eviction policies used by the cache garbage collector
+class CacheGCPolicy(ArgTypeMixin, enum.Enum):
+    LRU = 'lru'
+    LFU = 'lfu'
+
+DEFAULT_CACHE_GC_POLICY = CacheGCPolicy.LRU
+
+class _ThreadConnectionHolder(object):
+    __slots__ = ('conn', '__weakref__')
+
+def _closeThreadConnection(conns: MutableMapping[int, Any], connsLock: threading.Lock, key: int) -> None:
+    with connsLock:
+        conn = conns.pop(key, None)
+    if conn is not None:
+        conn.close()
+
+class ThreadConnections(object):
+    """
+    Connections (like the sqlite3 ones) which cannot be shared among
+    threads, so each thread gets its own one. It is closed when the
+    thread finishes, as the short-lived pools of threads used to digest
+    and fetch contents would leak them otherwise
+    """
+    def __init__(self, connect: Callable[[], Any]):
+        self._connect = connect
+        self._local = threading.local()
+        self._conns: MutableMapping[int, Any] = dict()
+        self._connsLock = threading.Lock()
+    
+    def get(self) -> Any:
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            holder = _ThreadConnectionHolder()
+            holder.conn = self._connect()
+            # The holder is only referenced from the thread local
+            # storage, which is released when the thread finishes
+            key = id(holder)
+            with self._connsLock:
+                self._conns[key] = holder.conn
+            weakref.finalize(holder, _closeThreadConnection, self._conns, self._connsLock, key)
+            self._local.holder = holder
+        
+        return holder.conn
+    
+    def closeAll(self) -> None:
+        with self._connsLock:
+            conns = list(self._conns.values())
+            self._conns.clear()
+        for conn in conns:
+            conn.close()
+        self._local = threading.local()
+    
+    def __len__(self) -> int:
+        with self._connsLock:
+            return len(self._conns)
+
+BYTE_SIZE_PATTERN = re.compile(r'^\s*([0-9]+(?:\.[0-9]+)?)\s*([kmgtp]?)(?:i?b)?\s*$', re.IGNORECASE)
+BYTE_SIZE_UNITS = {
+    '': 1,
+    'k': 1 << 10,
+    'm': 1 << 20,
+    'g': 1 << 30,
+    't': 1 << 40,
+    'p': 1 << 50,
+}
+
+def parseByteSize(size:Union[int, str]) -> int:
+    """
+    Accessory method to translate sizes like 500M or 1.5TiB into bytes.
+    Binary units are always used
+    """
+    if isinstance(size, int):
+        return size
+    
+    matched = BYTE_SIZE_PATTERN.match(size)
+    if matched is None:
+        raise WFException(f"Unable to parse {size} as a size in bytes")
+    
+    return int(float(matched.group(1)) * BYTE_SIZE_UNITS[matched.group(2).lower()])
+
 
 # Next methods have been borrowed from FlowMaps
 DEFAULT_DIGEST_ALGORITHM = 'sha256'
 DEFAULT_DIGEST_BUFFER_SIZE = 65536
 
+# Faster, non-cryptographic digests are available when xxhash is installed
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+XXHASH_DIGEST_ALGORITHMS = ('xxh64', 'xxh128', 'xxh3_64', 'xxh3_128')
+
+# CRC32C checksums (used by Google Cloud Storage) are available when google-crc32c is installed
+try:
+    import google_crc32c
+except ImportError:
+    google_crc32c = None
+
+CRC32C_DIGEST_ALGORITHM = 'crc32c'
+
+# Algorithm of the internal fingerprints (cache identity and change
+# detection), which can be a faster one than the provenance one
+DEFAULT_INTERNAL_DIGEST_ALGORITHM = DEFAULT_DIGEST_ALGORITHM
+_InternalDigestAlgorithm = DEFAULT_INTERNAL_DIGEST_ALGORITHM
+
+# Sequential digests use larger buffers for larger files
+MAX_DIGEST_BUFFER_SIZE = 4 * 1024 * 1024
+
+def adaptiveBufferSize(fileSize: int) -> int:
+    bufferSize = DEFAULT_DIGEST_BUFFER_SIZE
+    while (bufferSize < MAX_DIGEST_BUFFER_SIZE) and (bufferSize * 256 < fileSize):
+        bufferSize *= 2
+    
+    return bufferSize
+
+# Tree digests split files in chunks, which are digested in parallel.
+# The root digest is the digest of the concatenated digests of the chunks.
+# Their labels (like sha256-tree-64m) tell both the algorithm and the
+# size of the chunks (in MiB), so they never collide with plain digests
+DEFAULT_TREE_DIGEST_CHUNK_SIZE = 64 * 1024 * 1024
+TREE_DIGEST_ALGORITHM_PATTERN = re.compile(r'^(.+)-tree-([1-9][0-9]*)m$')
+
+def treeDigestAlgorithm(baseAlgorithm=DEFAULT_DIGEST_ALGORITHM, chunkSize: int = DEFAULT_TREE_DIGEST_CHUNK_SIZE) -> str:
+    if (chunkSize <= 0) or (chunkSize % (1024 * 1024) != 0):
+        raise WFException(f"Tree digest chunk size {chunkSize} must be a multiple of 1 MiB")
+    
+    return f'{baseAlgorithm}-tree-{chunkSize // (1024 * 1024)}m'
+
+def _parseTreeDigestAlgorithm(digestAlgorithm) -> Optional[Tuple[str, int]]:
+    matched = TREE_DIGEST_ALGORITHM_PATTERN.search(digestAlgorithm)
+    if matched is None:
+        return None
+    
+    return matched.group(1), int(matched.group(2)) * 1024 * 1024
+
+class TreeDigester(object):
+    """
+    Streaming implementation of the tree digests, used
+    when the contents are digested while they are written
+    """
+    def __init__(self, baseAlgorithm, chunkSize: int):
+        self.name = treeDigestAlgorithm(baseAlgorithm, chunkSize)
+        self.baseAlgorithm = baseAlgorithm
+        self.chunkSize = chunkSize
+        self._root = newDigester(baseAlgorithm)
+        self._chunk = newDigester(baseAlgorithm)
+        self._chunkLeft = chunkSize
+        # Digests of the completed chunks, which are the
+        # state needed to resume the digestion later
+        self.leaves: List[bytes] = []
+    
+    def restore(self, leaves: Sequence[bytes]) -> None:
+        """
+        It restores the state of a digestion of whole chunks,
+        from the digests of those chunks
+        """
+        self._root = newDigester(self.baseAlgorithm)
+        self._chunk = newDigester(self.baseAlgorithm)
+        self._chunkLeft = self.chunkSize
+        self.leaves = list(leaves)
+        for leaf in self.leaves:
+            self._root.update(leaf)
+    
+    def update(self, data) -> None:
+        mv = memoryview(data).cast('B')
+        while len(mv) > 0:
+            numBytes = min(len(mv), self._chunkLeft)
+            self._chunk.update(mv[0:numBytes])
+            self._chunkLeft -= numBytes
+            mv = mv[numBytes:]
+            if self._chunkLeft == 0:
+                leaf = self._chunk.digest()
+                self._root.update(leaf)
+                self.leaves.append(leaf)
+                self._chunk = newDigester(self.baseAlgorithm)
+                self._chunkLeft = self.chunkSize
+    
+    def digest(self) -> bytes:
+        root = self._root.copy()
+        # The last chunk is usually a partial one
+        if self._chunkLeft < self.chunkSize:
+            root.update(self._chunk.digest())
+        
+        return root.digest()
+
+def newDigester(digestAlgorithm):
+    """
+    Counterpart of hashlib.new, which also understands
+    the xxhash, crc32c and the tree digest algorithms
+    """
+    treeAlgorithm = _parseTreeDigestAlgorithm(digestAlgorithm)
+    if treeAlgorithm is not None:
+        return TreeDigester(*treeAlgorithm)
+    
+    if digestAlgorithm in XXHASH_DIGEST_ALGORITHMS:
+        if xxhash is None:
+            raise WFException(f"Digest algorithm {digestAlgorithm} needs xxhash module, which is not installed")
+        return getattr(xxhash, digestAlgorithm)()
+    
+    if digestAlgorithm == CRC32C_DIGEST_ALGORITHM:
+        if google_crc32c is None:
+            raise WFException(f"Digest algorithm {digestAlgorithm} needs google-crc32c module, which is not installed")
+        return google_crc32c.Checksum()
+    
+    try:
+        return hashlib.new(digestAlgorithm)
+    except ValueError as ve:
+        raise WFException(f"Unsupported digest algorithm {digestAlgorithm}") from ve
+
+def setInternalDigestAlgorithm(digestAlgorithm: str) -> None:
+    """
+    It sets up the algorithm of the internal fingerprints, like blake2b,
+    xxh3_128 or sha256-tree-64m. Provenance keeps using DEFAULT_DIGEST_ALGORITHM
+    """
+    # Unsupported algorithms are rejected early
+    newDigester(digestAlgorithm)
+    global _InternalDigestAlgorithm
+    _InternalDigestAlgorithm = digestAlgorithm
+
+def getInternalDigestAlgorithm() -> str:
+    return _InternalDigestAlgorithm
+
 def stringifyDigest(digestAlgorithm, digest:bytes) -> Union[Fingerprint, bytes]:
     return '{0}={1}'.format(digestAlgorithm, str(base64.standard_b64encode(digest), 'iso-8859-1'))
 
@@ -413,11 +663,60 @@ def nihDigest(digestAlgorithm, digest: bytes) -> Union[Fingerprint, bytes]:
     
     return generate_nih_from_digest(digest, algo=digestAlgorithm)
 
+# Declared checksums: sha256=base64, sha256~base64url or sha256:hex
+CHECKSUM_PATTERN = re.compile(r'^([A-Za-z0-9_-]+)([=~:])(.+)$')
+
+def _niAlgorithm(niAlgorithm: str, checksum: str) -> str:
+    # Only the full length digests can be verified
+    for digestAlgorithm, validNiAlgorithm in VALID_NI_ALGOS.items():
+        if validNiAlgorithm == niAlgorithm:
+            return digestAlgorithm
+    
+    raise WFException(f"Unsupported ni algorithm {niAlgorithm} in checksum {checksum}")
+
+def parseChecksum(checksum: str) -> Tuple[str, bytes]:
+    """
+    It parses a declared checksum, either in stringifyDigest, stringifyFilenameDigest,
+    hexadecimal (sha256:hex), ni or nih forms, returning the algorithm and the raw digest
+    """
+    try:
+        if checksum.startswith('nih:'):
+            # nih:algorithm;dashed-hex[;check digit]
+            niAlgorithm , _ , value = checksum[4:].partition(';')
+            digestAlgorithm = _niAlgorithm(niAlgorithm, checksum)
+            digest = bytes.fromhex(value.partition(';')[0].replace('-', ''))
+        elif checksum.startswith('ni:'):
+            # ni://[authority]/algorithm;value[?query]
+            niPath = checksum[3:]
+            if niPath.startswith('//'):
+                niPath = niPath[2:].partition('/')[2]
+            niAlgorithm , _ , value = niPath.partition('?')[0].partition(';')
+            digestAlgorithm = _niAlgorithm(niAlgorithm, checksum)
+            digest = base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+        else:
+            matched = CHECKSUM_PATTERN.search(checksum)
+            if matched is None:
+                raise WFException(f"Unrecognized checksum {checksum}")
+            digestAlgorithm = matched.group(1).lower()
+            if matched.group(2) == '=':
+                digest = base64.standard_b64decode(matched.group(3))
+            elif matched.group(2) == '~':
+                digest = base64.urlsafe_b64decode(matched.group(3))
+            else:
+                digest = bytes.fromhex(matched.group(3))
+    except (ValueError, binascii.Error) as e:
+        raise WFException(f"Unable to decode checksum {checksum}: {e}") from e
+    
+    if len(newDigester(digestAlgorithm).digest()) != len(digest):
+        raise WFException(f"Checksum {checksum} does not have the length of a {digestAlgorithm} digest")
+    
+    return digestAlgorithm, digest
+
 def ComputeDigestFromFileLike(filelike, digestAlgorithm=DEFAULT_DIGEST_ALGORITHM, bufferSize: int = DEFAULT_DIGEST_BUFFER_SIZE, repMethod=stringifyDigest) -> Fingerprint:
     """
     Accessory method used to compute the digest of an input file-like object
     """
-    h = hashlib.new(digestAlgorithm)
+    h = newDigester(digestAlgorithm)
     buf = filelike.read(bufferSize)
     while len(buf) > 0:
         h.update(buf)
@@ -426,8 +725,424 @@ def ComputeDigestFromFileLike(filelike, digestAlgorithm=DEFAULT_DIGEST_ALGORITHM
     return repMethod(digestAlgorithm, h.digest())
 
 
+# Persistent store of file digests (see digest_store.DigestStore),
+# shared by all the digest computations of this process
+_DigestStore = None
+
+# Digests computed while the files were written, used
+# when there is no persistent store
+_PrecomputedDigests = collections.OrderedDict()
+_PrecomputedDigestsLock = threading.Lock()
+MAX_PRECOMPUTED_DIGESTS = 4096
+
+# Number of threads used to digest the files of a directory
+DEFAULT_DIGEST_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+_DigestWorkers = DEFAULT_DIGEST_WORKERS
+
+def setDigestWorkers(numWorkers: int) -> None:
+    """
+    It sets up the number of threads used by ComputeDigestFromDirectory.
+    With 1, files are digested sequentially
+    """
+    global _DigestWorkers
+    _DigestWorkers = max(1, numWorkers)
+
+def setDigestStore(digestStore) -> None:
+    """
+    It sets up the persistent store consulted by ComputeDigestFromFile.
+    None disables it
+    """
+    global _DigestStore
+    _DigestStore = digestStore
+
+def registerFileDigest(filename: Union[AbsPath, RelPath], digest: bytes, digestAlgorithm=DEFAULT_DIGEST_ALGORITHM) -> None:
+    """
+    It records an already known digest of a file, so
+    ComputeDigestFromFile does not have to read it
+    """
+    fStat = os.stat(filename)
+    digestKey = (fStat.st_dev, fStat.st_ino, fStat.st_size, fStat.st_mtime_ns)
+    digestStore = _DigestStore
+    if digestStore is None:
+        _rememberDigest(digestKey, digestAlgorithm, digest)
+    else:
+        digestStore.put(digestKey, digestAlgorithm, digest)
+
+def _rememberDigest(digestKey: Tuple[int, int, int, int], digestAlgorithm, digest: bytes) -> None:
+    # Inputs can be fetched (and digested) concurrently
+    with _PrecomputedDigestsLock:
+        _PrecomputedDigests[(digestKey, digestAlgorithm)] = digest
+        _PrecomputedDigests.move_to_end((digestKey, digestAlgorithm))
+        while len(_PrecomputedDigests) > MAX_PRECOMPUTED_DIGESTS:
+            _PrecomputedDigests.popitem(last=False)
+
+class DigestingFile(io.RawIOBase):
+    """
+    Binary file sink which digests the contents while they are written,
+    so they do not have to be read again. On close, the digest is
+    registered (see registerFileDigest), after setting the modification
+    time, when it was provided. By default, the internal digest algorithm
+    is used, as fetched contents are identified in the cache by it.
+    When resume is true, the contents are appended to the existing ones,
+    so the digest covers the whole file. When a resume state is provided,
+    the state of tree digests is checkpointed in its sidecar after each
+    chunk, so only the contents after the last checkpoint are digested
+    again (see resumeRoot in writeResumeState). Other digest algorithms
+    have to digest the existing contents
+    """
+    def __init__(self, filename: Union[AbsPath, RelPath], digestAlgorithm: Optional[str] = None, mtime: Optional[float] = None, buffering: int = -1, resume: bool = False, resumeState: Optional[MutableMapping[str, Any]] = None, resumeRoot: Optional[Union[AbsPath, RelPath]] = None):
+        super().__init__()
+        if digestAlgorithm is None:
+            digestAlgorithm = _InternalDigestAlgorithm
+        self.filename = filename
+        self.resumeRoot = resumeRoot
+        self.digestAlgorithm = digestAlgorithm
+        self.mtime = mtime
+        self.size = 0
+        self._h = newDigester(digestAlgorithm)
+        self._failed = False
+        # Only the state of tree digests can be checkpointed
+        self._resumeState = resumeState  if isinstance(self._h, TreeDigester)  else  None
+        if resume and os.path.isfile(filename):
+            self._restoreDigest(resumeState)
+            self._f = open(filename, mode='ab', buffering=buffering)
+        else:
+            if self._resumeState is not None:
+                self._resumeState.pop('digest', None)
+            self._f = open(filename, mode='wb', buffering=buffering)
+        self._numCheckpointed = len(self._h.leaves)  if self._resumeState is not None  else  0
+    
+    def _restoreDigest(self, resumeState: Optional[Mapping[str, Any]]) -> None:
+        offset = 0
+        checkpoint = resumeState.get('digest')  if (resumeState is not None) and isinstance(self._h, TreeDigester)  else  None
+        if isinstance(checkpoint, dict) and (checkpoint.get('algorithm') == self.digestAlgorithm):
+            try:
+                leaves = [ bytes.fromhex(leaf) for leaf in checkpoint.get('leaves', []) ]
+            except (TypeError, ValueError):
+                leaves = []
+            offset = len(leaves) * self._h.chunkSize
+            if (offset > 0) and (offset <= os.path.getsize(self.filename)):
+                self._h.restore(leaves)
+            else:
+                offset = 0
+        
+        with open(self.filename, mode='rb') as prevH:
+            # The last checkpointed chunk is verified, as the
+            # contents could have been changed since then
+            if offset > 0:
+                prevH.seek(offset - self._h.chunkSize)
+                lastLeaf = newDigester(self._h.baseAlgorithm)
+                numLeft = self._h.chunkSize
+                while numLeft > 0:
+                    chunk = prevH.read(min(numLeft, MAX_DIGEST_BUFFER_SIZE))
+                    if len(chunk) == 0:
+                        break
+                    lastLeaf.update(chunk)
+                    numLeft -= len(chunk)
+                if lastLeaf.digest() != self._h.leaves[-1]:
+                    self._h.restore([])
+                    offset = 0
+                    prevH.seek(0)
+            
+            self.size = offset
+            buf = bytearray(adaptiveBufferSize(os.path.getsize(self.filename) - offset))
+            view = memoryview(buf)
+            numRead = prevH.readinto(buf)
+            while numRead > 0:
+                self._h.update(view[0:numRead])
+                self.size += numRead
+                numRead = prevH.readinto(buf)
+    
+    def _checkpoint(self) -> None:
+        # The contents are flushed before recording the state which covers them
+        self._f.flush()
+        self._resumeState['digest'] = {
+            'algorithm': self.digestAlgorithm,
+            'leaves': [ leaf.hex() for leaf in self._h.leaves ],
+        }
+        writeResumeState(self.filename, self._resumeState, self.resumeRoot)
+        self._numCheckpointed = len(self._h.leaves)
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, b) -> int:
+        try:
+            numWritten = self._f.write(b)
+        except:
+            # The digest would not match the contents
+            self._failed = True
+            raise
+        
+        self._h.update(memoryview(b)[0:numWritten])
+        self.size += numWritten
+        if (self._resumeState is not None) and (len(self._h.leaves) > self._numCheckpointed):
+            self._checkpoint()
+        return numWritten
+    
+    def flush(self) -> None:
+        # It is also called from close
+        if not self._f.closed:
+            self._f.flush()
+    
+    def digest(self) -> bytes:
+        return self._h.digest()
+    
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                self._f.close()
+                if self.mtime is not None:
+                    os.utime(self.filename, (self.mtime, self.mtime))
+                if not self._failed:
+                    registerFileDigest(self.filename, self._h.digest(), self.digestAlgorithm)
+            finally:
+                super().close()
+
+# Sidecar files with what is needed to resume interrupted downloads
+# (validators, sizes), which are removed once they are complete.
+# The ones of the files of mirrored directories are kept in a
+# directory next to the mirrored one, so they are never part of it
+RESUME_STATE_POSTFIX = '.resume.json'
+RESUME_STATE_DIR_POSTFIX = '.resume.d'
+
+def _resumeStateFilename(filename: Union[AbsPath, RelPath], resumeRoot: Optional[Union[AbsPath, RelPath]] = None) -> Union[AbsPath, RelPath]:
+    if resumeRoot is None:
+        return filename + RESUME_STATE_POSTFIX
+    
+    return os.path.join(resumeRoot + RESUME_STATE_DIR_POSTFIX, os.path.relpath(filename, resumeRoot) + RESUME_STATE_POSTFIX)
+
+def readResumeState(filename: Union[AbsPath, RelPath], resumeRoot: Optional[Union[AbsPath, RelPath]] = None) -> Optional[Mapping[str, Any]]:
+    try:
+        with open(_resumeStateFilename(filename, resumeRoot), mode='r', encoding='utf-8') as rH:
+            return json.load(rH)
+    except (OSError, ValueError):
+        return None
+
+def writeResumeState(filename: Union[AbsPath, RelPath], resumeState: Mapping[str, Any], resumeRoot: Optional[Union[AbsPath, RelPath]] = None) -> None:
+    resumeStateFilename = _resumeStateFilename(filename, resumeRoot)
+    if resumeRoot is not None:
+        os.makedirs(os.path.dirname(resumeStateFilename), exist_ok=True)
+    with open(resumeStateFilename, mode='w', encoding='utf-8') as rH:
+        json.dump(resumeState, rH)
+
+def sameResumeState(prevResumeState: Optional[Mapping[str, Any]], resumeState: Mapping[str, Any]) -> bool:
+    """
+    It tells whether a previous resume state was recorded for the
+    same remote contents, ignoring the checkpointed digest state
+    """
+    return (prevResumeState is not None) and all(map(lambda key: prevResumeState.get(key) == resumeState[key], resumeState.keys()))
+
+def clearResumeState(filename: Union[AbsPath, RelPath], resumeRoot: Optional[Union[AbsPath, RelPath]] = None) -> None:
+    try:
+        os.unlink(_resumeStateFilename(filename, resumeRoot))
+    except FileNotFoundError:
+        pass
+
+def clearResumeStates(resumeRoot: Union[AbsPath, RelPath]) -> None:
+    """
+    It removes the resume states of the files of a mirrored directory
+    """
+    shutil.rmtree(resumeRoot + RESUME_STATE_DIR_POSTFIX, ignore_errors=True)
+
+def copy2WithDigest(src: Union[AbsPath, RelPath], dst: Union[AbsPath, RelPath], digestAlgorithm: Optional[str] = None) -> Union[AbsPath, RelPath]:
+    """
+    Like shutil.copy2 (but for extended attributes), digesting
+    the contents while they are copied
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    
+    srcStat = os.stat(src)
+    with open(src, mode='rb') as fsrc, DigestingFile(dst, digestAlgorithm=digestAlgorithm) as fdst:
+        shutil.copyfileobj(fsrc, fdst)
+    # The digest is registered again, as it depends on the modification time
+    os.utime(dst, ns=(srcStat.st_atime_ns, srcStat.st_mtime_ns))
+    registerFileDigest(dst, fdst.digest(), fdst.digestAlgorithm)
+    shutil.copymode(src, dst)
+    
+    return dst
+
+# ioctl which shares the extents of a file with other one (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+def reflinkFile(src: Union[AbsPath, RelPath], dst: Union[AbsPath, RelPath]) -> bool:
+    """
+    It creates dst as a copy-on-write clone of src, keeping its
+    modification time and mode. It returns False when the
+    filesystem (or the platform) does not support it
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    
+    srcStat = os.stat(src)
+    try:
+        with open(src, mode='rb') as fsrc, open(dst, mode='wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        return False
+    
+    os.utime(dst, ns=(srcStat.st_atime_ns, srcStat.st_mtime_ns))
+    shutil.copymode(src, dst)
+    
+    return True
+
+def getReferenceStats(path: AbsPath) -> Mapping[str, Any]:
+    """
+    The path, size, modification time and inode of a file, or of
+    all the files within a directory, which tell whether contents
+    registered by reference have changed since then
+    """
+    def _entryStats(relPath: str, fileStat: os.stat_result) -> List[Any]:
+        return [ relPath, fileStat.st_size, fileStat.st_mtime_ns, fileStat.st_ino ]
+    
+    if os.path.isdir(path):
+        entries = sorted(map(lambda e: _entryStats(os.path.relpath(e.path, path), e.stat()), filter(lambda e: e.is_file(), scantree(path))))
+    else:
+        entries = [ _entryStats('', os.stat(path)) ]
+    
+    return {
+        'path': path,
+        'entries': entries
+    }
+
+def _ComputeTreeDigestFromFile(filename: Union[AbsPath, RelPath], fileSize: int, baseAlgorithm, chunkSize: int, bufferSize: int) -> bytes:
+    """
+    Chunks are read with os.pread and digested in parallel,
+    as hashlib releases the GIL
+    """
+    numChunks = (fileSize + chunkSize - 1) // chunkSize
+    with open(filename, mode='rb') as f:
+        fd = f.fileno()
+        def _digestChunk(iChunk: int) -> bytes:
+            h = newDigester(baseAlgorithm)
+            offset = iChunk * chunkSize
+            endOffset = min(fileSize, offset + chunkSize)
+            while offset < endOffset:
+                buf = os.pread(fd, min(bufferSize, endOffset - offset), offset)
+                if len(buf) == 0:
+                    raise WFException(f"File {filename} was truncated while it was being digested")
+                h.update(buf)
+                offset += len(buf)
+            
+            return h.digest()
+        
+        numWorkers = min(_DigestWorkers, numChunks)
+        if numWorkers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=numWorkers) as executor:
+                chunkDigests = list(executor.map(_digestChunk, range(numChunks)))
+        else:
+            chunkDigests = list(map(_digestChunk, range(numChunks)))
+    
+    root = newDigester(baseAlgorithm)
+    for chunkDigest in chunkDigests:
+        root.update(chunkDigest)
+    
+    return root.digest()
+
 @functools.lru_cache(maxsize=32)
-def ComputeDigestFromFile(filename: Union[AbsPath, RelPath], digestAlgorithm=DEFAULT_DIGEST_ALGORITHM, bufferSize: int = DEFAULT_DIGEST_BUFFER_SIZE, repMethod=stringifyDigest) -> Fingerprint:
+def _ComputeRawDigestsFromFile(filename: Union[AbsPath, RelPath], digestKey: Tuple[int, int, int, int], digestAlgorithms: Tuple[str, ...], bufferSize: Optional[int]) -> Tuple[bytes, ...]:
+    # digestKey is part of the memoization key, so changed files are digested again
+    fileSize = digestKey[2]
+    if bufferSize is None:
+        bufferSize = adaptiveBufferSize(fileSize)
+    
+    digests = {}
+    hashers = {}
+    for digestAlgorithm in digestAlgorithms:
+        treeAlgorithm = _parseTreeDigestAlgorithm(digestAlgorithm)
+        if treeAlgorithm is not None:
+            digests[digestAlgorithm] = _ComputeTreeDigestFromFile(filename, fileSize, *treeAlgorithm, bufferSize)
+        else:
+            hashers[digestAlgorithm] = newDigester(digestAlgorithm)
+    
+    # All the sequential digests are computed in a single read
+    if len(hashers) > 0:
+        buf = bytearray(bufferSize)
+        mv = memoryview(buf)
+        with open(filename, mode='rb', buffering=0) as f:
+            numRead = f.readinto(buf)
+            while numRead:
+                for h in hashers.values():
+                    h.update(mv[0:numRead])
+                numRead = f.readinto(buf)
+        
+        for digestAlgorithm, h in hashers.items():
+            digests[digestAlgorithm] = h.digest()
+    
+    return tuple(digests[digestAlgorithm] for digestAlgorithm in digestAlgorithms)
+
+class FileDigests(NamedTuple):
+    """
+    The raw digest of a file, along with the raw digests
+    from the extra algorithms computed in the same read
+    """
+    algorithm: str
+    digest: bytes
+    extra: Mapping[str, bytes]
+    
+    def represent(self, repMethod=stringifyDigest, digestAlgorithm=None) -> Union[Fingerprint, bytes]:
+        if (digestAlgorithm is None) or (digestAlgorithm == self.algorithm):
+            return repMethod(self.algorithm, self.digest)
+        
+        return repMethod(digestAlgorithm, self.extra[digestAlgorithm])
+    
+    @property
+    def fingerprint(self) -> Fingerprint:
+        return self.represent(stringifyDigest)
+    
+    @property
+    def filenameFingerprint(self) -> Fingerprint:
+        return self.represent(stringifyFilenameDigest)
+    
+    @property
+    def nih(self) -> Fingerprint:
+        return self.represent(nihDigest)
+
+def ComputeDigestsFromFile(filename: Union[AbsPath, RelPath], digestAlgorithm=DEFAULT_DIGEST_ALGORITHM, extraAlgorithms: Sequence[str] = [], bufferSize: Optional[int] = None) -> FileDigests:
+    """
+    Accessory method used to compute the digest of an input file, along with
+    the ones from extraAlgorithms, reading the file at most once (tree digests
+    apart). All the representations of the digests can be derived from the
+    result. Without bufferSize, it is chosen from the size of the file
+    """
+    digestAlgorithms = [ digestAlgorithm ]
+    for extraAlgorithm in extraAlgorithms:
+        if extraAlgorithm not in digestAlgorithms:
+            digestAlgorithms.append(extraAlgorithm)
+    
+    fStat = os.stat(filename)
+    digestKey = (fStat.st_dev, fStat.st_ino, fStat.st_size, fStat.st_mtime_ns)
+    digestStore = _DigestStore
+    if digestStore is None:
+        digests = {}
+        for algorithm in digestAlgorithms:
+            digest = _PrecomputedDigests.get((digestKey, algorithm))
+            if digest is not None:
+                digests[algorithm] = digest
+        
+        toCompute = tuple(filter(lambda algorithm: algorithm not in digests, digestAlgorithms))
+        if len(toCompute) > 0:
+            # Remembered, so later requests of any of these algorithms are not computed again
+            for algorithm, digest in zip(toCompute, _ComputeRawDigestsFromFile(filename, digestKey, toCompute, bufferSize)):
+                _rememberDigest(digestKey, algorithm, digest)
+                digests[algorithm] = digest
+    else:
+        # Strict mode needs actually reading the file
+        computeDigests = _ComputeRawDigestsFromFile.__wrapped__  if digestStore.strict  else  _ComputeRawDigestsFromFile
+        digests = digestStore.lookupMany(digestKey, digestAlgorithms, lambda toCompute: computeDigests(filename, digestKey, toCompute, bufferSize), filename=filename)
+    
+    return FileDigests(
+        algorithm=digestAlgorithm,
+        digest=digests[digestAlgorithm],
+        extra={ algorithm: digests[algorithm] for algorithm in digestAlgorithms[1:] }
+    )
+
+def ComputeDigestFromFile(filename: Union[AbsPath, RelPath], digestAlgorithm=DEFAULT_DIGEST_ALGORITHM, bufferSize: Optional[int] = None, repMethod=stringifyDigest) -> Fingerprint:
     """
     Accessory method used to compute the digest of an input file
     """
@@ -436,50 +1151,92 @@ def ComputeDigestFromFile(filename: Union[AbsPath, RelPath], digestAlgorithm=DEF
     if repMethod is None:
         return None
     
-    with open(filename, mode='rb') as f:
-        return ComputeDigestFromFileLike(f, digestAlgorithm, bufferSize, repMethod)
+    return ComputeDigestsFromFile(filename, digestAlgorithm, bufferSize=bufferSize).represent(repMethod)
+
+def _scandirOnce(path) -> Tuple[List[os.DirEntry], List[os.DirEntry]]:
+    """
+    It scans a directory only once, returning
+    both its non-directory entries and its subdirectories
+    """
+    entries = []
+    dirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            # We are avoiding to enter in loops around '.' and '..'
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name[0] != '.':
+                    dirs.append(entry)
+            else:
+                entries.append(entry)
+    
+    return entries, dirs
 
 def scantree(path):
     """Recursively yield DirEntry objects for given directory."""
+    
+    # Each directory is scanned once, and the recursion is replaced
+    # by a stack of pending subdirectories, keeping the order:
+    # the dirs are left to the end, each one followed by its contents
+    entries, dirs = _scandirOnce(path)
+    yield from entries
+    pending = [ iter(dirs) ]
+    while len(pending) > 0:
+        entry = next(pending[-1], None)
+        if entry is None:
+            pending.pop()
+            continue
+        
+        yield entry
+        entries, dirs = _scandirOnce(entry.path)
+        yield from entries
+        pending.append(iter(dirs))
 
-    hasDirs = False
-    for entry in os.scandir(path):
-        # We are avoiding to enter in loops around '.' and '..'
-        if entry.is_dir(follow_symlinks=False):
-            if entry.name[0] != '.':
-                hasDirs = True
-        else:
-            yield entry
-
-    # We are leaving the dirs to the end
-    if hasDirs:
-        for entry in os.scandir(path):
-            # We are avoiding to enter in loops around '.' and '..'
-            if entry.is_dir(follow_symlinks=False) and entry.name[0] != '.':
-                yield entry
-                yield from scantree(entry.path)
-
-def ComputeDigestFromDirectory(dirname: Union[AbsPath, RelPath], digestAlgorithm=DEFAULT_DIGEST_ALGORITHM, bufferSize: int = DEFAULT_DIGEST_BUFFER_SIZE, repMethod=stringifyDigest) -> Fingerprint:
+def ComputeDigestFromDirectory(dirname: Union[AbsPath, RelPath], digestAlgorithm=DEFAULT_DIGEST_ALGORITHM, bufferSize: Optional[int] = None, repMethod=stringifyDigest, numWorkers: Optional[int] = None, fileDigestAlgorithm=DEFAULT_DIGEST_ALGORITHM) -> Fingerprint:
     """
     Accessory method used to compute the digest of an input directory,
-    based on the names and digest of the files in the directory
+    based on the names and digest of the files in the directory.
+    Files are digested by numWorkers threads (see setDigestWorkers)
     """
-    cEntries = [ ]
-    # First, gather and compute all the files
-    for entry in scantree(dirname):
-        if entry.is_file():
-            cEntries.append(
-                (
-                    os.path.relpath(entry.path, dirname).encode('utf-8'),
-                    ComputeDigestFromFile(entry.path, repMethod=nullProcessDigest)
-                )
-            )
+    if numWorkers is None:
+        numWorkers = _DigestWorkers
     
+    # Files are digested with the default algorithm by default,
+    # whichever is the one of the directory, so fingerprints are kept
+    def _digestFile(filename):
+        return ComputeDigestFromFile(filename, digestAlgorithm=fileDigestAlgorithm, bufferSize=bufferSize, repMethod=nullProcessDigest)
+    
+    cRelPaths = [ ]
+    cDigests = [ ]
+    # First, gather and compute all the files. They are digested
+    # while the tree is walked, as hashlib releases the GIL
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=numWorkers)  if numWorkers > 1  else None
+    try:
+        for entry in scantree(dirname):
+            if entry.is_file():
+                cRelPaths.append(os.path.relpath(entry.path, dirname).encode('utf-8'))
+                if executor is None:
+                    cDigests.append(_digestFile(entry.path))
+                else:
+                    cDigests.append(executor.submit(_digestFile, entry.path))
+        
+        if executor is not None:
+            cDigests = [ future.result() for future in cDigests ]
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+    
+    return _digestDirectoryEntries(list(zip(cRelPaths, cDigests)), digestAlgorithm, repMethod)
+
+def _digestDirectoryEntries(cEntries: List[Tuple[bytes, bytes]], digestAlgorithm=DEFAULT_DIGEST_ALGORITHM, repMethod=stringifyDigest) -> Fingerprint:
+    """
+    Digest of a directory from the relative paths (bytes encoded in utf-8)
+    and the raw digests of all the files below it
+    """
     # Second, sort by the relative path, bytes encoded in utf-8
     cEntries.sort(key=lambda e: e[0])
     
     # Third, digest compute
-    h = hashlib.new(digestAlgorithm)
+    h = newDigester(digestAlgorithm)
     for cRelPathB , cDigest in cEntries:
         h.update(cRelPathB)
         h.update(cDigest)
@@ -508,16 +1265,34 @@ def ComputeDigestFromGeneratedContentList(
                 )
             )
     
-    # Second, sort by the relative path, bytes encoded in utf-8
-    cEntries.sort(key=lambda e: e[0])
+    return _digestDirectoryEntries(cEntries, digestAlgorithm, repMethod)
+
+def _merkleNodeDigest(merkleChildren: List[Tuple[bytes, bool, bytes]], digestAlgorithm=DEFAULT_DIGEST_ALGORITHM) -> bytes:
+    """
+    Raw digest of the Merkle tree node of a directory, from the utf-8
+    encoded names, kinds (is it a directory?) and raw digests of its children
+    """
+    h = newDigester(digestAlgorithm)
+    for nameB, isDir, digest in sorted(merkleChildren, key=lambda c: c[0]):
+        h.update(b'd'  if isDir  else  b'f')
+        # Names cannot contain NUL characters
+        h.update(nameB)
+        h.update(b'\0')
+        h.update(digest)
     
-    # Third, digest compute
-    h = hashlib.new(digestAlgorithm)
-    for cRelPathB , cDigest in cEntries:
-        h.update(cRelPathB)
-        h.update(cDigest)
+    return h.digest()
+
+def _merkleDigestFromGeneratedContentList(theValues: List[AbstractGeneratedContent], digestAlgorithm=DEFAULT_DIGEST_ALGORITHM) -> bytes:
+    merkleChildren = []
+    for theValue in theValues:
+        nameB = os.path.basename(theValue.local).encode('utf-8')
+        if isinstance(theValue, GeneratedContent):
+            # Unchanged files are not read again, as their digests are remembered
+            merkleChildren.append((nameB, False, ComputeDigestsFromFile(theValue.local).digest))
+        elif isinstance(theValue, GeneratedDirectoryContent):
+            merkleChildren.append((nameB, True, _merkleDigestFromGeneratedContentList(theValue.values, digestAlgorithm)))
     
-    return repMethod(digestAlgorithm, h.digest())
+    return _merkleNodeDigest(merkleChildren, digestAlgorithm)
 
 def GetGeneratedDirectoryContent(
     thePath: AbsPath,
@@ -529,37 +1304,114 @@ def GetGeneratedDirectoryContent(
     The signatureMethod tells whether to generate a signature and fill-in
     the new signature element from GeneratedDirectoryContent tuple
     """
-    theValues = []
+    # Files are digested by a pool of threads (see setDigestWorkers)
+    if callable(signatureMethod) and (_DigestWorkers > 1):
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=_DigestWorkers)
+    else:
+        executor = None
+    
+    try:
+        theContent , _ , _ = _getGeneratedDirectoryContent(thePath, uri, preferredFilename, signatureMethod, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+    
+    return theContent
+
+def _getGeneratedDirectoryContent(
+    thePath: AbsPath,
+    uri: Optional[URIType],
+    preferredFilename: Optional[RelPath],
+    signatureMethod,
+    executor: Optional[concurrent.futures.Executor] = None
+) -> Tuple[GeneratedDirectoryContent, Optional[bytes], List[Tuple[RelPath, bytes]]]:
+    """
+    Single bottom-up pass. Besides the content, it returns the raw digest
+    of the Merkle tree node of the directory, and the relative paths and
+    raw digests of all the files below it (the same ones gathered by
+    ComputeDigestFromDirectory), so the signatures of the parent
+    directory are built from them, without digesting any file again
+    """
+    doSign = callable(signatureMethod)
+    
+    # Values are kept in the order they were found, as
+    # (name, is it hidden?, file digests or a future of them, directory value, Merkle node digest)
+    pending = []
+    # Relative paths and raw digests of the files below this directory
+    fileEntries = []
     with os.scandir(thePath) as itEntries:
         for entry in itEntries:
-            # Hidden files are skipped by default
-            if not entry.name.startswith('.'):
-                theValue = None
-                if entry.is_file():
-                    theValue = GeneratedContent(
-                        local=entry.path,
-                        # uri=None, 
-                        signature=ComputeDigestFromFile(entry.path, repMethod=signatureMethod)
-                    )
-                elif entry.is_dir():
-                    theValue = GetGeneratedDirectoryContent(entry.path, repMethod=signatureMethod)
-
-                if theValue is not None:
-                    theValues.append(theValue)
+            isHidden = entry.name.startswith('.')
+            if entry.is_dir(follow_symlinks=False):
+                # Hidden directories are skipped by default
+                if not isHidden:
+                    theValue , merkleDigest , childFileEntries = _getGeneratedDirectoryContent(entry.path, None, None, signatureMethod, executor)
+                    pending.append((entry.name, isHidden, None, theValue, merkleDigest))
+                    fileEntries.extend(map(lambda fe: (os.path.join(entry.name, fe[0]), fe[1]), childFileEntries))
+            elif entry.is_file():
+                # Hidden files are not listed, but they are part of the signature
+                if not doSign:
+                    fileDigests = None
+                elif executor is not None:
+                    fileDigests = executor.submit(ComputeDigestsFromFile, entry.path)
+                else:
+                    fileDigests = ComputeDigestsFromFile(entry.path)
+                pending.append((entry.name, isHidden, fileDigests, None, None))
+            elif entry.is_dir() and not isHidden:
+                # Symbolic links to directories are listed,
+                # but they are not part of the signature
+                theValue , merkleDigest , _ = _getGeneratedDirectoryContent(entry.path, None, None, signatureMethod, executor)
+                pending.append((entry.name, isHidden, None, theValue, merkleDigest))
+    
+    theValues = []
+    merkleChildren = []
+    for name, isHidden, fileDigests, theValue, merkleDigest in pending:
+        if theValue is None:
+            if isinstance(fileDigests, concurrent.futures.Future):
+                fileDigests = fileDigests.result()
+            
+            if fileDigests is not None:
+                fileEntries.append((name, fileDigests.digest))
+            
+            if isHidden:
+                continue
+            
+            if fileDigests is not None:
+                merkleChildren.append((name.encode('utf-8'), False, fileDigests.digest))
+                signature = fileDigests.represent(signatureMethod)
+            else:
+                signature = None
+            theValue = GeneratedContent(
+                local=os.path.join(thePath, name),
+                # uri=None, 
+                signature=signature
+            )
+        elif merkleDigest is not None:
+            merkleChildren.append((name.encode('utf-8'), True, merkleDigest))
+        
+        theValues.append(theValue)
     
     # As this is a heavy operation, do it only when it is requested
-    if callable(signatureMethod):
-        signature = ComputeDigestFromDirectory(thePath, repMethod=signatureMethod)
+    if doSign:
+        # Same signature as ComputeDigestFromDirectory
+        signature = _digestDirectoryEntries(list(map(lambda fe: (fe[0].encode('utf-8'), fe[1]), fileEntries)), repMethod=signatureMethod)
+        # The Merkle tree node is built from the digests of the children,
+        # so a change only affects the nodes from the changed file to the root
+        merkleDigest = _merkleNodeDigest(merkleChildren)
+        merkleSignature = signatureMethod(DEFAULT_DIGEST_ALGORITHM, merkleDigest)
     else:
         signature = None
+        merkleDigest = None
+        merkleSignature = None
     
     return GeneratedDirectoryContent(
         local=thePath,
         uri=uri,
         preferredFilename=preferredFilename,
         values=theValues,
-        signature=signature
-    )
+        signature=signature,
+        merkleSignature=merkleSignature
+    ), merkleDigest, fileEntries
 
 def GetGeneratedDirectoryContentFromList(
     thePath: AbsPath,
@@ -576,15 +1428,18 @@ def GetGeneratedDirectoryContentFromList(
     # As this is a heavy operation, do it only when it is requested
     if callable(signatureMethod):
         signature = ComputeDigestFromGeneratedContentList(thePath, theValues, repMethod=signatureMethod)
+        merkleSignature = signatureMethod(DEFAULT_DIGEST_ALGORITHM, _merkleDigestFromGeneratedContentList(theValues))
     else:
         signature = None
+        merkleSignature = None
     
     return GeneratedDirectoryContent(
         local=thePath,
         uri=uri,
         preferredFilename=preferredFilename,
         values=theValues,
-        signature=signature
+        signature=signature,
+        merkleSignature=merkleSignature
     )
 
 
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2020-2021 Barcelona Supercomputing Center (BSC), Spain
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from typing import Callable, Mapping, Optional, Sequence, Tuple
+
+from .common import *
+
+# (device, inode, size, modification time in nanoseconds)
+DigestKey = Tuple[int, int, int, int]
+
+class DigestStore:
+    """
+    Persistent store of the digests of files, shared among processes.
+    Entries are keyed by device, inode, size, modification time and
+    algorithm, so any change in a file leads to a new entry.
+    """
+    DEFAULT_FILENAME = 'file_digests.sqlite3'
+    
+    # Time to wait for other processes holding a lock on the database
+    DEFAULT_LOCK_TIMEOUT = 60
+    
+    DEFAULT_MAX_ENTRIES = 1000000
+    
+    # Number of new entries between checks of the size of the store
+    EVICTION_CHECK_INTERVAL = 1000
+    
+    # Accesses are recorded in batches, so lookups do not take the write lock
+    ACCESS_FLUSH_INTERVAL = 256
+    
+    SCHEMA_VERSION = 1
+    SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_digest (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (dev, ino, size, mtime_ns, algorithm)
+);
+CREATE INDEX IF NOT EXISTS idx_file_digest_last_access ON file_digest(last_access);
+"""
+
+    def __init__(self, dbFilename:AbsPath, maxEntries:Optional[int]=DEFAULT_MAX_ENTRIES, policy:CacheGCPolicy=DEFAULT_CACHE_GC_POLICY, strict:bool=False, lockTimeout:float=DEFAULT_LOCK_TIMEOUT):
+        # Getting a logger focused on specific classes
+        import inspect
+        
+        self.logger = logging.getLogger(dict(inspect.getmembers(self))['__module__'] + '::' + self.__class__.__name__)
+        
+        self.dbFilename = dbFilename
+        self.maxEntries = maxEntries
+        self.policy = policy
+        # In strict mode, stored digests are only used to verify the computed ones
+        self.strict = strict
+        self.lockTimeout = lockTimeout
+        
+        # sqlite3 connections cannot be shared among threads,
+        # so each thread gets its own one
+        self._conns = ThreadConnections(self._connect)
+        self._countersLock = threading.Lock()
+        self._newEntries = 0
+        # Pending access statistics, by key and algorithm
+        self._pendingAccesses = dict()
+        
+        try:
+            self._checkSchema(self.conn)
+        except sqlite3.OperationalError as oe:
+            raise WFException(f'Unable to open digest store {self.dbFilename}: {oe}')
+        except sqlite3.DatabaseError as de:
+            # A corrupted store is just thrown away, as it is only a cache
+            self.logger.warning(f'Digest store {self.dbFilename} is corrupted ({de}). Recreating it')
+            self.close()
+            os.unlink(self.dbFilename)
+            self._checkSchema(self.conn)
+    
+    def _connect(self) -> sqlite3.Connection:
+        # The default rollback journal is used instead of WAL,
+        # as WAL does not work on network filesystems
+        conn = sqlite3.connect(self.dbFilename, timeout=self.lockTimeout, check_same_thread=False)
+        # It is only a cache, so durability is not needed
+        conn.execute('PRAGMA synchronous = OFF')
+        return conn
+    
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return self._conns.get()
+    
+    def _checkSchema(self, conn:sqlite3.Connection) -> None:
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            conn.execute('DROP TABLE IF EXISTS file_digest')
+            conn.executescript(self.SCHEMA)
+            conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+            conn.commit()
+    
+    def close(self) -> None:
+        self.flush()
+        self._conns.closeAll()
+    
+    def get(self, digestKey:DigestKey, digestAlgorithm:str) -> Optional[bytes]:
+        # A plain read, which does not open a transaction
+        row = self.conn.execute(
+            'SELECT digest FROM file_digest WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ? AND algorithm = ?',
+            (*digestKey, digestAlgorithm)
+        ).fetchone()
+        if row is None:
+            return None
+        
+        with self._countersLock:
+            accessKey = (*digestKey, digestAlgorithm)
+            _, hits = self._pendingAccesses.get(accessKey, (None, 0))
+            self._pendingAccesses[accessKey] = (time.time(), hits + 1)
+            doFlush = len(self._pendingAccesses) >= self.ACCESS_FLUSH_INTERVAL
+        
+        if doFlush:
+            self.flush()
+        
+        return row[0]
+    
+    def flush(self) -> None:
+        """
+        It records the pending access statistics in a single transaction
+        """
+        with self._countersLock:
+            pendingAccesses = self._pendingAccesses
+            self._pendingAccesses = dict()
+        
+        if len(pendingAccesses) == 0:
+            return
+        
+        with self.conn:
+            self.conn.executemany(
+                'UPDATE file_digest SET last_access = MAX(last_access, ?), hits = hits + ? WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ? AND algorithm = ?',
+                [ (lastAccess, hits, *accessKey)  for accessKey, (lastAccess, hits) in pendingAccesses.items() ]
+            )
+    
+    def put(self, digestKey:DigestKey, digestAlgorithm:str, digest:bytes) -> None:
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO file_digest (dev, ino, size, mtime_ns, algorithm, digest, last_access) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (*digestKey, digestAlgorithm, digest, time.time())
+            )
+        
+        with self._countersLock:
+            self._newEntries += 1
+            doEvict = self._newEntries >= self.EVICTION_CHECK_INTERVAL
+            if doEvict:
+                self._newEntries = 0
+        
+        if doEvict:
+            self.evict()
+    
+    def lookup(self, digestKey:DigestKey, digestAlgorithm:str, computeDigest:Callable[[], bytes], filename:Optional[AbsPath]=None) -> bytes:
+        """
+        It returns the stored digest, or the computed one, which is stored.
+        In strict mode the digest is always computed, and a warning is
+        emitted when it does not match the stored one
+        """
+        return self.lookupMany(digestKey, [ digestAlgorithm ], lambda algorithms: [ computeDigest() ], filename=filename)[digestAlgorithm]
+    
+    def lookupMany(self, digestKey:DigestKey, digestAlgorithms:Sequence[str], computeDigests:Callable[[Tuple[str, ...]], Sequence[bytes]], filename:Optional[AbsPath]=None) -> Mapping[str, bytes]:
+        """
+        Like lookup, but for several algorithms. The digests which
+        have to be computed are requested in a single call, so the
+        file is read only once
+        """
+        digests = {}
+        for digestAlgorithm in digestAlgorithms:
+            digest = self.get(digestKey, digestAlgorithm)
+            if digest is not None:
+                digests[digestAlgorithm] = digest
+        
+        if self.strict:
+            toCompute = tuple(digestAlgorithms)
+        else:
+            toCompute = tuple(filter(lambda digestAlgorithm: digestAlgorithm not in digests, digestAlgorithms))
+        
+        if len(toCompute) > 0:
+            for digestAlgorithm, computedDigest in zip(toCompute, computeDigests(toCompute)):
+                digest = digests.get(digestAlgorithm)
+                if digest != computedDigest:
+                    if digest is not None:
+                        self.logger.warning(f'Stored {digestAlgorithm} digest of {filename} does not match its contents, which were changed keeping size and modification time')
+                    self.put(digestKey, digestAlgorithm, computedDigest)
+                    digests[digestAlgorithm] = computedDigest
+        
+        return digests
+    
+    def evict(self) -> int:
+        """
+        Following either LRU or LFU policy, it removes the entries
+        above maxEntries, returning the number of removed ones
+        """
+        if self.maxEntries is None:
+            return 0
+        
+        # So the policy sees the latest accesses
+        self.flush()
+        with self.conn:
+            numEntries = self.conn.execute('SELECT COUNT(*) FROM file_digest').fetchone()[0]
+            numEvicted = numEntries - self.maxEntries
+            if numEvicted <= 0:
+                return 0
+            
+            if self.policy == CacheGCPolicy.LFU:
+                order = 'hits, last_access'
+            else:
+                order = 'last_access'
+            self.conn.execute(f'DELETE FROM file_digest WHERE rowid IN (SELECT rowid FROM file_digest ORDER BY {order} LIMIT ?)', (numEvicted,))
+        
+        self.logger.debug(f'Evicted {numEvicted} entries from digest store {self.dbFilename}')
+        return numEvicted
@@ -17,6 +17,9 @@
 
 from __future__ import absolute_import
 
+import concurrent.futures
+import contextlib
+import hashlib
 import http.client
 import io
 import logging
@@ -25,16 +28,350 @@ import paramiko
 import paramiko.pkey
 from paramiko.config import SSH_PORT as DEFAULT_SSH_PORT
 
+import queue
+import re
 import shutil
 import stat
+import threading
 
-from typing import Any, List, Optional, Tuple, Union
+from typing import Any, Callable, Hashable, Iterator, List, Optional, Tuple, Union
 
 from urllib import request, parse
 import urllib.error
 
 from ..common import *
-from ..utils.ftp_downloader import FTPDownloader
+from ..session_pool import SessionPool
+from ..utils.ftp_downloader import ByteRateLimiter, FTPDownloader
+
+logger = logging.getLogger(__name__)
+
+# Number of times an interrupted download is resumed within the same fetch
+DEFAULT_RESUME_RETRIES = 3
+CONTENT_RANGE_PATTERN = re.compile(r'^bytes\s+([0-9]+)-([0-9]+)/([0-9]+|\*)$')
+
+# Large files from servers accepting range requests are fetched
+# through several concurrent ones, each one of a chunk of the file
+DEFAULT_PARALLEL_DOWNLOAD_STREAMS = 4
+DEFAULT_PARALLEL_DOWNLOAD_CHUNK_SIZE = 64 * 1024 * 1024
+DEFAULT_PARALLEL_DOWNLOAD_MIN_SIZE = 256 * 1024 * 1024
+PARALLEL_DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+
+_ParallelDownloadStreams = DEFAULT_PARALLEL_DOWNLOAD_STREAMS
+_ParallelDownloadChunkSize = DEFAULT_PARALLEL_DOWNLOAD_CHUNK_SIZE
+_ParallelDownloadMinSize = DEFAULT_PARALLEL_DOWNLOAD_MIN_SIZE
+
+def setParallelDownloads(streams: int = DEFAULT_PARALLEL_DOWNLOAD_STREAMS, chunkSize: int = DEFAULT_PARALLEL_DOWNLOAD_CHUNK_SIZE, minSize: int = DEFAULT_PARALLEL_DOWNLOAD_MIN_SIZE) -> None:
+    """
+    Number of concurrent range requests, size of the chunks and minimum
+    size of the files fetched that way. With 1 stream it is disabled
+    """
+    global _ParallelDownloadStreams
+    global _ParallelDownloadChunkSize
+    global _ParallelDownloadMinSize
+    
+    _ParallelDownloadStreams = max(1, streams)
+    _ParallelDownloadChunkSize = max(PARALLEL_DOWNLOAD_BUFFER_SIZE, chunkSize)
+    _ParallelDownloadMinSize = minSize
+
+# Directories from ftp servers are mirrored through several connections,
+# optionally limiting the bytes per second fetched among all of them
+DEFAULT_FTP_CONNECTIONS = FTPDownloader.DEFAULT_MAX_CONNECTIONS
+
+_FTPConnections = DEFAULT_FTP_CONNECTIONS
+_FTPRateLimiter = None
+
+def setFTPDownloads(connections: int = DEFAULT_FTP_CONNECTIONS, maxRate: Optional[int] = None) -> None:
+    """
+    Number of connections used to mirror an ftp directory, and
+    global limit of bytes per second fetched from ftp servers
+    """
+    global _FTPConnections
+    global _FTPRateLimiter
+    
+    _FTPConnections = max(1, connections)
+    _FTPRateLimiter = ByteRateLimiter(maxRate)  if maxRate  else  None
+
+# How local files are materialized in the cache. 'auto' tries a
+# copy-on-write clone, and then a copy. Hard links share the inode with
+# the original files, so in place changes would alter the cached contents
+# unnoticed, and they are only used on request. 'reference' does not
+# copy them, keeping a symlink validated on reuse
+FILE_STRATEGIES = ('auto', 'reflink', 'hardlink', 'copy', 'reference')
+DEFAULT_FILE_STRATEGY = 'auto'
+
+_FileStrategy = DEFAULT_FILE_STRATEGY
+
+def setFileStrategy(strategy: str = DEFAULT_FILE_STRATEGY) -> None:
+    """
+    It sets how the contents of file URIs are materialized in the cache
+    """
+    global _FileStrategy
+    
+    if strategy not in FILE_STRATEGIES:
+        raise WFException(f"Unknown strategy {strategy} for local files. Valid ones are {', '.join(FILE_STRATEGIES)}")
+    
+    _FileStrategy = strategy
+
+# Pool of http connections, ssh transports and ftp clients
+# shared by the fetchers. Without it, each fetch opens its own
+_SessionPool = None
+_PooledOpener = None
+
+def setSessionPool(sessionPool: Optional[SessionPool]) -> None:
+    """
+    It sets up the session pool used by the fetchers. None disables it
+    """
+    global _SessionPool
+    global _PooledOpener
+    
+    _SessionPool = sessionPool
+    _PooledOpener = None  if sessionPool is None  else  request.build_opener(KeepAliveHTTPHandler, KeepAliveHTTPSHandler)
+
+def getSessionPool() -> Optional[SessionPool]:
+    """
+    The session pool currently used by the fetchers
+    """
+    return _SessionPool
+
+@contextlib.contextmanager
+def _pooledSession(key:Hashable, connect:Callable[[], Any], closeSession:Callable[[Any], None], validate:Optional[Callable[[Any], bool]]=None) -> Iterator[Any]:
+    """
+    A session from the pool, or a new one which
+    is closed afterwards when there is no pool
+    """
+    sessionPool = _SessionPool
+    if sessionPool is not None:
+        with sessionPool.session(key, connect, closeSession, validate=validate) as session:
+            yield session
+    else:
+        session = connect()
+        try:
+            yield session
+        finally:
+            closeSession(session)
+
+def _credentialsKey(*credentials:Optional[str]) -> str:
+    """
+    Pooled sessions are keyed by a digest of their credentials
+    """
+    h = hashlib.sha256()
+    for credential in credentials:
+        h.update(b'\0' if credential is None else credential.encode('utf-8') + b'\1')
+    return h.hexdigest()
+
+class _PooledHTTPResponse(http.client.HTTPResponse):
+    """
+    Response which returns its connection to the pool when it is
+    closed, as long as its body was completely read
+    """
+    _poolRelease = None
+    
+    def close(self):
+        # The body was completely read when the connection was detached
+        eof = self.fp is None
+        super().close()
+        poolRelease = self._poolRelease
+        if poolRelease is not None:
+            self._poolRelease = None
+            poolRelease(eof and not self.will_close)
+
+def _closeHTTPConnection(conn:http.client.HTTPConnection) -> None:
+    conn.close()
+
+class _KeepAliveHandlerMixin:
+    """
+    It replaces AbstractHTTPHandler.do_open, so connections are
+    kept alive and reused from the session pool
+    """
+    def do_open(self, http_class, req, **http_conn_args):
+        sessionPool = _SessionPool
+        # Connections through proxy tunnels are not pooled
+        if (sessionPool is None) or req._tunnel_host:
+            return super().do_open(http_class, req, **http_conn_args)
+        
+        host = req.host
+        if not host:
+            raise urllib.error.URLError('no host given')
+        
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items()
+                        if k not in headers})
+        headers["Connection"] = "keep-alive"
+        headers = {name.title(): val for name, val in headers.items()}
+        
+        def connect() -> http.client.HTTPConnection:
+            conn = http_class(host, timeout=req.timeout, **http_conn_args)
+            conn.set_debuglevel(self._debuglevel)
+            conn.response_class = _PooledHTTPResponse
+            return conn
+        
+        key = (host, req.type)
+        while True:
+            conn, reused = sessionPool.acquire(key, connect, _closeHTTPConnection)
+            try:
+                try:
+                    conn.request(req.get_method(), req.selector, req.data, headers,
+                              encode_chunked=req.has_header('Transfer-encoding'))
+                except OSError as err: # timeout error
+                    raise urllib.error.URLError(err)
+                r = conn.getresponse()
+            except Exception as e:
+                sessionPool.release(key, conn, _closeHTTPConnection, reusable=False)
+                # The server could have closed the idle connection
+                if reused and (req.data is None) and isinstance(getattr(e, 'reason', e), ConnectionError):
+                    continue
+                raise
+            break
+        
+        r._poolRelease = lambda reusable: sessionPool.release(key, conn, _closeHTTPConnection, reusable=reusable)
+        r.url = req.get_full_url()
+        r.msg = r.reason
+        return r
+
+class KeepAliveHTTPHandler(_KeepAliveHandlerMixin, request.HTTPHandler):
+    pass
+
+class KeepAliveHTTPSHandler(_KeepAliveHandlerMixin, request.HTTPSHandler):
+    pass
+
+def _urlopen(req:request.Request):
+    """
+    request.urlopen, through pooled connections when there is a session pool
+    """
+    opener = _PooledOpener
+    if opener is None:
+        return request.urlopen(req)
+    return opener.open(req)
+
+def _fetchChunk(remote_file:URIType, orig_remote_file:URIType, headers:Mapping[str, str], validator:str, fd:int, start:int, end:int) -> None:
+    """
+    It fetches the bytes from start to end (both included) with a range
+    request, writing them at their offset with os.pwrite
+    """
+    req_headers = dict(headers)
+    req_headers['Range'] = f'bytes={start}-{end}'
+    req_headers['If-Range'] = validator
+    req_remote = request.Request(remote_file, headers=req_headers)
+    try:
+        url_response = _urlopen(req_remote)
+    except urllib.error.HTTPError as he:
+        # Its pooled connection is given back right now, instead
+        # of waiting for the traceback to be collected
+        he.close()
+        raise
+    
+    with url_response:
+        contentRange = CONTENT_RANGE_PATTERN.search(url_response.headers.get('Content-Range', ''))
+        if (url_response.status != 206) or (contentRange is None) or (int(contentRange.group(1)) != start):
+            raise WFException(f"Content from {orig_remote_file} changed while it was fetched in chunks")
+        
+        buf = bytearray(PARALLEL_DOWNLOAD_BUFFER_SIZE)
+        view = memoryview(buf)
+        offset = start
+        while offset <= end:
+            numRead = url_response.readinto(view[0:min(len(buf), end + 1 - offset)])
+            if numRead == 0:
+                raise http.client.IncompleteRead(b'', end + 1 - offset)
+            numWritten = 0
+            while numWritten < numRead:
+                numWritten += os.pwrite(fd, view[numWritten:numRead], offset + numWritten)
+            offset += numRead
+
+def _fetchChunksParallel(remote_file:URIType, orig_remote_file:URIType, headers:Mapping[str, str], cachedFilename:AbsPath, totalSize:int, validator:str, resumeState:Optional[Mapping[str, Any]]=None) -> None:
+    """
+    The file is preallocated, and its chunks are fetched through concurrent
+    range requests. The fetched chunks are recorded in the resume state,
+    so an interrupted download only fetches the missing ones. Chunks are
+    digested in order, while the next ones are being fetched
+    """
+    chunkSize = _ParallelDownloadChunkSize
+    fetchedChunks = set()
+    if (resumeState is not None) and (resumeState.get('chunkSize') is not None) and os.path.isfile(cachedFilename) and (os.path.getsize(cachedFilename) == totalSize):
+        chunkSize = resumeState['chunkSize']
+        fetchedChunks.update(resumeState.get('chunks', []))
+    else:
+        with open(cachedFilename, mode='wb') as pH:
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(pH.fileno(), 0, totalSize)
+                except OSError:
+                    # Not supported by the filesystem
+                    os.ftruncate(pH.fileno(), totalSize)
+            else:
+                os.ftruncate(pH.fileno(), totalSize)
+    
+    numChunks = (totalSize + chunkSize - 1) // chunkSize
+    resumeState = {
+        'uri': orig_remote_file,
+        'validator': validator,
+        'size': totalSize,
+        'chunkSize': chunkSize,
+        'chunks': sorted(fetchedChunks),
+    }
+    writeResumeState(cachedFilename, resumeState)
+    if len(fetchedChunks) > 0:
+        logger.info(f"Resuming download of {orig_remote_file} ({len(fetchedChunks)} of {numChunks} chunks already fetched)")
+    
+    digestAlgorithm = getInternalDigestAlgorithm()
+    h = newDigester(digestAlgorithm)
+    nextToDigest = 0
+    
+    def digestFetchedChunks() -> None:
+        # The contiguous fetched chunks are digested
+        nonlocal nextToDigest
+        while nextToDigest in fetchedChunks:
+            offset = nextToDigest * chunkSize
+            endOffset = min(totalSize, offset + chunkSize)
+            while offset < endOffset:
+                digestBuf = os.pread(fd, min(PARALLEL_DOWNLOAD_BUFFER_SIZE, endOffset - offset), offset)
+                if len(digestBuf) == 0:
+                    raise WFException(f"File {cachedFilename} was truncated while it was being fetched")
+                h.update(digestBuf)
+                offset += len(digestBuf)
+            nextToDigest += 1
+    
+    fd = os.open(cachedFilename, os.O_RDWR)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=_ParallelDownloadStreams) as executor:
+            futures = dict()
+            for iChunk in range(numChunks):
+                if iChunk not in fetchedChunks:
+                    futures[executor.submit(_fetchChunk, remote_file, orig_remote_file, headers, validator, fd, iChunk * chunkSize, min(totalSize, (iChunk + 1) * chunkSize) - 1)] = iChunk
+            
+            # Chunks fetched by previous attempts
+            digestFetchedChunks()
+            
+            failure = None
+            for future in concurrent.futures.as_completed(futures):
+                if future.cancelled():
+                    continue
+                if future.exception() is not None:
+                    # Pending chunks are not fetched, but the
+                    # ones being fetched are still recorded
+                    if failure is None:
+                        failure = future.exception()
+                        for pendingFuture in futures.keys():
+                            pendingFuture.cancel()
+                    continue
+                
+                fetchedChunks.add(futures[future])
+                resumeState['chunks'] = sorted(fetchedChunks)
+                writeResumeState(cachedFilename, resumeState)
+                
+                digestFetchedChunks()
+            
+            if failure is not None:
+                raise failure
+            
+            digestFetchedChunks()
+    finally:
+        os.close(fd)
+    
+    # The digest has to cover the whole file
+    if nextToDigest != numChunks:
+        raise WFException(f"Only {nextToDigest} of {numChunks} chunks from {orig_remote_file} were digested")
+    
+    registerFileDigest(cachedFilename, h.digest(), digestAlgorithm)
 
 class AbstractStatefulFetcher(abc.ABC):
     """
@@ -56,7 +393,11 @@ class AbstractStatefulFetcher(abc.ABC):
 
 def fetchClassicURL(remote_file:URIType, cachedFilename:Union[AbsPath, io.BytesIO], secContext:Optional[SecurityContextConfig]=None) -> Tuple[Union[URIType, ContentKind], List[URIWithMetadata]]:
     """
-    Method to fetch contents from http, https and ftp
+    Method to fetch contents from http, https and ftp. Interrupted
+    downloads to files are resumed through range requests, either in this
+    call or in a later one, as long as the validator (strong ETag or
+    Last-Modified) kept in the resume state still matches. Large files
+    are fetched through concurrent range requests, when it is possible
 
     :param remote_file:
     :param cachedFilename:
@@ -90,32 +431,112 @@ def fetchClassicURL(remote_file:URIType, cachedFilename:Union[AbsPath, io.BytesI
     # Preparing where it is going to be written
     if isinstance(cachedFilename, (io.TextIOBase, io.BufferedIOBase, io.RawIOBase, io.IOBase)):
         download_file = cachedFilename
+        resumable = False
     else:
-        download_file = open(cachedFilename, 'wb')
+        download_file = None
+        # Resumed downloads are not mixed with conditional requests
+        resumable = (method in (None, 'GET')) and all(map(lambda header: header.lower() not in ('if-none-match', 'if-modified-since'), headers.keys()))
     
     uri_with_metadata = None
-    try:
-        req_remote = request.Request(remote_file, headers=headers, method=method)
-        with request.urlopen(req_remote) as url_response:
-            
-            uri_with_metadata = URIWithMetadata(url_response.url, dict(url_response.headers.items()))
-            
-            while True:
-                try:
-                    # Try getting it
-                    shutil.copyfileobj(url_response, download_file)
-                except http.client.IncompleteRead as icread:
-                    download_file.write(icread.partial)
-                    # Restarting the copy
-                    continue
-                break
-            
-    except urllib.error.HTTPError as he:
-        raise WFException("Error fetching {} : {} {}".format(orig_remote_file, he.code, he.reason))
-    finally:
-        # Closing files opened by this code
-        if download_file != cachedFilename:
-            download_file.close()
+    retries = DEFAULT_RESUME_RETRIES
+    while True:
+        req_headers = dict(headers)
+        offset = 0
+        resumeState = None
+        if resumable and os.path.isfile(cachedFilename):
+            resumeState = readResumeState(cachedFilename)
+            if (resumeState is not None) and (resumeState.get('uri') != orig_remote_file):
+                resumeState = None
+            # Downloads fetched in chunks are resumed once the validator is checked
+            if (resumeState is not None) and (resumeState.get('chunkSize') is None):
+                offset = os.path.getsize(cachedFilename)
+                if offset > 0:
+                    req_headers['Range'] = f'bytes={offset}-'
+                    req_headers['If-Range'] = resumeState['validator']
+        
+        streaming = False
+        try:
+            req_remote = request.Request(remote_file, headers=req_headers, method=method)
+            with _urlopen(req_remote) as url_response:
+                
+                uri_with_metadata = URIWithMetadata(url_response.url, dict(url_response.headers.items()))
+                
+                if download_file is not None:
+                    while True:
+                        try:
+                            # Try getting it
+                            shutil.copyfileobj(url_response, download_file)
+                        except http.client.IncompleteRead as icread:
+                            download_file.write(icread.partial)
+                            # Restarting the copy
+                            continue
+                        break
+                    break
+                
+                if (offset > 0) and (url_response.status == 206):
+                    contentRange = CONTENT_RANGE_PATTERN.search(url_response.headers.get('Content-Range', ''))
+                    if (contentRange is None) or (int(contentRange.group(1)) != offset):
+                        raise WFException("Unexpected Content-Range {} from {} when resuming from byte {}".format(url_response.headers.get('Content-Range'), orig_remote_file, offset))
+                    expectedSize = None  if contentRange.group(3) == '*'  else  int(contentRange.group(3))
+                    logger.info(f"Resuming download of {orig_remote_file} from byte {offset}")
+                else:
+                    # Either a new download, or the content has changed
+                    offset = 0
+                    contentLength = url_response.headers.get('Content-Length')
+                    expectedSize = int(contentLength)  if (contentLength is not None) and (url_response.headers.get('Content-Encoding') is None)  else  None
+                    etag = url_response.headers.get('ETag')
+                    validator = etag  if (etag is not None) and not etag.startswith('W/')  else  url_response.headers.get('Last-Modified')
+                    
+                    if resumable and (validator is not None) and (_ParallelDownloadStreams > 1) and (expectedSize is not None) and (expectedSize >= _ParallelDownloadMinSize) and (url_response.headers.get('Accept-Ranges', '').lower() == 'bytes'):
+                        if (resumeState is not None) and ((resumeState.get('validator') != validator) or (resumeState.get('size') != expectedSize)):
+                            resumeState = None
+                        # The response is closed without reading its body,
+                        # so its connection is not held during the fetch
+                        url_response.close()
+                        streaming = True
+                        _fetchChunksParallel(remote_file, orig_remote_file, headers, cachedFilename, expectedSize, validator, resumeState=resumeState)
+                        break
+                    
+                    if resumable and (validator is not None):
+                        resumeState = {'uri': orig_remote_file, 'validator': validator}
+                        writeResumeState(cachedFilename, resumeState)
+                    else:
+                        resumeState = None
+                        clearResumeState(cachedFilename)
+                
+                # Contents are digested while they are written,
+                # and the digest state is checkpointed in the resume state
+                streaming = True
+                with DigestingFile(cachedFilename, resume=offset > 0, resumeState=resumeState) as partial_file:
+                    shutil.copyfileobj(url_response, partial_file)
+                
+                if (expectedSize is not None) and (partial_file.size != expectedSize):
+                    raise http.client.IncompleteRead(b'', expectedSize - partial_file.size)
+        except urllib.error.HTTPError as he:
+            # Its connection is released
+            he.close()
+            # Answer to a conditional request
+            if he.code == 304:
+                raise ContentNotModifiedException("Content from {} was not modified".format(orig_remote_file)) from he
+            # The partial download is larger than the content
+            if (he.code == 416) and (offset > 0) and (retries > 0):
+                retries -= 1
+                clearResumeState(cachedFilename)
+                os.unlink(cachedFilename)
+                continue
+            raise WFException("Error fetching {} : {} {}".format(orig_remote_file, he.code, he.reason)) from he
+        except (http.client.HTTPException, OSError) as e:
+            # Interrupted transfers are resumed
+            if streaming and resumable and (retries > 0) and (readResumeState(cachedFilename) is not None):
+                retries -= 1
+                logger.warning(f"Download of {orig_remote_file} was interrupted ({e}). Left {retries} resumptions")
+                continue
+            raise
+        
+        break
+    
+    if resumable:
+        clearResumeState(cachedFilename)
     
     return ContentKind.File, [ uri_with_metadata ]
 
@@ -140,8 +561,25 @@ def fetchFTPURL(remote_file:URIType, cachedFilename:AbsPath, secContext:Optional
         connParams['USER'] = secContext.get('username')
         connParams['PASSWORD'] = secContext.get('password')
     
-    ftp_client = FTPDownloader(**connParams)
-    retval = ftp_client.download(download_path=parsedInputURL.path, upload_path=cachedFilename)
+    def connect() -> FTPDownloader:
+        # The additional connections used to mirror directories
+        # also count against the limit of connections to the host
+        sessionPool = _SessionPool
+        if sessionPool is not None:
+            host = parsedInputURL.hostname
+            slotParams = {
+                'reserve_connection': lambda: sessionPool.reserve(host),
+                'release_connection': lambda: sessionPool.unreserve(host),
+            }
+        else:
+            slotParams = {}
+        ftp_client = FTPDownloader(**connParams, max_connections=_FTPConnections, rate_limiter=_FTPRateLimiter, **slotParams)
+        ftp_client.connect()
+        return ftp_client
+    
+    key = (parsedInputURL.hostname, 'ftp', parsedInputURL.port, _credentialsKey(connParams.get('USER'), connParams.get('PASSWORD')))
+    with _pooledSession(key, connect, FTPDownloader.close, validate=FTPDownloader.isActive) as ftp_client:
+        retval = ftp_client.download(download_path=parsedInputURL.path, upload_path=cachedFilename)
     if isinstance(retval, list):
         kind = ContentKind.Directory
     else:
@@ -149,47 +587,146 @@ def fetchFTPURL(remote_file:URIType, cachedFilename:AbsPath, secContext:Optional
     
     return kind, [ URIWithMetadata(remote_file, {}) ]
 
-def sftpCopy(sftp:paramiko.SFTPClient, sshPath, localPath, sshStat=None) -> Tuple[Union[int,bool], ContentKind]:
+def _sftpCopyFile(sftp:paramiko.SFTPClient, remotePath, rStat, filename, resumeRoot=None) -> None:
+    # Partial downloads from previous fetches are resumed
+    # when the remote file has not changed since then
+    resumeState = {
+        'size': rStat.st_size,
+        'mtime': rStat.st_mtime,
+    }
+    prevResumeState = readResumeState(filename, resumeRoot)
+    resume = os.path.isfile(filename) and sameResumeState(prevResumeState, resumeState)
+    if resume:
+        # It keeps the checkpointed digest state
+        resumeState = prevResumeState
+    writeResumeState(filename, resumeState, resumeRoot)
+    
+    # Contents are digested while they are written,
+    # and the remote modification time is kept
+    with DigestingFile(filename, mtime=rStat.st_mtime, resume=resume, resumeState=resumeState, resumeRoot=resumeRoot) as fl:
+        if fl.size < rStat.st_size:
+            if fl.size > 0:
+                logger.info(f"Resuming download of {remotePath} from byte {fl.size}")
+            with sftp.open(remotePath, mode='rb') as rH:
+                rH.seek(fl.size)
+                # Pipelined reads
+                rH.prefetch(rStat.st_size)
+                shutil.copyfileobj(rH, fl, length=32768)
+    clearResumeState(filename, resumeRoot)
+
+def sftpCopy(sftp:paramiko.SFTPClient, sshPath, localPath, sshStat=None, channels:int=1) -> Tuple[Union[int,bool], ContentKind]:
+    """
+    It copies a remote file or directory. Directories are listed with a
+    single request each, and their files are transferred through up to
+    the given number of concurrent SFTP channels, all of them over the
+    transport of the given client
+    """
     if sshStat is None:
         sshStat = sftp.stat(sshPath)
     
     # Trios
     transTrios = []
-    recur = []
     kind = None
     if stat.S_ISREG(sshStat.st_mode):
         transTrios.append((sshPath, sshStat, localPath))
         kind = ContentKind.File
     elif stat.S_ISDIR(sshStat.st_mode):
-        # Recursive
-        os.makedirs(localPath, exist_ok=True)
-        recur = []
-        # List of remote files
-        for filename in sftp.listdir(sshPath):
-            rPath = os.path.join(sshPath, filename)
-            lPath = os.path.join(localPath, filename)
-            rStat = sftp.stat(rPath)
-            
-            if stat.S_ISREG(rStat.st_mode):
-                transTrios.append((rPath, rStat, lPath))
-            elif stat.S_ISDIR(rStat.st_mode):
-                recur.append((rPath, rStat, lPath))
+        # The whole tree is listed before any transfer
+        pendingDirs = [ (sshPath, localPath) ]
+        while len(pendingDirs) > 0:
+            rDir, lDir = pendingDirs.pop()
+            os.makedirs(lDir, exist_ok=True)
+            # List of remote files, along with their attributes
+            for rStat in sftp.listdir_attr(rDir):
+                rPath = os.path.join(rDir, rStat.filename)
+                lPath = os.path.join(lDir, rStat.filename)
+                # Symbolic links are followed
+                if stat.S_ISLNK(rStat.st_mode):
+                    rStat = sftp.stat(rPath)
+                
+                if stat.S_ISREG(rStat.st_mode):
+                    transTrios.append((rPath, rStat, lPath))
+                elif stat.S_ISDIR(rStat.st_mode):
+                    pendingDirs.append((rPath, lPath))
         kind = ContentKind.Directory
     else:
         return False, None
     
+    # The resume states of the files of a directory are kept apart from it
+    resumeRoot = localPath  if kind == ContentKind.Directory  else  None
+    
     # Now, transfer these
-    numCopied = 0
-    for remotePath, rStat, filename in transTrios:
-        sftp.get(remotePath, filename)
-        os.utime(filename, (rStat.st_atime, rStat.st_mtime))
-        numCopied += 1
+    if (channels <= 1) or (len(transTrios) <= 1):
+        for remotePath, rStat, filename in transTrios:
+            _sftpCopyFile(sftp, remotePath, rStat, filename, resumeRoot)
+        
+        if resumeRoot is not None:
+            clearResumeStates(resumeRoot)
+        
+        return len(transTrios), kind
     
-    # And recurse on these
-    for rDir, rStat, lDir in recur:
-        numCopied += sftpCopy(sftp, rDir, lDir, sshStat=rStat)
+    transport = sftp.get_channel().get_transport()
+    idleChannels = queue.Queue()
+    idleChannels.put(sftp)
+    openedChannels = []
+    openedChannelsLock = threading.Lock()
     
-    return numCopied, kind
+    def copyWithChannel(remotePath, rStat, filename):
+        try:
+            channel = idleChannels.get_nowait()
+        except queue.Empty:
+            try:
+                channel = paramiko.SFTPClient.from_transport(transport)
+                with openedChannelsLock:
+                    openedChannels.append(channel)
+            except Exception as e:
+                # Servers limit the sessions of a connection (MaxSessions)
+                logger.debug(f"Unable to open an additional SFTP channel ({e}). Waiting for a free one")
+                channel = idleChannels.get()
+        
+        try:
+            _sftpCopyFile(channel, remotePath, rStat, filename, resumeRoot)
+        except:
+            # Additional channels are not reused after a failure
+            if channel is not sftp:
+                channel.close()
+                raise
+            idleChannels.put(channel)
+            raise
+        idleChannels.put(channel)
+    
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(channels, len(transTrios))) as executor:
+            futures = [ executor.submit(copyWithChannel, *transTrio) for transTrio in transTrios ]
+        
+        # All the transfers were tried, and the first failure is reported
+        failures = list(filter(lambda future: future.exception() is not None, futures))
+        for failure in failures:
+            logger.error(f"Unable to fetch {transTrios[futures.index(failure)][0]}: {failure.exception()}")
+        if len(failures) > 0:
+            raise failures[0].exception()
+    finally:
+        with openedChannelsLock:
+            for channel in openedChannels:
+                channel.close()
+    
+    if resumeRoot is not None:
+        clearResumeStates(resumeRoot)
+    
+    return len(transTrios), kind
+
+# Concurrent SFTP channels used to copy a directory,
+# unless the security context tells otherwise
+DEFAULT_SFTP_CHANNELS = 4
+
+def _closeSFTPClient(sftp:paramiko.SFTPClient) -> None:
+    t = sftp.get_channel().get_transport()
+    sftp.close()
+    t.close()
+
+def _isSFTPClientActive(sftp:paramiko.SFTPClient) -> bool:
+    channel = sftp.get_channel()
+    return (not channel.closed) and channel.get_transport().is_active()
 
 # TODO: test this codepath
 def fetchSSHURL(remote_file:URIType, cachedFilename:AbsPath, secContext:Optional[SecurityContextConfig]=None) -> Tuple[Union[URIType, ContentKind], List[URIWithMetadata]]:
@@ -228,22 +765,57 @@ def fetchSSHURL(remote_file:URIType, cachedFilename:AbsPath, secContext:Optional
     sshPort = parsedInputURL.port  if parsedInputURL.port is not None  else  DEFAULT_SSH_PORT
     sshPath = parsedInputURL.path
     
-    t = None
-    try:
-        t = paramiko.Transport((sshHost, sshPort))
-        # Performance reasons!
-        # t.window_size = 134217727
-        # t.use_compression()
-        
-        t.connect(**connBlock)
-        sftp = paramiko.SFTPClient.from_transport(t)
-        
-        _ , kind = sftpCopy(sftp,sshPath,cachedFilename)
-        return kind, [ URIWithMetadata(remote_file, {}) ]
-    finally:
-        # Closing the SFTP connection
-        if t is not None:
+    # Transfer tuning (concurrent channels, window and packet sizes, compression)
+    sftpSettings = secContext.get('sftp', {})
+    channels = sftpSettings.get('channels', DEFAULT_SFTP_CHANNELS)
+    transportParams = {}
+    if sftpSettings.get('window_size') is not None:
+        transportParams['default_window_size'] = parseByteSize(sftpSettings['window_size'])
+    if sftpSettings.get('max_packet_size') is not None:
+        transportParams['default_max_packet_size'] = parseByteSize(sftpSettings['max_packet_size'])
+    compression = sftpSettings.get('compression', False)
+    
+    def connect() -> paramiko.SFTPClient:
+        t = paramiko.Transport((sshHost, sshPort), **transportParams)
+        try:
+            # Performance reasons!
+            t.use_compression(compression)
+            
+            t.connect(**connBlock)
+            return paramiko.SFTPClient.from_transport(t)
+        except:
+            # Closing the SSH connection
             t.close()
+            raise
+    
+    # Transports and their SFTP channels are reused among fetches
+    key = (sshHost, 'ssh', sshPort, _credentialsKey(username, password, sshKey), tuple(sorted(transportParams.items())), compression)
+    with _pooledSession(key, connect, _closeSFTPClient, validate=_isSFTPClientActive) as sftp:
+        _ , kind = sftpCopy(sftp,sshPath,cachedFilename,channels=channels)
+    
+    return kind, [ URIWithMetadata(remote_file, {}) ]
+
+def _linkOrCopyFile(src:AbsPath, dst:AbsPath) -> AbsPath:
+    """
+    Copy function which avoids copying the contents when the
+    strategy and the filesystem allow it
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    
+    if _FileStrategy in ('auto', 'reflink'):
+        if reflinkFile(src, dst):
+            return dst
+    
+    if _FileStrategy == 'hardlink':
+        # The digest is shared with the source, as the inode is the same
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError as e:
+            logger.debug(f'Unable to hard link {src} to {dst}: {e}')
+    
+    return copy2WithDigest(src, dst)
 
 def fetchFile(remote_file:URIType, cachedFilename:AbsPath, secContext:Optional[SecurityContextConfig]=None) -> Tuple[Union[URIType, ContentKind], List[URIWithMetadata]]:
     """
@@ -261,15 +833,25 @@ def fetchFile(remote_file:URIType, cachedFilename:AbsPath, secContext:Optional[S
     
     kind = None
     if os.path.isdir(localPath):
-        shutil.copytree(localPath, cachedFilename)
         kind = ContentKind.Directory
     elif os.path.isfile(localPath):
-        shutil.copy2(localPath, cachedFilename)
         kind = ContentKind.File
     else:
         raise WFException("Local path {} is neither a file nor a directory".format(localPath))
     
-    return kind, [ URIWithMetadata(remote_file, {}) ]
+    metadata = {}
+    if _FileStrategy == 'reference':
+        # Contents are not copied. The cache keeps a symlink to them,
+        # along with their stats, so changes are detected on reuse
+        localPath = os.path.abspath(localPath)
+        metadata['reference'] = getReferenceStats(localPath)
+        os.symlink(localPath, cachedFilename)
+    elif kind == ContentKind.Directory:
+        shutil.copytree(localPath, cachedFilename, copy_function=_linkOrCopyFile)
+    else:
+        _linkOrCopyFile(localPath, cachedFilename)
+    
+    return kind, [ URIWithMetadata(remote_file, metadata) ]
 
 DEFAULT_SCHEME_HANDLERS = {
     'http': fetchClassicURL,
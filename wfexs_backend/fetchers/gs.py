@@ -17,26 +17,48 @@
 
 from google.cloud import storage
 from urllib.parse import urlparse
+import base64
+import concurrent.futures
+import hashlib
 import logging
-import shutil
+import os
 
 from ..common import *
 from typing import List, Optional, Tuple, Union
 
+# Logger of this module
+logger = logging.getLogger(__name__)
 
-def downloadContentFrom_gs(remote_file: URIType, cachedFilename: AbsPath, secContext: Optional[SecurityContextConfig] = None) -> Tuple[Union[URIType, ContentKind], List[URIWithMetadata]]:
-    """
-        Method to download contents from Google Storage.
+# Blobs fetched at once. Large blobs are fetched in slices
+# through concurrent ranged downloads
+DEFAULT_GS_CONCURRENT_BLOBS = 8
+DEFAULT_GS_SLICES = 4
+DEFAULT_GS_SLICED_THRESHOLD = 128 * 1024 * 1024
+DEFAULT_GS_SLICE_SIZE = 32 * 1024 * 1024
+GS_DIGEST_BUFFER_SIZE = 1024 * 1024
 
-        :param remote_file:
-        :param cachedFilename:
-        :param secContext:
+_GSConcurrentBlobs = DEFAULT_GS_CONCURRENT_BLOBS
+_GSSlices = DEFAULT_GS_SLICES
+_GSSlicedThreshold = DEFAULT_GS_SLICED_THRESHOLD
+_GSSliceSize = DEFAULT_GS_SLICE_SIZE
+
+def setGSTransfers(concurrentBlobs: int = DEFAULT_GS_CONCURRENT_BLOBS, slices: int = DEFAULT_GS_SLICES, slicedThreshold: int = DEFAULT_GS_SLICED_THRESHOLD, sliceSize: int = DEFAULT_GS_SLICE_SIZE) -> None:
     """
-    url = urlparse(remote_file)
-    bucket = url.netloc
-    prefix = url.path[1:]
-    local_path = cachedFilename
+        Number of blobs fetched at once, and how large blobs are
+        fetched in slices. With 1 slice they are never sliced
+    """
+    global _GSConcurrentBlobs
+    global _GSSlices
+    global _GSSlicedThreshold
+    global _GSSliceSize
+    
+    _GSConcurrentBlobs = max(1, concurrentBlobs)
+    _GSSlices = max(1, slices)
+    _GSSlicedThreshold = slicedThreshold
+    _GSSliceSize = max(GS_DIGEST_BUFFER_SIZE, sliceSize)
 
+
+def _getClient(secContext: Optional[SecurityContextConfig]) -> storage.Client:
     if isinstance(secContext, dict):
         credentials = secContext.get('gs_credentials')
     else:
@@ -44,58 +66,230 @@ def downloadContentFrom_gs(remote_file: URIType, cachedFilename: AbsPath, secCon
 
     try:
         if credentials is None:
-            gs = storage.Client.create_anonymous_client()
+            return storage.Client.create_anonymous_client()
         else:
-            gs = storage.Client.from_service_account_json(credentials)
-    except Exception:
-        logging.warning("Authentication error")
-
-    bucket = gs.bucket(bucket)
-    blob = bucket.blob(prefix)
-    blobs = bucket.list_blobs(prefix=prefix)
-    listBlobs = bucket.list_blobs(prefix=prefix)
-    total_bobs = 0
-
-    for blob in blobs:
-        total_bobs += 1
-    if total_bobs == 1:
-        try:
-            blob.download_to_filename(local_path)
-        except Exception:
-            logging.exception("Error downloading file")
+            return storage.Client.from_service_account_json(credentials)
+    except Exception as e:
+        raise WFException("Authentication error: {}".format(e)) from e
+
+
+def _blobChecksums(blob: storage.Blob) -> List[Tuple[str, bytes]]:
+    """
+        The checksums of the blob told by the listing. Composite
+        objects only have crc32c
+    """
+    checksums = _blobIdentityChecksums(blob)
+    if blob.crc32c is not None:
+        checksums.append((CRC32C_DIGEST_ALGORITHM, base64.b64decode(blob.crc32c)))
+    
+    return checksums
+
+
+def _blobIdentityChecksums(blob: storage.Blob) -> List[Tuple[str, bytes]]:
+    """
+        The checksums of the blob which can identify its contents
+        in the cache. crc32c is only used to check the transfers
+    """
+    checksums = []
+    if blob.md5_hash is not None:
+        checksums.append(('md5', base64.b64decode(blob.md5_hash)))
+    
+    return checksums
+
+
+class _OffsetWriter:
+    """
+        File-like object which writes at increasing
+        offsets of a file descriptor, using os.pwrite
+    """
+    def __init__(self, fd: int, offset: int):
+        self.fd = fd
+        self.offset = offset
+    
+    def write(self, data) -> int:
+        view = memoryview(data)
+        numWritten = 0
+        while numWritten < len(view):
+            numWritten += os.pwrite(self.fd, view[numWritten:], self.offset + numWritten)
+        self.offset += numWritten
+        return numWritten
+    
+    def tell(self) -> int:
+        return self.offset
+
+
+def _downloadBlobSliced(blob: storage.Blob, filename: AbsPath) -> List[Tuple[str, bytes]]:
+    """
+        The blob is preallocated, and its slices are fetched through
+        concurrent ranged downloads. Slices are digested in order,
+        while the next ones are being fetched, and the whole blob
+        is checked against its md5 and crc32c
+    """
+    totalSize = blob.size
+    with open(filename, mode='wb') as pH:
+        os.ftruncate(pH.fileno(), totalSize)
+    
+    digestAlgorithm = getInternalDigestAlgorithm()
+    h = newDigester(digestAlgorithm)
+    md5 = hashlib.md5()  if blob.md5_hash is not None  else  None
+    crc = newDigester(CRC32C_DIGEST_ALGORITHM)  if (blob.crc32c is not None) and (google_crc32c is not None)  else  None
+    numSlices = (totalSize + _GSSliceSize - 1) // _GSSliceSize
+    fetchedSlices = set()
+    nextToDigest = 0
+    fd = os.open(filename, os.O_RDWR)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=_GSSlices) as executor:
+            futures = dict()
+            for iSlice in range(numSlices):
+                start = iSlice * _GSSliceSize
+                end = min(totalSize, start + _GSSliceSize) - 1
+                futures[executor.submit(blob.download_to_file, _OffsetWriter(fd, start), start=start, end=end, checksum=None)] = iSlice
+            
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+                    fetchedSlices.add(futures[future])
+                    
+                    # The contiguous fetched slices are digested
+                    while nextToDigest in fetchedSlices:
+                        offset = nextToDigest * _GSSliceSize
+                        endOffset = min(totalSize, offset + _GSSliceSize)
+                        while offset < endOffset:
+                            digestBuf = os.pread(fd, min(GS_DIGEST_BUFFER_SIZE, endOffset - offset), offset)
+                            if len(digestBuf) == 0:
+                                raise WFException(f"File {filename} was truncated while it was being fetched")
+                            h.update(digestBuf)
+                            if md5 is not None:
+                                md5.update(digestBuf)
+                            if crc is not None:
+                                crc.update(digestBuf)
+                            offset += len(digestBuf)
+                        nextToDigest += 1
+            except:
+                for pendingFuture in futures.keys():
+                    pendingFuture.cancel()
+                raise
+    finally:
+        os.close(fd)
+    
+    if (crc is not None) and (crc.digest() != base64.b64decode(blob.crc32c)):
+        raise WFException(f"Sliced download of gs://{blob.bucket.name}/{blob.name} does not match its crc32c")
+    checksums = []
+    if md5 is not None:
+        if md5.digest() != base64.b64decode(blob.md5_hash):
+            raise WFException(f"Sliced download of gs://{blob.bucket.name}/{blob.name} does not match its md5")
+        checksums.append(('md5', md5.digest()))
+    
+    # Modification time is set before registering the digest
+    if blob.updated is not None:
+        updated = blob.updated.timestamp()
+        os.utime(filename, (updated, updated))
+    registerFileDigest(filename, h.digest(), digestAlgorithm)
+    
+    return checksums
 
-    elif total_bobs > 1:
+
+def _downloadBlob(blob: storage.Blob, filename: AbsPath) -> List[Tuple[str, bytes]]:
+    """
+        Like blob.download_to_filename, but digesting the contents
+        while they are written. Large blobs are fetched in slices.
+        It returns the verified checksums identifying the blob
+    """
+    if (_GSSlices > 1) and (blob.size is not None) and (blob.size >= _GSSlicedThreshold):
+        return _downloadBlobSliced(blob, filename)
+    
+    # The download is verified with one of the checksums from the listing
+    checksums = _blobChecksums(blob)
+    if (len(checksums) > 0) and ((checksums[0][0] != CRC32C_DIGEST_ALGORITHM) or (google_crc32c is not None)):
+        checksums = checksums[0:1]
+        checksum = checksums[0][0]
+    else:
+        checksums = []
+        checksum = None
+    
+    with DigestingFile(filename) as download_file:
+        blob.download_to_file(download_file, checksum=checksum)
+        # Modification time is set on close, before registering the digest
+        if blob.updated is not None:
+            download_file.mtime = blob.updated.timestamp()
+    
+    return checksums  if checksum == 'md5'  else  []
+
+
+def probeChecksums_gs(remote_file: URIType, secContext: Optional[SecurityContextConfig] = None) -> Tuple[List[Tuple[str, bytes]], Optional[int]]:
+    """
+        The md5 checksum and the size of an object, when the URI
+        is not a prefix. Composite objects have no md5
+    """
+    url = urlparse(remote_file)
+    prefix = url.path[1:]
+    if (prefix == '') or prefix.endswith('/'):
+        return [], None
+    
+    blob = _getClient(secContext).bucket(url.netloc).get_blob(prefix)
+    if blob is None:
+        return [], None
+    
+    return _blobIdentityChecksums(blob), blob.size
+
+
+def downloadContentFrom_gs(remote_file: URIType, cachedFilename: AbsPath, secContext: Optional[SecurityContextConfig] = None) -> Tuple[Union[URIType, ContentKind], List[URIWithMetadata]]:
+    """
+        Method to download contents from Google Storage. The prefix is
+        listed once, and its blobs are fetched concurrently while the
+        listing goes on, straight into the cache.
+
+        :param remote_file:
+        :param cachedFilename:
+        :param secContext:
+    """
+    url = urlparse(remote_file)
+    prefix = url.path[1:]
+
+    gs = _getClient(secContext)
+
+    kind = None
+    metadata = {}
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_GSConcurrentBlobs) as executor:
         try:
-            for blob in listBlobs:
-                if blob.name.endswith("/"):
+            for blob in gs.list_blobs(url.netloc, prefix=prefix):
+                # Blobs are listed in order, so a blob named as the
+                # prefix comes before the ones under it
+                if (kind is None) and (blob.name == prefix) and not prefix.endswith('/'):
+                    kind = ContentKind.File
+                    checksums = _downloadBlob(blob, cachedFilename)
+                    metadata['checksums'] = list(map(lambda checksum: stringifyFilenameDigest(*checksum), checksums))
+                    break
+                
+                # Neither folder placeholders nor blobs which
+                # only share the beginning of their names
+                if blob.name.endswith('/') or not (prefix.endswith('/') or (prefix == '') or blob.name.startswith(prefix + '/')):
                     continue
+                
+                kind = ContentKind.Directory
+                path = os.path.join(cachedFilename, blob.name[len(prefix):].lstrip('/'))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                futures.append(executor.submit(_downloadBlob, blob, path))
+        except:
+            # Pending downloads are not started
+            for future in futures:
+                future.cancel()
+            raise
 
-                if local_path[-1] == '/':
-                    path = local_path + blob.name
-                elif local_path == './':
-                    path = local_path + blob.name
-                elif local_path[-1] != '/':
-                    path = local_path + '/' + blob.name
-
-                if not os.path.exists(os.path.dirname(path)):
-                    os.makedirs(os.path.dirname(path))
-                blob.download_to_filename(path)
-        except Exception:
-            logging.exception("Error downloading files")
-
-    if os.path.isdir(local_path):
-        shutil.move(local_path, cachedFilename)
-        kind = ContentKind.Directory
-    elif os.path.isfile(local_path):
-        shutil.move(local_path, cachedFilename)
-        kind = ContentKind.File
-    else:
-        raise WFException(
-            "Local path {} is neither a file nor a directory".format(local_path))
+    for future in futures:
+        future.result()
 
-    return kind, [URIWithMetadata(remote_file, {})]
+    if kind is None:
+        raise WFException("No object found at {}".format(remote_file))
+
+    return kind, [URIWithMetadata(remote_file, metadata)]
 
 
 GS_SCHEME_HANDLERS = {
     'gs': downloadContentFrom_gs
 }
+
+GS_CHECKSUM_PROBES = {
+    'gs': probeChecksums_gs
+}
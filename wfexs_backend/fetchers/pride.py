@@ -56,7 +56,7 @@ def fetchPRIDEProject(remote_file:URIType, cachedFilename:AbsPath, secContext:Op
         gathered_meta['payload'] = metadata
         metadata_array.extend(metametaio)
     except urllib.error.HTTPError as he:
-        raise WFException("Error fetching PRIDE metadata for {} : {} {}".format(projectId, he.code, he.reason))
+        raise WFException("Error fetching PRIDE metadata for {} : {} {}".format(projectId, he.code, he.reason)) from he
     
     try:
         for addAtt in metadata['additionalAttributes']:
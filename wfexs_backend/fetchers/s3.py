@@ -16,26 +16,65 @@
 # limitations under the License.
 
 import boto3
+import boto3.s3.transfer
 from botocore import UNSIGNED
 from botocore.client import Config
 import botocore.exceptions
+import concurrent.futures
 from urllib.parse import urlparse
 from typing import Any, List, Optional, Tuple, Union
 import os
-import shutil
 import logging
-import argparse
 from ..common import *
 
 # Logger of this module
 logger = logging.getLogger(__name__)
 
+# Objects fetched at once, and parts of each object fetched at once
+# through ranged GETs. Objects above the threshold are fetched in parts
+DEFAULT_S3_CONCURRENT_KEYS = 8
+DEFAULT_S3_PART_CONCURRENCY = 8
+DEFAULT_S3_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_S3_PART_SIZE = 16 * 1024 * 1024
+
+_S3ConcurrentKeys = DEFAULT_S3_CONCURRENT_KEYS
+_S3TransferConfig = boto3.s3.transfer.TransferConfig(
+    multipart_threshold=DEFAULT_S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=DEFAULT_S3_PART_SIZE,
+    max_concurrency=DEFAULT_S3_PART_CONCURRENCY,
+)
+
+def setS3Transfers(concurrentKeys:int=DEFAULT_S3_CONCURRENT_KEYS, partConcurrency:int=DEFAULT_S3_PART_CONCURRENCY, multipartThreshold:int=DEFAULT_S3_MULTIPART_THRESHOLD, partSize:int=DEFAULT_S3_PART_SIZE) -> None:
+    """
+    Number of objects fetched at once, and how each large object is
+    fetched through concurrent ranged GETs
+    """
+    global _S3ConcurrentKeys
+    global _S3TransferConfig
+    
+    _S3ConcurrentKeys = max(1, concurrentKeys)
+    _S3TransferConfig = boto3.s3.transfer.TransferConfig(
+        multipart_threshold=multipartThreshold,
+        multipart_chunksize=partSize,
+        max_concurrency=max(1, partConcurrency),
+    )
+
+def _downloadObject(s3, bucket:str, key:str, local_path:AbsPath) -> None:
+    # The sink is not seekable, so parts are written (and digested)
+    # in order, while the next ones are being fetched
+    with DigestingFile(local_path) as download_file:
+        s3.download_fileobj(bucket, key, download_file, Config=_S3TransferConfig)
+
 def downloadContentFrom_s3(remote_file:URIType, cachedFilename:AbsPath, secContext:Optional[SecurityContextConfig]=None) -> Tuple[Union[URIType, ContentKind], List[URIWithMetadata]]:
+    """
+    Method to fetch either an object or all the objects under a prefix
+    from s3. The prefix is listed once, and its objects are fetched
+    concurrently while the listing goes on, straight into the cache
+    """
     urlParse = urlparse(remote_file)
     bucket = urlParse.netloc
     prefix = urlParse.path
     prefix = prefix[1:]
-    local_path = cachedFilename
     
     if(isinstance(secContext, dict)):
         access_key = secContext.get('access_key')
@@ -43,61 +82,57 @@ def downloadContentFrom_s3(remote_file:URIType, cachedFilename:AbsPath, secConte
     else:
         access_key = None
         secret_key = None
-
-
+    
+    # Enough connections for all the concurrent ranged GETs
+    clientConfig = Config(max_pool_connections=_S3ConcurrentKeys * _S3TransferConfig.max_request_concurrency)
+    if access_key == None and secret_key == None:
+        s3 = boto3.client('s3', config=clientConfig.merge(Config(signature_version=UNSIGNED)))
+    else:
+        s3 = boto3.client('s3', aws_access_key_id=access_key, aws_secret_access_key=secret_key, config=clientConfig)
+    
+    kind = None
+    futures = []
     try:
-        if access_key == None and secret_key == None:
-                s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
-                response = s3.list_objects_v2(Bucket=bucket,Prefix=prefix)
-        else:
-                s3 = boto3.client('s3',access_key,secret_key)
-                response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    except botocore.exceptions.ClientError as error:
-        logger.warn('Error in the connection with s3 ' + error)
-
-    if response["KeyCount"] == 1:
-        file_name = urlParse.path.split('/')
-        file_name = file_name[len(file_name) - 1]
-
-        if(local_path[:1] == '/'):
-            local_path = local_path + file_name
-        elif(local_path == './'):
-            local_path = local_path + file_name
-        elif(local_path[:1] != '/'):
-            local_path = local_path + '/' + file_name
+        with concurrent.futures.ThreadPoolExecutor(max_workers=_S3ConcurrentKeys) as executor:
+            try:
+                paginator = s3.get_paginator('list_objects_v2')
+                for result in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                    for key in result.get('Contents', []):
+                        # Keys are listed in order, so an object named as the
+                        # prefix comes before the ones under it
+                        if (kind is None) and (key['Key'] == prefix) and not prefix.endswith('/'):
+                            kind = ContentKind.File
+                            break
+                        
+                        rel_path = key['Key'][len(prefix):].lstrip('/')
+                        # Neither folder placeholders nor objects which
+                        # only share the beginning of their names
+                        if key['Key'].endswith('/') or not (prefix.endswith('/') or (prefix == '') or key['Key'].startswith(prefix + '/')):
+                            continue
+                        
+                        kind = ContentKind.Directory
+                        local_file_path = os.path.join(cachedFilename, rel_path)
+                        os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+                        futures.append(executor.submit(_downloadObject, s3, bucket, key['Key'], local_file_path))
+                    
+                    if kind == ContentKind.File:
+                        break
+                
+                if kind == ContentKind.File:
+                    _downloadObject(s3, bucket, prefix, cachedFilename)
+            except:
+                # Pending downloads are not started
+                for future in futures:
+                    future.cancel()
+                raise
         
-        try:
-            s3.download_file(bucket, prefix, local_path)
-        
-        except botocore.exceptions.ParamValidationError as error:
-            logger.warn("Error downloading file" + error)
-
-    elif response["KeyCount"] > 1:
-        try:
-
-            paginator = s3.get_paginator('list_objects_v2')
-            for result in paginator.paginate(Bucket=bucket, Prefix=prefix):
-                for key in result['Contents']:
-                    rel_path = key['Key'][len(prefix):]
-                    if not key['Key'].endswith('/'):
-                        local_file_path = os.path.join(local_path, rel_path)
-                        local_file_dir = os.path.dirname(local_file_path)
-                        if not os.path.exists(local_file_dir):
-                            os.makedirs(local_file_dir)
-                        s3.download_file(bucket, key['Key'],local_file_path)
-
-        except botocore.exceptions.ParamValidationError as error:
-            logger.warn("Error downloading file " + error)
+        for future in futures:
+            future.result()
+    except botocore.exceptions.ClientError as error:
+        raise WFException("Error fetching {} from s3: {}".format(remote_file, error)) from error
     
-    kind = None
-    if os.path.isdir(local_path):
-        shutil.move(local_path, cachedFilename)
-        kind = ContentKind.Directory
-    elif os.path.isfile(local_path):
-        shutil.move(local_path, cachedFilename)
-        kind = ContentKind.File
-    else:
-        raise WFException("Local path {} is neither a file nor a directory".format(local_path))
+    if kind is None:
+        raise WFException("No object found at {}".format(remote_file))
     
     return kind, [ URIWithMetadata(remote_file, {}) ]
 
@@ -71,7 +71,7 @@ def fetchTRSFiles(remote_file:URIType, cachedFilename:AbsPath, secContext:Option
         
         metaio = None
     except urllib.error.HTTPError as he:
-        raise WFException("Error fetching or processing TRS files metadata for {} : {} {}".format(remote_file, he.code, he.reason))
+        raise WFException("Error fetching or processing TRS files metadata for {} : {} {}".format(remote_file, he.code, he.reason)) from he
     
     os.makedirs(cachedFilename, exist_ok=True)
     absdirs = set()
@@ -111,7 +111,7 @@ def fetchTRSFiles(remote_file:URIType, cachedFilename:AbsPath, secContext:Option
             metadata_array.extend(metaelem)
     
     if emptyWorkflow:
-        raise WFException("Error processing TRS files for {} : no file was found.\n{}".format(remote_file, metadata))
+        raise ContentNotFoundException("Error processing TRS files for {} : no file was found.\n{}".format(remote_file, metadata))
     
     return ContentKind.Directory, metadata_array
 
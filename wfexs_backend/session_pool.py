@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2020-2021 Barcelona Supercomputing Center (BSC), Spain
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+from typing import Any, Callable, Hashable, Iterator, List, Optional, Tuple
+
+from .common import *
+
+# A pooled session, along with the time it was released and how it is closed
+IdleSession = Tuple[Any, float, Callable[[Any], None]]
+
+class SessionPool:
+    """
+    Pool of sessions (http connections, ssh transports, ftp clients)
+    reused among fetches from the same host. Sessions are keyed by
+    host, port and credentials, the idle ones are closed after a timeout,
+    and the number of sessions to the same host is capped
+    """
+    DEFAULT_IDLE_TIMEOUT = 60
+    DEFAULT_MAX_PER_HOST = 4
+
+    def __init__(self, idleTimeout:float=DEFAULT_IDLE_TIMEOUT, maxPerHost:Optional[int]=DEFAULT_MAX_PER_HOST):
+        # Getting a logger focused on specific classes
+        import inspect
+
+        self.logger = logging.getLogger(dict(inspect.getmembers(self))['__module__'] + '::' + self.__class__.__name__)
+
+        self.idleTimeout = idleTimeout
+        self.maxPerHost = maxPerHost
+
+        self._cond = threading.Condition()
+        # Idle sessions by key, the most recently released last
+        self._idle = collections.defaultdict(list)
+        # Open sessions (both idle and in use) by host
+        self._hostLoad = collections.Counter()
+        self._closed = False
+
+    def _pruneIdle(self, now:float) -> List[Tuple[str, IdleSession]]:
+        """
+        It detaches the sessions idle for longer than the timeout,
+        which have to be closed outside the lock
+        """
+        expired = []
+        for key in list(self._idle.keys()):
+            idleSessions = self._idle[key]
+            alive = []
+            for idleSession in idleSessions:
+                if now - idleSession[1] > self.idleTimeout:
+                    expired.append((key[0], idleSession))
+                else:
+                    alive.append(idleSession)
+            if len(alive) > 0:
+                self._idle[key] = alive
+            else:
+                del self._idle[key]
+
+        for host, _ in expired:
+            self._hostLoad[host] -= 1
+
+        return expired
+
+    def _evictIdleFromHost(self, host:str) -> Optional[Tuple[str, IdleSession]]:
+        """
+        It detaches the least recently used idle session to the host,
+        so a session with other credentials can be opened
+        """
+        oldestKey = None
+        oldestSession = None
+        for key, idleSessions in self._idle.items():
+            if key[0] == host and ((oldestSession is None) or (idleSessions[0][1] < oldestSession[1])):
+                oldestKey = key
+                oldestSession = idleSessions[0]
+
+        if oldestKey is None:
+            return None
+
+        self._idle[oldestKey].pop(0)
+        if len(self._idle[oldestKey]) == 0:
+            del self._idle[oldestKey]
+        self._hostLoad[host] -= 1
+
+        return host, oldestSession
+
+    def _closeSessions(self, toClose:List[Tuple[str, IdleSession]]) -> None:
+        for host, (session, _, closeSession) in toClose:
+            try:
+                closeSession(session)
+            except Exception as e:
+                self.logger.debug(f'Error closing pooled session to {host}: {e}')
+
+    def acquire(self, key:Hashable, connect:Callable[[], Any], closeSession:Callable[[Any], None], validate:Optional[Callable[[Any], bool]]=None) -> Tuple[Any, bool]:
+        """
+        It returns an idle session for the key, or a new one from connect,
+        waiting while the host is at its cap. The first element of the key
+        must be the host. The second returned value tells whether the
+        session was reused
+        """
+        host = key[0]
+        while True:
+            toClose = []
+            with self._cond:
+                while True:
+                    toClose.extend(self._pruneIdle(time.monotonic()))
+                    idleSessions = self._idle.get(key)
+                    if idleSessions:
+                        session, _, _ = idleSessions.pop()
+                        if len(idleSessions) == 0:
+                            del self._idle[key]
+                        reused = True
+                        break
+
+                    if (self.maxPerHost is None) or (self._hostLoad[host] < self.maxPerHost):
+                        self._hostLoad[host] += 1
+                        session = None
+                        reused = False
+                        break
+
+                    evicted = self._evictIdleFromHost(host)
+                    if evicted is not None:
+                        toClose.append(evicted)
+                        continue
+
+                    # The host is saturated
+                    self._cond.wait(timeout=self.idleTimeout)
+
+            self._closeSessions(toClose)
+
+            if not reused:
+                try:
+                    session = connect()
+                except:
+                    self._discard(host)
+                    raise
+                return session, False
+
+            # Idle sessions could have been closed by the other side
+            if validate is not None:
+                try:
+                    valid = validate(session)
+                except Exception as e:
+                    self.logger.debug(f'Pooled session to {host} is not usable: {e}')
+                    valid = False
+                if not valid:
+                    self.release(key, session, closeSession, reusable=False)
+                    continue
+
+            return session, True
+
+    def reserve(self, host:str) -> bool:
+        """
+        It counts a session which is not pooled (for instance, an
+        additional connection opened by a pooled one) against the cap
+        of the host, without waiting. It returns False when the host
+        is saturated. Reserved slots are freed through unreserve
+        """
+        toClose = []
+        with self._cond:
+            toClose.extend(self._pruneIdle(time.monotonic()))
+            reserved = True
+            if (self.maxPerHost is not None) and (self._hostLoad[host] >= self.maxPerHost):
+                evicted = self._evictIdleFromHost(host)
+                if evicted is not None:
+                    toClose.append(evicted)
+                else:
+                    reserved = False
+            if reserved:
+                self._hostLoad[host] += 1
+
+        self._closeSessions(toClose)
+
+        return reserved
+
+    def unreserve(self, host:str) -> None:
+        self._discard(host)
+
+    def _discard(self, host:str) -> None:
+        with self._cond:
+            self._hostLoad[host] -= 1
+            self._cond.notify_all()
+
+    def release(self, key:Hashable, session:Any, closeSession:Callable[[Any], None], reusable:bool=True) -> None:
+        """
+        It returns a session to the pool, or closes it when it is not reusable
+        """
+        host = key[0]
+        if reusable:
+            with self._cond:
+                if not self._closed:
+                    self._idle[key].append((session, time.monotonic(), closeSession))
+                    self._cond.notify_all()
+                    return
+
+        self._closeSessions([(host, (session, 0, closeSession))])
+        self._discard(host)
+
+    @contextlib.contextmanager
+    def session(self, key:Hashable, connect:Callable[[], Any], closeSession:Callable[[Any], None], validate:Optional[Callable[[Any], bool]]=None) -> Iterator[Any]:
+        """
+        Context manager around acquire and release. Sessions which
+        were in use when an exception was raised are not reused
+        """
+        session, _ = self.acquire(key, connect, closeSession, validate=validate)
+        try:
+            yield session
+        except:
+            self.release(key, session, closeSession, reusable=False)
+            raise
+        self.release(key, session, closeSession)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def close(self) -> None:
+        """
+        It closes all the idle sessions. Sessions in use are
+        closed when they are released
+        """
+        with self._cond:
+            self._closed = True
+            toClose = []
+            for key, idleSessions in self._idle.items():
+                for idleSession in idleSessions:
+                    toClose.append((key[0], idleSession))
+                    self._hostLoad[key[0]] -= 1
+            self._idle.clear()
+            self._cond.notify_all()
+
+        self._closeSessions(toClose)
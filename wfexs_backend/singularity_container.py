@@ -164,9 +164,14 @@ class SingularityContainerFactory(ContainerFactory):
                         if not os.path.exists(tmpContainerPath):
                             raise ContainerFactoryException("FATAL ERROR: Singularity finished properly but it did not materialize {} into {}".format(tag, tmpContainerPath))
                         
-                        imageSignature = ComputeDigestFromFile(tmpContainerPath)
+                        # Deduplication uses the internal digest algorithm, which can be a faster one
+                        internalDigestAlgorithm = getInternalDigestAlgorithm()
+                        internalSignature = ComputeDigestFromFile(tmpContainerPath, digestAlgorithm=internalDigestAlgorithm)
+                        # The provenance signature is computed later, when the algorithms differ
+                        if internalDigestAlgorithm == DEFAULT_DIGEST_ALGORITHM:
+                            imageSignature = internalSignature
                         # Some filesystems complain when filenames contain 'equal', 'slash' or 'plus' symbols
-                        canonicalContainerPath = os.path.join(self.containersCacheDir, imageSignature.replace('=','~').replace('/','-').replace('+','_'))
+                        canonicalContainerPath = os.path.join(self.containersCacheDir, internalSignature.replace('=','~').replace('/','-').replace('+','_'))
                         if os.path.exists(canonicalContainerPath):
                             tmpSize = os.path.getsize(tmpContainerPath)
                             canonicalSize = os.path.getsize(canonicalContainerPath)
@@ -180,7 +185,7 @@ class SingularityContainerFactory(ContainerFactory):
                             if tmpSize != canonicalSize:
                                 # If files were not the same complain
                                 # This should not happen!!!!!
-                                raise ContainerFactoryException("FATAL ERROR: Singularity cache collision for {}, with differing sizes ({} local, {} remote {})".format(imageSignature,canonicalSize,tmpSize,tag))
+                                raise ContainerFactoryException("FATAL ERROR: Singularity cache collision for {}, with differing sizes ({} local, {} remote {})".format(internalSignature,canonicalSize,tmpSize,tag))
                         else:
                             shutil.move(tmpContainerPath, canonicalContainerPath)
                             tmpContainerPath = None
@@ -26,10 +26,13 @@ import os
 from pathlib import Path, PurePosixPath
 import socket
 import sys
+import threading
 import time
 
 import aioftp
 
+from ..common import DigestingFile, clearResumeState, clearResumeStates, readResumeState, sameResumeState, writeResumeState
+
 
 def asyncio_run(tasks):
     """
@@ -53,14 +56,44 @@ def asyncio_run(tasks):
         
     return task.result()
 
+class ByteRateLimiter:
+    """
+    Limit of the bytes per second fetched, shared among all the
+    connections, even the ones from different threads and event loops
+    """
+    def __init__(self, max_rate):
+        self.max_rate = max_rate
+        self._next_time = time.monotonic()
+        self._lock = threading.Lock()
+    
+    async def consume(self, num_bytes):
+        """
+        It waits for the turn of the block already fetched, so the
+        average rate among all the blocks does not exceed the limit
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._next_time = max(self._next_time, now)
+            delay = self._next_time - now
+            self._next_time += num_bytes / self.max_rate
+        
+        if delay > 0:
+            await asyncio.sleep(delay)
+
 class FTPDownloader:
     DEFAULT_USER = 'ftp'
     DEFAULT_PASS = 'guest@'
     DEFAULT_FTP_PORT = 21
     
     DEFAULT_MAX_RETRIES = 5
+    
+    # Connections used to mirror a directory
+    DEFAULT_MAX_CONNECTIONS = 4
+    
+    # Time to wait for the answer to the command probing a persistent session
+    DEFAULT_PROBE_TIMEOUT = 10
 
-    def __init__(self, HOST, PORT=DEFAULT_FTP_PORT, USER=DEFAULT_USER, PASSWORD=DEFAULT_PASS, max_retries=DEFAULT_MAX_RETRIES):
+    def __init__(self, HOST, PORT=DEFAULT_FTP_PORT, USER=DEFAULT_USER, PASSWORD=DEFAULT_PASS, max_retries=DEFAULT_MAX_RETRIES, max_connections=DEFAULT_MAX_CONNECTIONS, rate_limiter=None, reserve_connection=None, release_connection=None):
         # Due a misbehaviour in asyncio.open_connection with
         # EPSV connection in ftp-trace.ncbi.nih.gov
         # this only works always when HOST is an IP address
@@ -72,6 +105,13 @@ class FTPDownloader:
         self.PASSWORD = PASSWORD
         
         self.max_retries = max_retries
+        self.max_connections = max(1, max_connections)
+        self.rate_limiter = rate_limiter
+        # Additional connections are only opened when reserve_connection
+        # allows it (for instance, to honour a per host limit), and
+        # release_connection is called once they are closed
+        self.reserve_connection = reserve_connection
+        self.release_connection = release_connection
         # Trying to be adaptive to the aioftp implementation
         if hasattr(aioftp, "ClientSession"):
             # aioftp 0.16.x
@@ -80,6 +120,10 @@ class FTPDownloader:
             # aioftp 0.18.x
             self.aioSessMethod = aioftp.Client.context
 
+        # Persistent session (see connect), with its own event loop
+        self.loop = None
+        self.client = None
+
         # Getting a logger focused on specific classes
         self.logger = logging.getLogger(self.__class__.__name__)
 
@@ -88,43 +132,159 @@ class FTPDownloader:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        self.close()
+    
+    async def _open_client(self):
+        client = aioftp.Client()
+        await client.connect(self.HOST, self.PORT)
+        await client.login(self.USER, self.PASSWORD)
+        return client
     
-    async def __download_file_async(self, client, upload_file_path, dfdPath, dfdStat):
-        if upload_file_path.exists():
+    def connect(self):
+        """
+        It opens a persistent session, reused by the next downloads
+        until close is called. It has its own event loop, so it can
+        be used from any thread, but only from one at a time
+        """
+        if self.client is None:
+            self.loop = asyncio.new_event_loop()
+            try:
+                self.client = self.loop.run_until_complete(self._open_client())
+            except:
+                self.loop.close()
+                self.loop = None
+                raise
+    
+    def isActive(self):
+        """
+        It tells whether the persistent session is still alive
+        """
+        if self.client is None:
+            return False
+        
+        try:
+            self.loop.run_until_complete(asyncio.wait_for(self.client.get_current_directory(), self.DEFAULT_PROBE_TIMEOUT))
+        except Exception as e:
+            self.logger.debug(f"Persistent session to {self.HOST} is not alive: {e}")
+            return False
+        
+        return True
+    
+    def close(self):
+        """
+        It closes the persistent session, if any
+        """
+        if self.client is not None:
+            try:
+                self.loop.run_until_complete(asyncio.wait_for(self.client.quit(), self.DEFAULT_PROBE_TIMEOUT))
+            except Exception:
+                pass
+            self.client.close()
+            self.client = None
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
+    
+    def _run(self, method, *args):
+        """
+        It runs the method with either the persistent
+        session or a new one, which is closed afterwards
+        """
+        if self.client is not None:
+            return self.loop.run_until_complete(method(self.client, *args))
+        
+        async def run_with_session():
+            async with self.aioSessMethod(self.HOST, self.PORT, self.USER, self.PASSWORD) as client:
+                return await method(client, *args)
+        
+        tasks = (
+            run_with_session()
+            ,
+        )
+        return asyncio_run(tasks)
+    
+    @staticmethod
+    def _remote_mtime(dfdStat):
+        """
+        The modification time from the MDTM / MLST facts, if available
+        """
+        modify = dfdStat.get('modify')
+        if modify is None:
+            return None
+        
+        ttuple = datetime.datetime.strptime(modify[0:14],'%Y%m%d%H%M%S').timetuple()
+        return time.mktime(ttuple)
+    
+    def _is_up_to_date(self, upload_file_path, dfdStat):
+        """
+        A local copy is kept when both its size and
+        modification time match the remote ones
+        """
+        if not upload_file_path.exists():
+            return False
+        
+        localStat = upload_file_path.stat()
+        if int(dfdStat['size']) != localStat.st_size:
+            return False
+        
+        remote_mtime = self._remote_mtime(dfdStat)
+        return (remote_mtime is None) or (abs(localStat.st_mtime - remote_mtime) < 1)
+    
+    async def __download_file_async(self, client, upload_file_path, dfdPath, dfdStat, resume_root=None):
+        # Partial downloads from previous fetches are resumed
+        # when the remote file has not changed since then
+        resumeState = {
+            'size': dfdStat.get('size'),
+            'modify': dfdStat.get('modify'),
+        }
+        prevResumeState = readResumeState(str(upload_file_path), resume_root)
+        resume = upload_file_path.exists() and sameResumeState(prevResumeState, resumeState)
+        if resume:
+            # It keeps the checkpointed digest state
+            resumeState = prevResumeState
+        elif upload_file_path.exists():
             upload_file_path.unlink()  # Remove file before append stream to file
         upload_file_path.parent.mkdir(exist_ok=True, parents=True)  # Create dirs
+        writeResumeState(str(upload_file_path), resumeState, resume_root)
         
-        downloaded_size = 0
         # This is needed to detect reconnections
         stream = None
         retries = self.max_retries
-        while retries > 0:
-            try:
-                stream = await client.download_stream(dfdPath, offset=downloaded_size)
-                with upload_file_path.open(mode='ab', buffering=1024*1024) as wb:
-                    wb.seek(downloaded_size)
+        # The contents are digested while they are written. The sink
+        # is kept open among reconnections, as the stream is resumed
+        # (REST) from the number of bytes already written
+        with DigestingFile(str(upload_file_path), buffering=1024*1024, resume=resume, resumeState=resumeState, resumeRoot=resume_root) as wb:
+            if wb.size > 0:
+                self.logger.info(f"Resuming download of {dfdPath} from byte {wb.size}")
+            while retries > 0:
+                try:
+                    stream = await client.download_stream(dfdPath, offset=wb.size)
                     async for block in stream.iter_by_block():
                         wb.write(block)
-                        downloaded_size += sys.getsizeof(block)
+                        if self.rate_limiter is not None:
+                            await self.rate_limiter.consume(len(block))
                         #self.logger.debug(
-                        #    f'Loading: {math.floor(downloaded_size / ftp_file_size * 100)}%...')
+                        #    f'Loading: {math.floor(wb.size / ftp_file_size * 100)}%...')
                     await stream.finish()
-                
-                ttuple = datetime.datetime.strptime(dfdStat['modify'],'%Y%m%d%H%M%S').timetuple()
-                ttime = time.mktime(ttuple)
-                os.utime(upload_file_path, (ttime, ttime))
-    
-                break
-            except ConnectionResetError:
-                self.logger.debug("Reconnecting")
-                await self._reconnect(client)
-            except Exception as e:
-                retries -= 1
-                self.logger.debug("Left {} retries".format(retries))
-                if retries == 0:
-                    raise e
-                await self._reconnect(client)
+                    
+                    # Modification time is set on close, before registering the digest
+                    wb.mtime = self._remote_mtime(dfdStat)
+                    
+                    break
+                except Exception as e:
+                    # Both resets and other errors count, so a server
+                    # continuously dropping the connection is not retried forever
+                    retries -= 1
+                    self.logger.debug("Download of {} failed ({}). Left {} retries".format(dfdPath, e, retries))
+                    if retries == 0:
+                        raise e
+                    try:
+                        await self._reconnect(client)
+                    except Exception as re:
+                        # Next attempt fails, consuming a retry
+                        self.logger.debug("Unable to reconnect ({})".format(re))
+        
+        clearResumeState(str(upload_file_path), resume_root)
         
     async def _reconnect(self, client):
         self.logger.debug("Reconnecting")
@@ -161,33 +321,38 @@ class FTPDownloader:
                     raise e
                 await self._reconnect(client)
         
+        # The resume states of the files are kept apart from the mirrored directory
+        resume_root = str(utdPath)
         downloaded_path = []
         if files_list:
             self.logger.debug(f'({len(files_list)}) {dfdPath} -> '
                                  f'{utdPath}')
+            # Files are pulled from a queue by several connections
+            queue = asyncio.Queue()
             for i, (path, info) in enumerate(files_list):
-                download = False
                 upload_file_path = Path.joinpath(
                     utdPath, path.relative_to(dfdPath)
                 )
-                destination_dir = upload_file_path.parents[0]
-                file_name = path.name
-                
-                if upload_file_path.exists():
-                    ftp_file_size = int(info['size'])
-                    local_file_size = upload_file_path.stat().st_size
-                    # TODO diff creation time too
-                    if ftp_file_size != local_file_size:
-                        download = True
-                else:
-                    download = True
                 
                 downloaded_path.append(upload_file_path)
-                self.logger.debug(
-                    f'({i + 1}/{len(files_list)}) {file_name} -> ../{path}')
-                if download:
-                    await self.__download_file_async(client, upload_file_path, path, info)
-                    self.logger.info('Loading: Complete')
+                if self._is_up_to_date(upload_file_path, info):
+                    clearResumeState(str(upload_file_path), resume_root)
+                else:
+                    queue.put_nowait((i, path, info, upload_file_path))
+            
+            num_workers = min(self.max_connections, queue.qsize())
+            self.logger.debug(f'{queue.qsize()} files to download through {num_workers} connections')
+            failures = []
+            await asyncio.gather(*(
+                self._mirror_worker(client  if i_worker == 0  else  None, queue, len(files_list), failures, resume_root)
+                for i_worker in range(num_workers)
+            ))
+            
+            if failures:
+                failures.sort(key=lambda failure: failure[0])
+                raise failures[0][1]
+            
+            clearResumeStates(resume_root)
         else:
             self.logger.warning('Nothing new to download')
 #                self.clear_tasks()
@@ -195,6 +360,50 @@ class FTPDownloader:
         
         return downloaded_path
 
+    async def _mirror_worker(self, client, queue, num_files, failures, resume_root=None):
+        """
+        It downloads the queued files, using either the
+        given client or a new one, which is closed afterwards
+        """
+        own_client = client is None
+        if own_client:
+            if (self.reserve_connection is not None) and not self.reserve_connection():
+                self.logger.debug(f"No additional connection to {self.HOST} is allowed. Fewer files are fetched in parallel")
+                return
+            try:
+                client = await self._open_client()
+            except Exception as e:
+                self.logger.warning(f"Unable to open an additional connection to {self.HOST} ({e}). Fewer files are fetched in parallel")
+                if self.release_connection is not None:
+                    self.release_connection()
+                return
+        
+        try:
+            while True:
+                try:
+                    i, path, info, upload_file_path = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                
+                self.logger.debug(
+                    f'({i + 1}/{num_files}) {path.name} -> ../{path}')
+                try:
+                    await self.__download_file_async(client, upload_file_path, path, info, resume_root)
+                    self.logger.info('Loading: Complete')
+                except Exception as e:
+                    # The other files are still fetched
+                    self.logger.error(f"Unable to download {path}: {e}")
+                    failures.append((i, e))
+        finally:
+            if own_client:
+                try:
+                    await client.quit()
+                except:
+                    pass
+                client.close()
+                if self.release_connection is not None:
+                    self.release_connection()
+    
     async def _download_file_async(self, client, dfdPath, utdPath):
         """
         dfdPath must be absolute
@@ -207,15 +416,9 @@ class FTPDownloader:
         destination_dir = utdPath.parent
         
         dfdStat = await client.stat(dfdPath)
-        ftp_file_size = int(dfdStat['size'])
-        download = False
-        if upload_file_path.exists():
-            local_file_size = upload_file_path.stat().st_size
-            # TODO diff creation time too
-            if ftp_file_size != local_file_size:
-                download = True
-        else:
-            download = True
+        download = not self._is_up_to_date(upload_file_path, dfdStat)
+        if not download:
+            clearResumeState(str(upload_file_path))
         
         self.logger.debug(f'{dfdPath} -> '
                              f'{upload_file_path}')
@@ -229,35 +432,33 @@ class FTPDownloader:
         
         return upload_file_path
 
-    async def download_dir_async(self, download_from_dir, upload_to_dir, exclude_ext):
+    async def download_dir_async(self, client, download_from_dir, upload_to_dir, exclude_ext):
         dfdPath = Path(download_from_dir)
         destdir = os.path.abspath(upload_to_dir)
         os.makedirs(destdir, exist_ok=True)
         utdPath = Path(destdir)
         
-        async with self.aioSessMethod(self.HOST, self.PORT, self.USER, self.PASSWORD) as client:
-            # Changing to absolute path
-            if not dfdPath.is_absolute():
-                currRemoteDir = await client.get_current_directory()
-                dfdPath = currRemoteDir.joinpath(dfdPath).resolve()
-            
-            retval = await self._download_dir_async(client, dfdPath, utdPath, exclude_ext)
-            return retval
+        # Changing to absolute path
+        if not dfdPath.is_absolute():
+            currRemoteDir = await client.get_current_directory()
+            dfdPath = currRemoteDir.joinpath(dfdPath).resolve()
+        
+        retval = await self._download_dir_async(client, dfdPath, utdPath, exclude_ext)
+        return retval
     
-    async def download_file_async(self, download_from_file, upload_to_file):
+    async def download_file_async(self, client, download_from_file, upload_to_file):
         dfdPath = Path(download_from_file)
         destfile = os.path.abspath(upload_to_file)
         utdPath = Path(destfile)
-        async with self.aioSessMethod(self.HOST, self.PORT, self.USER, self.PASSWORD) as client:
-            # Changing to absolute path
-            if not dfdPath.is_absolute():
-                currRemoteDir = await client.get_current_directory()
-                dfdPath = currRemoteDir.joinpath(dfdPath).resolve()
-            
-            retval = await self._download_file_async(client, dfdPath, utdPath)
-            return retval
+        # Changing to absolute path
+        if not dfdPath.is_absolute():
+            currRemoteDir = await client.get_current_directory()
+            dfdPath = currRemoteDir.joinpath(dfdPath).resolve()
+        
+        retval = await self._download_file_async(client, dfdPath, utdPath)
+        return retval
     
-    async def download_async(self, download_from_df, upload_to_df, exclude_ext):
+    async def download_async(self, client, download_from_df, upload_to_df, exclude_ext):
         """
         This method returns a Path when a file is fetched
         and a list of Path when it is a directory
@@ -265,41 +466,28 @@ class FTPDownloader:
         dfdPath = Path(download_from_df)
         destpath = os.path.abspath(upload_to_df)
         utdPath = Path(destpath)
-        async with self.aioSessMethod(self.HOST, self.PORT, self.USER, self.PASSWORD) as client:
-            # Changing to absolute path
-            if not dfdPath.is_absolute():
-                currRemoteDir = await client.get_current_directory()
-                dfdPath = currRemoteDir.joinpath(dfdPath).resolve()
-            
-            dfdStat = await client.stat(dfdPath)
-            if dfdStat['type'] == 'dir':
-                os.makedirs(destpath, exist_ok=True)
-                retval = await self._download_dir_async(client, dfdPath, utdPath, exclude_ext)
-            else:
-                retval = await self._download_file_async(client, dfdPath, utdPath)
-            
-            return retval
+        # Changing to absolute path
+        if not dfdPath.is_absolute():
+            currRemoteDir = await client.get_current_directory()
+            dfdPath = currRemoteDir.joinpath(dfdPath).resolve()
+        
+        dfdStat = await client.stat(dfdPath)
+        if dfdStat['type'] == 'dir':
+            os.makedirs(destpath, exist_ok=True)
+            retval = await self._download_dir_async(client, dfdPath, utdPath, exclude_ext)
+        else:
+            retval = await self._download_file_async(client, dfdPath, utdPath)
+        
+        return retval
     
     def download_dir(self, download_from_dir, upload_to_dir='.', exclude_ext=[]):
-        tasks = (
-            self.download_dir_async(download_from_dir, upload_to_dir, exclude_ext)
-            ,
-        )
-        return asyncio_run(tasks)
+        return self._run(self.download_dir_async, download_from_dir, upload_to_dir, exclude_ext)
     
     def download_file(self, download_from_file, upload_to_file):
-        tasks = (
-            self.download_file_async(download_from_file, upload_to_file)
-            ,
-        )
-        return asyncio_run(tasks)
+        return self._run(self.download_file_async, download_from_file, upload_to_file)
     
     def download(self, download_path, upload_path, exclude_ext=[]):
-        tasks = (
-            self.download_async(download_path, upload_path, exclude_ext)
-            ,
-        )
-        return asyncio_run(tasks)
+        return self._run(self.download_async, download_path, upload_path, exclude_ext)
 
     @staticmethod
     def clear_tasks():
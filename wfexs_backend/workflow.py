@@ -17,6 +17,8 @@
 from __future__ import absolute_import
 
 import atexit
+import collections
+import concurrent.futures
 import http
 import inspect
 import io
@@ -33,7 +35,7 @@ import types
 import uuid
 
 from pathlib import Path
-from typing import List, Mapping, Pattern, Tuple, Type, Union
+from typing import Any, Iterator, List, Mapping, Optional, Pattern, Tuple, Type, Union
 from urllib import request, parse
 
 from rocrate import rocrate
@@ -58,17 +60,22 @@ from .engine import WORKDIR_WORKFLOW_META_FILE, WORKDIR_SECURITY_CONTEXT_FILE, W
 from .engine import WORKDIR_MARSHALLED_STAGE_FILE, WORKDIR_MARSHALLED_EXECUTE_FILE, WORKDIR_MARSHALLED_EXPORT_FILE
 from .engine import WORKDIR_INPUTS_RELDIR, WORKDIR_INTERMEDIATE_RELDIR, WORKDIR_META_RELDIR, WORKDIR_OUTPUTS_RELDIR, \
     WORKDIR_ENGINE_TWEAKS_RELDIR
-from .cache_handler import SchemeHandlerCacheHandler
+from .cache_handler import SchemeHandlerCacheHandler, DEFAULT_FAILED_TTL
+from .digest_store import DigestStore
 
 from .utils.marshalling_handling import marshall_namedtuple, unmarshall_namedtuple
 
 from .fetchers import AbstractStatefulFetcher
 from .fetchers import DEFAULT_SCHEME_HANDLERS
+from .fetchers import DEFAULT_PARALLEL_DOWNLOAD_STREAMS, DEFAULT_PARALLEL_DOWNLOAD_CHUNK_SIZE, DEFAULT_PARALLEL_DOWNLOAD_MIN_SIZE, setParallelDownloads, getSessionPool, setSessionPool, DEFAULT_FTP_CONNECTIONS, setFTPDownloads, DEFAULT_FILE_STRATEGY, setFileStrategy
+from .session_pool import SessionPool
 from .fetchers.git import SCHEME_HANDLERS as GIT_SCHEME_HANDLERS, GitFetcher
 from .fetchers.pride import SCHEME_HANDLERS as PRIDE_SCHEME_HANDLERS
 from .fetchers.trs_files import INTERNAL_TRS_SCHEME_PREFIX, SCHEME_HANDLERS as INTERNAL_TRS_SCHEME_HANDLERS
 from .fetchers.s3 import S3_SCHEME_HANDLERS as S3_SCHEME_HANDLERS
+from .fetchers.s3 import DEFAULT_S3_CONCURRENT_KEYS, DEFAULT_S3_PART_CONCURRENCY, DEFAULT_S3_MULTIPART_THRESHOLD, DEFAULT_S3_PART_SIZE, setS3Transfers
 from .fetchers.gs import GS_SCHEME_HANDLERS as GS_SCHEME_HANDLERS
+from .fetchers.gs import GS_CHECKSUM_PROBES, DEFAULT_GS_CONCURRENT_BLOBS, DEFAULT_GS_SLICES, DEFAULT_GS_SLICED_THRESHOLD, DEFAULT_GS_SLICE_SIZE, setGSTransfers
 
 from .nextflow_engine import NextflowWorkflowEngine
 from .cwl_engine import CWLWorkflowEngine
@@ -90,6 +97,10 @@ class WF:
 
     DEFAULT_PASSPHRASE_LENGTH = 4
 
+    # Inputs fetched at once, in total and from the same host
+    DEFAULT_MAX_CONCURRENT_FETCHES = 4
+    DEFAULT_MAX_CONCURRENT_FETCHES_PER_HOST = 2
+
     CRYPT4GH_SECTION = 'crypt4gh'
     CRYPT4GH_PRIVKEY_KEY = 'key'
     CRYPT4GH_PUBKEY_KEY = 'pub'
@@ -362,6 +373,90 @@ class WF:
         os.makedirs(cacheWorkflowInputsDir, exist_ok=True)
         self.cachePathMap[CacheType.Input] = cacheWorkflowInputsDir
 
+        # Cache eviction setup
+        cacheSect = local_config.get('cache', {})
+        cacheGCSect = cacheSect.get('gc', {})
+        self.cacheGCPolicy = CacheGCPolicy(cacheGCSect.get('policy', DEFAULT_CACHE_GC_POLICY.value))
+        self.cacheGCAuto = cacheGCSect.get('auto', False)
+        self.cacheGCLimits = dict()
+        for cache_type_str, limits in cacheGCSect.get('limits', {}).items():
+            maxSize = limits.get('maxSize')
+            maxAgeDays = limits.get('maxAgeDays')
+            self.cacheGCLimits[CacheType(cache_type_str)] = (
+                None  if maxSize is None  else  parseByteSize(maxSize),
+                None  if maxAgeDays is None  else  maxAgeDays * 86400.0
+            )
+        self.cacheFailedTTL = cacheSect.get('failed', {}).get('ttl', DEFAULT_FAILED_TTL)
+        self.cacheSortQuerySchemes = cacheSect.get('uris', {}).get('sortQuery', [])
+
+        # Persistent store of the digests of files, so
+        # they are not computed again on each run
+        cacheDigestsSect = cacheSect.get('digests', {})
+        self.digestStore = None
+        if cacheDigestsSect.get('enabled', True):
+            self.digestStore = DigestStore(
+                os.path.join(cacheDir, DigestStore.DEFAULT_FILENAME),
+                maxEntries=cacheDigestsSect.get('maxEntries', DigestStore.DEFAULT_MAX_ENTRIES),
+                policy=CacheGCPolicy(cacheDigestsSect.get('policy', DEFAULT_CACHE_GC_POLICY.value)),
+                strict=cacheDigestsSect.get('strict', False)
+            )
+            # Access statistics are recorded in batches
+            atexit.register(self.digestStore.flush)
+        setDigestStore(self.digestStore)
+        setDigestWorkers(cacheDigestsSect.get('workers', DEFAULT_DIGEST_WORKERS))
+        setInternalDigestAlgorithm(cacheDigestsSect.get('internalAlgorithm', DEFAULT_INTERNAL_DIGEST_ALGORITHM))
+
+        # Fetchers setup
+        fetchersSect = local_config.get('fetchers', {})
+        self.maxConcurrentFetches = fetchersSect.get('maxConcurrent', self.DEFAULT_MAX_CONCURRENT_FETCHES)
+        self.maxConcurrentFetchesPerHost = fetchersSect.get('maxConcurrentPerHost', self.DEFAULT_MAX_CONCURRENT_FETCHES_PER_HOST)
+        httpParallelSect = fetchersSect.get('http', {}).get('parallel', {})
+        setParallelDownloads(
+            streams=httpParallelSect.get('streams', DEFAULT_PARALLEL_DOWNLOAD_STREAMS),
+            chunkSize=parseByteSize(httpParallelSect.get('chunkSize', DEFAULT_PARALLEL_DOWNLOAD_CHUNK_SIZE)),
+            minSize=parseByteSize(httpParallelSect.get('minSize', DEFAULT_PARALLEL_DOWNLOAD_MIN_SIZE))
+        )
+
+        ftpSect = fetchersSect.get('ftp', {})
+        ftpMaxRate = ftpSect.get('maxRate')
+        setFTPDownloads(
+            connections=ftpSect.get('connections', DEFAULT_FTP_CONNECTIONS),
+            maxRate=None  if ftpMaxRate is None  else  parseByteSize(ftpMaxRate)
+        )
+
+        s3Sect = fetchersSect.get('s3', {})
+        setS3Transfers(
+            concurrentKeys=s3Sect.get('concurrentKeys', DEFAULT_S3_CONCURRENT_KEYS),
+            partConcurrency=s3Sect.get('partConcurrency', DEFAULT_S3_PART_CONCURRENCY),
+            multipartThreshold=parseByteSize(s3Sect.get('multipartThreshold', DEFAULT_S3_MULTIPART_THRESHOLD)),
+            partSize=parseByteSize(s3Sect.get('partSize', DEFAULT_S3_PART_SIZE))
+        )
+
+        gsSect = fetchersSect.get('gs', {})
+        setGSTransfers(
+            concurrentBlobs=gsSect.get('concurrentBlobs', DEFAULT_GS_CONCURRENT_BLOBS),
+            slices=gsSect.get('slices', DEFAULT_GS_SLICES),
+            slicedThreshold=parseByteSize(gsSect.get('slicedThreshold', DEFAULT_GS_SLICED_THRESHOLD)),
+            sliceSize=parseByteSize(gsSect.get('sliceSize', DEFAULT_GS_SLICE_SIZE))
+        )
+
+        fileSect = fetchersSect.get('file', {})
+        setFileStrategy(fileSect.get('strategy', DEFAULT_FILE_STRATEGY))
+
+        # Connections reused among fetches from the same host. The pool
+        # is installed for the whole process, so the previous one is
+        # restored on cleanup
+        sessionsSect = fetchersSect.get('sessions', {})
+        self.sessionPool = None
+        self._previousSessionPool = getSessionPool()
+        if sessionsSect.get('enabled', True):
+            self.sessionPool = SessionPool(
+                idleTimeout=sessionsSect.get('idleTimeout', SessionPool.DEFAULT_IDLE_TIMEOUT),
+                maxPerHost=sessionsSect.get('maxPerHost', SessionPool.DEFAULT_MAX_PER_HOST)
+            )
+            atexit.register(self.sessionPool.close)
+        setSessionPool(self.sessionPool)
+
         # This directory will be used to store the intermediate
         # and final results before they are sent away
         workDir = local_config.get('workDir')
@@ -390,13 +485,14 @@ class WF:
 
         # cacheHandler is created on first use
         self._sngltn = dict()
-        self.cacheHandler = SchemeHandlerCacheHandler(self.cacheDir, dict())
+        self.cacheHandler = SchemeHandlerCacheHandler(self.cacheDir, dict(), failedTTL=self.cacheFailedTTL, sortQuerySchemes=self.cacheSortQuerySchemes)
 
         # All the custom ones should be added here
         self.cacheHandler.addSchemeHandlers(PRIDE_SCHEME_HANDLERS)
         self.cacheHandler.addSchemeHandlers(INTERNAL_TRS_SCHEME_HANDLERS)
         self.cacheHandler.addSchemeHandlers(S3_SCHEME_HANDLERS)
         self.cacheHandler.addSchemeHandlers(GS_SCHEME_HANDLERS)
+        self.cacheHandler.addChecksumProbes(GS_CHECKSUM_PROBES)
 
         # These ones should have prevalence over other custom ones
         self.addSchemeHandlers(GIT_SCHEME_HANDLERS)
@@ -421,6 +517,39 @@ class WF:
     def getCacheHandler(self, cache_type:CacheType) -> Tuple[SchemeHandlerCacheHandler, AbsPath]:
         return self.cacheHandler, self.cachePathMap.get(cache_type)
 
+    def getCacheGCLimits(self, cache_type:CacheType) -> Tuple[Optional[int], Optional[float]]:
+        """
+        It returns the configured size (in bytes) and age (in seconds)
+        limits of a cache
+        """
+        return self.cacheGCLimits.get(cache_type, (None, None))
+
+    def cacheGC(self, dryRun:bool=False) -> List[Tuple[CacheType, AbsPath, int, List[URIType]]]:
+        """
+        Garbage collection pass over all the caches with configured limits
+        """
+        evicted = []
+        for cache_type, (maxSize, maxAge) in self.cacheGCLimits.items():
+            cH, cPath = self.getCacheHandler(cache_type)
+            for evictedPath, evictedSize, evictedURIs in cH.gc(cPath, maxSize=maxSize, maxAge=maxAge, policy=self.cacheGCPolicy, dryRun=dryRun):
+                evicted.append((cache_type, evictedPath, evictedSize, evictedURIs))
+
+        if (self.digestStore is not None) and not dryRun:
+            self.digestStore.evict()
+
+        if len(evicted) > 0:
+            self.logger.info("Cache garbage collection evicted {} entries ({} bytes)".format(len(evicted), sum(map(lambda e: e[2], evicted))))
+
+        return evicted
+
+    def _registerCacheReference(self, destdir:AbsPath, cachedFilename:AbsPath) -> None:
+        """
+        Cached contents used by this working directory
+        are protected from the cache garbage collection
+        """
+        if (self.rawWorkDir is not None) and (cachedFilename is not None):
+            self.cacheHandler.addReference(destdir, cachedFilename, self.rawWorkDir)
+
     def instantiateStatefulFetcher(self, statefulFetcher: Type[AbstractStatefulFetcher]) -> AbstractStatefulFetcher:
         """
         Method to instantiate stateful fetchers once
@@ -758,6 +887,12 @@ class WF:
 
     def cleanup(self):
         self.unmountWorkdir()
+        # Other instances could have installed their own pool meanwhile
+        if getSessionPool() is self.sessionPool:
+            previousSessionPool = self._previousSessionPool
+            setSessionPool(None  if (previousSessionPool is None) or previousSessionPool.closed  else  previousSessionPool)
+        if self.sessionPool is not None:
+            self.sessionPool.close()
 
     def fromWorkDir(self, workflowWorkingDirectory):
         if workflowWorkingDirectory is None:
@@ -1082,11 +1217,125 @@ class WF:
                                                 lastInput=lastInput)
         self.materializedParams = theParams
 
+    @staticmethod
+    def _inputRemoteFiles(linearKey: str, inputs) -> List[Tuple[URIType, Optional[str]]]:
+        """
+        The URLs of a File or Directory input, along with their declared checksums
+        """
+        remote_files = inputs['url']
+        if not isinstance(remote_files, list):  # more than one input file
+            remote_files = [remote_files]
+
+        # Declared checksums, one per URL
+        checksums = inputs.get('checksum')
+        if checksums is None:
+            checksums = [None] * len(remote_files)
+        elif not isinstance(checksums, list):
+            checksums = [checksums]
+        if len(checksums) != len(remote_files):
+            raise WFException(
+                'Input "{}" declares {} checksums for {} URLs'.format(linearKey, len(checksums), len(remote_files)))
+
+        return list(zip(remote_files, checksums))
+
+    def _inputFetchRequests(self, params, workflowInputs_destdir: AbsPath, workflowInputs_cacheDir: AbsPath,
+                            prefix='') -> Iterator[Tuple[Tuple[str, int], URIType, Mapping[str, Any]]]:
+        """
+        It walks the params as fetchInputs does, yielding the key of each
+        URL to be fetched, the URL and the parameters of downloadInputFile
+        """
+        paramsIter = params.items() if isinstance(params, dict) else enumerate(params)
+        for key, inputs in paramsIter:
+            linearKey = prefix + key
+            if not isinstance(inputs, dict):
+                continue
+
+            inputClass = inputs.get('c-l-a-s-s')
+            if inputClass is None:
+                # possible nested files
+                yield from self._inputFetchRequests(inputs, workflowInputs_destdir, workflowInputs_cacheDir,
+                                                    prefix=linearKey + '.')
+            elif inputClass in ("File", "Directory") and not inputs.get('autoFill', False):
+                cacheable = not self.paranoidMode if inputs.get('cache', True) else False
+                # The storage dir depends on whether it can be cached or not
+                if cacheable:
+                    storeDir = workflowInputs_cacheDir
+                elif inputClass == 'Directory':
+                    storeDir = os.path.join(workflowInputs_destdir, *linearKey.split('.'))
+                    os.makedirs(storeDir, exist_ok=True)
+                else:
+                    storeDir = workflowInputs_destdir
+
+                for iRemote, (remote_file, checksum) in enumerate(self._inputRemoteFiles(linearKey, inputs)):
+                    yield (linearKey, iRemote), remote_file, {
+                        'workflowInputs_destdir': storeDir,
+                        'contextName': inputs.get('security-context'),
+                        'ignoreCache': not cacheable,
+                        'registerInCache': cacheable,
+                        'revalidate': inputs.get('revalidate', False),
+                        'checksum': checksum,
+                    }
+
+    def prefetchInputs(self, params, workflowInputs_destdir: AbsPath = None, workflowInputs_cacheDir: AbsPath = None,
+                       prefix='', offline: bool = False) -> Mapping[Tuple[str, int], MaterializedContent]:
+        """
+        Concurrent fetch of all the input URLs, bounded both in total and
+        per host. Fetches are started in the order of the params, and all
+        the failed ones are reported at once
+
+        :return: The fetched contents, keyed by input name and URL index
+        """
+        fetchRequests = list(self._inputFetchRequests(params, workflowInputs_destdir, workflowInputs_cacheDir, prefix=prefix))
+
+        fetched = dict()
+        failures = []
+        pending = list(range(len(fetchRequests)))
+        running = dict()
+        hostLoad = collections.Counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.maxConcurrentFetches)) as executor:
+            while (len(pending) > 0) or (len(running) > 0):
+                # The first pending fetches whose hosts are not saturated are started
+                for iRequest in list(pending):
+                    if len(running) >= self.maxConcurrentFetches:
+                        break
+
+                    _ , remote_file, kwargs = fetchRequests[iRequest]
+                    parsedInputURL = parse.urlparse(remote_file)
+                    host = parsedInputURL.hostname if parsedInputURL.hostname is not None else parsedInputURL.scheme
+                    if hostLoad[host] >= self.maxConcurrentFetchesPerHost:
+                        continue
+
+                    pending.remove(iRequest)
+                    hostLoad[host] += 1
+                    running[executor.submit(self.downloadInputFile, remote_file, offline=offline, **kwargs)] = (iRequest, host)
+
+                done, _ = concurrent.futures.wait(running.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    iRequest, host = running.pop(future)
+                    hostLoad[host] -= 1
+                    key, remote_file, _ = fetchRequests[iRequest]
+                    try:
+                        fetched[key] = future.result()
+                    except Exception as e:
+                        self.logger.error('Unable to fetch input {} from {}: {}'.format(key[0], remote_file, e))
+                        failures.append((iRequest, e))
+
+        if len(failures) > 0:
+            failures.sort(key=lambda failure: failure[0])
+            raise WFException('{} input URLs could not be fetched:\n'.format(len(failures)) + '\n'.join(
+                map(lambda failure: '- {} ({}): {}'.format(fetchRequests[failure[0]][0][0], fetchRequests[failure[0]][1], failure[1]), failures)
+            )) from failures[0][1]
+
+        return fetched
+
     def fetchInputs(self, params, workflowInputs_destdir: AbsPath = None, workflowInputs_cacheDir: AbsPath = None,
-                    prefix='', lastInput=0, offline: bool = False) -> Tuple[List[MaterializedInput], int]:
+                    prefix='', lastInput=0, offline: bool = False,
+                    prefetched: Optional[Mapping[Tuple[str, int], MaterializedContent]] = None) -> Tuple[List[MaterializedInput], int]:
         """
         Fetch the input files for the workflow execution.
         All the inputs must be URLs or CURIEs from identifiers.org / n2t.net.
+        The URLs are fetched concurrently beforehand (see prefetchInputs),
+        so the numbering and order of the inputs does not depend on it.
 
         :param params: Optional params for the workflow execution.
         :param workflowInputs_destdir:
@@ -1094,9 +1343,15 @@ class WF:
         :param workflowInputs_cacheDir:
         :param lastInput:
         :param offline:
+        :param prefetched: Already fetched contents, keyed by input name and URL index
         :type params: dict
         :type prefix: str
         """
+        if prefetched is None:
+            prefetched = self.prefetchInputs(params, workflowInputs_destdir=workflowInputs_destdir,
+                                             workflowInputs_cacheDir=workflowInputs_cacheDir, prefix=prefix,
+                                             offline=offline)
+
         theInputs = []
 
         paramsIter = params.items() if isinstance(params, dict) else enumerate(params)
@@ -1138,25 +1393,11 @@ class WF:
                             theInputs.append(MaterializedInput(linearKey, [autoFilledFile]))
                             continue
 
-                        remote_files = inputs['url']
-                        cacheable = not self.paranoidMode if inputs.get('cache', True) else False
-                        if not isinstance(remote_files, list):  # more than one input file
-                            remote_files = [remote_files]
-
                         remote_pairs = []
-                        # The storage dir depends on whether it can be cached or not
-                        storeDir = workflowInputs_cacheDir if cacheable else inputDestDir
-                        for remote_file in remote_files:
-                            # We are sending the context name thinking in the future,
-                            # as it could contain potential hints for authenticated access
-                            contextName = inputs.get('security-context')
-                            matContent = self.downloadInputFile(remote_file,
-                                                                workflowInputs_destdir=storeDir,
-                                                                contextName=contextName,
-                                                                offline=offline,
-                                                                ignoreCache=not cacheable,
-                                                                registerInCache=cacheable,
-                                                                )
+                        for iRemote, _ in enumerate(self._inputRemoteFiles(linearKey, inputs)):
+                            # It was already fetched, either from
+                            # the cache or using the security context
+                            matContent = prefetched[(linearKey, iRemote)]
 
                             # Now, time to create the symbolic link
                             lastInput += 1
@@ -1217,7 +1458,7 @@ class WF:
                                                                      workflowInputs_destdir=workflowInputs_destdir,
                                                                      workflowInputs_cacheDir=workflowInputs_cacheDir,
                                                                      prefix=linearKey + '.', lastInput=lastInput,
-                                                                     offline=offline)
+                                                                     offline=offline, prefetched=prefetched)
                     theInputs.extend(newInputsAndParams)
             else:
                 if not isinstance(inputs, list):
@@ -1236,6 +1477,9 @@ class WF:
         self.materializeInputs()
         self.marshallStage()
 
+        if self.cacheGCAuto:
+            self.cacheGC()
+
         return self.instanceId
 
     def workdirToBagit(self):
@@ -1620,6 +1864,9 @@ class WF:
                 }
                 if isinstance(itemOutValues, GeneratedDirectoryContent):    # if is a directory
                     if os.path.isdir(itemOutSource):
+                        # The signature is not reused, as the one built from a CWL listing
+                        # only covers the direct files. The files are not read again,
+                        # as their digests were already remembered
                         generatedDirectoryContentURI = ComputeDigestFromDirectory(itemOutSource, repMethod=nihDigest)   # generate nih for the directory
                         dirProperties = dict.fromkeys(['hasPart'])  # files in the directory
                         generatedContentList = []
@@ -1718,8 +1965,11 @@ class WF:
                 )
             ],
             finalCachedFilename=repoDir,
-            inputKind=ContentKind.Directory
+            inputKind=ContentKind.Directory,
+            # Checkouts can be evicted, as they are cloned again when needed
+            owned=True
         )
+        self._registerCacheReference(self.cacheWorkflowDir, repoDir)
 
         return repoDir, repoEffectiveCheckout
 
@@ -1736,15 +1986,23 @@ class WF:
         # Needed to store this metadata
         trsMetadataCache = os.path.join(self.metaDir, self.TRS_METADATA_FILE)
 
-        try:
-            metaContentKind, cachedTRSMetaFile, trsMetaMeta = self.cacheHandler.fetch(trs_endpoint_v2_meta, self.metaDir, offline)
-            trs_endpoint_meta = trs_endpoint_v2_meta
-        except WFException as wfe:
-            try:
-                metaContentKind, cachedTRSMetaFile, trsMetaMeta = self.cacheHandler.fetch(trs_endpoint_v2_beta2_meta, self.metaDir, offline)
-                trs_endpoint_meta = trs_endpoint_v2_beta2_meta
-            except WFException as wfebeta:
-                raise WFException("Unable to fetch metadata from {} in order to identify whether it is a working GA4GH TRSv2 endpoint. Exceptions:\n{}\n{}".format(self.trs_endpoint, wfe, wfebeta))
+        # Already cached answers are looked for before hitting the network,
+        # and probes which recently failed are skipped by the cache handler
+        probeErrors = []
+        for probeOffline in ((True,)  if offline  else  (True, False)):
+            for trs_endpoint_probe in (trs_endpoint_v2_meta, trs_endpoint_v2_beta2_meta):
+                try:
+                    metaContentKind, cachedTRSMetaFile, trsMetaMeta = self.cacheHandler.fetch(trs_endpoint_probe, self.metaDir, probeOffline)
+                    trs_endpoint_meta = trs_endpoint_probe
+                    break
+                except WFException as wfe:
+                    if not probeOffline or offline:
+                        probeErrors.append(wfe)
+
+            if trs_endpoint_meta is not None:
+                break
+        else:
+            raise WFException("Unable to fetch metadata from {} in order to identify whether it is a working GA4GH TRSv2 endpoint. Exceptions:\n{}".format(self.trs_endpoint, '\n'.join(map(str, probeErrors))))
 
         # Giving a friendly name
         if not os.path.exists(trsMetadataCache):
@@ -1860,6 +2118,7 @@ class WF:
             # Learning the available files and maybe
             # which is the entrypoint to the workflow
             _, trsFilesDir, trsFilesMeta = self.cacheHandler.fetch(INTERNAL_TRS_SCHEME_PREFIX + ':' + toolFilesURL, self.cacheTRSFilesDir, offline)
+            self._registerCacheReference(self.cacheTRSFilesDir, trsFilesDir)
 
             expectedEngineDesc = self.RECOGNIZED_TRS_DESCRIPTORS[chosenDescriptorType]
             remote_workflow_entrypoint = trsFilesMeta[0].metadata.get('remote_workflow_entrypoint')
@@ -2074,6 +2333,7 @@ class WF:
             roCK, roCrateFile, _ = self.cacheHandler.fetch(roCrateURL, self.cacheROCrateDir, offline)
         except Exception as e:
             raise WFException("Cannot download RO-Crate from {}, {}".format(roCrateURL, e))
+        self._registerCacheReference(self.cacheROCrateDir, roCrateFile)
 
         crate_hashed_id = hashlib.sha1(roCrateURL.encode('utf-8')).hexdigest()
         cachedFilename = os.path.join(self.cacheROCrateDir, crate_hashed_id + self.DEFAULT_RO_EXTENSION)
@@ -2085,7 +2345,7 @@ class WF:
         return cachedFilename
 
     def downloadInputFile(self, remote_file, workflowInputs_destdir: AbsPath = None,
-                          contextName=None, offline: bool = False, ignoreCache:bool=False, registerInCache:bool=True) -> MaterializedContent:
+                          contextName=None, offline: bool = False, ignoreCache:bool=False, registerInCache:bool=True, revalidate:bool=False, checksum:Optional[str]=None) -> MaterializedContent:
         """
         Download remote file or directory / dataset.
 
@@ -2093,6 +2353,8 @@ class WF:
         :param contextName:
         :param workflowInputs_destdir:
         :param offline:
+        :param revalidate: Revalidate cached http(s) contents through conditional requests
+        :param checksum: Declared checksum, used to find the contents already cached from other URIs, and to verify the fetched ones
         :type remote_file: str
         """
         parsedInputURL = parse.urlparse(remote_file)
@@ -2117,8 +2379,10 @@ class WF:
                     raise WFException(
                         'No security context {} is available, needed by {}'.format(contextName, remote_file))
 
-            inputKind, cachedFilename, metadata_array = self.cacheHandler.fetch(remote_file, workflowInputs_destdir, offline, ignoreCache, registerInCache, secContext)
+            inputKind, cachedFilename, metadata_array = self.cacheHandler.fetch(remote_file, workflowInputs_destdir, offline, ignoreCache, registerInCache, secContext, revalidate=revalidate, checksum=checksum)
             self.logger.info("downloaded workflow input: {} => {}".format(remote_file, cachedFilename))
+            if registerInCache:
+                self._registerCacheReference(workflowInputs_destdir, cachedFilename)
 
             # FIXME: What to do when there is more than one entry in the metadata array?
             if len(metadata_array) > 0 and (metadata_array[0].preferredName is not None):